@@ -1,39 +1,186 @@
-import sys
 import os
-from os.path import isfile
+import hashlib
+from os.path import isdir, isfile, join
 from time import perf_counter
-from datetime import datetime
+from datetime import datetime, timedelta
 import typer
+from typing import BinaryIO
 from typing_extensions import Annotated
-import io
+import tempfile
 import zipfile
+from io import BytesIO
 
 
 import streamlit as st
+import streamlit.components.v1 as components
 import polars as pl
 
 
+from manifest import template_hash
 from mergedata import (
     prepare_data,
-    group_data,
-    unique_rows,
     extract_distributor_data,
-    extract_exhibitor_data,
-    extract_annexure_data,
+    extract_group_data,
+    extract_payloads,
+    index_groups,
 )
-from utils import tpl_suffix, get_fname, with_suffix
-from htmlmerge import md_html_mergefields, get_jinja2_template
-from docxmerge import (
-    docx_mergefields,
-    detect_soffice_path,
-    soffice_docx2pdf,
+from utils import tpl_suffix, get_fname
+from htmlmerge import PdfRenderer
+from docxmerge import docx_mergefields_pdf, detect_soffice_path
+from jobs import DONE, JOBS_DIR, JobStore
+
+
+# Cached results expire after CACHE_TTL, and at most CACHE_MAX_ENTRIES parsed workbooks
+# and prepared data sets are kept in memory. ZIP files are kept on disk in ZIP_CACHE_DIR
+# and expire in the same way
+CACHE_TTL = timedelta(hours=1)
+CACHE_MAX_ENTRIES = 16
+ZIP_CACHE_DIR = os.environ.get(
+    "AGREEMENT_ZIP_CACHE_DIR", join(tempfile.gettempdir(), "agreement_zips")
 )
-
-
-def create_zip(flist: list[str], zip_name: str = "output.zip"):
-    with zipfile.ZipFile(zip_name, "w") as zipf:
-        for fname in flist:
-            zipf.write(fname)
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+FNAME_TPL = "{count:02}_{movie}_{exhibitor}_{release_date}"
+
+
+@st.cache_resource
+def st_job_store() -> JobStore:
+    # Opened once rather than on every rerun
+    return JobStore()
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=4)
+def st_renderer(tpl_fname: str, tpl_type: str, css_fname: str, tpl_digest: str):
+    # The renderer is shared across reruns and sessions; tpl_digest makes an edited
+    # template or stylesheet a new key
+    return PdfRenderer(tpl_fname, tpl_type, css_fname)
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def st_read_excel(data: bytes) -> pl.DataFrame:
+    # Keyed on the contents of the workbook, so reruns do not parse an upload again
+    return pl.read_excel(BytesIO(data))
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def st_prepare_frame(uploads: tuple[bytes, bytes, bytes]) -> tuple[dict, pl.DataFrame]:
+    # Distributor data and the prepared DataFrame of the documents, prepared once for
+    # both generating all the documents and previewing one of them
+    distributors, df = prepare_data(*(st_read_excel(data) for data in uploads))
+    return extract_distributor_data(distributors), df
+
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def st_prepare_data(uploads: tuple[bytes, bytes, bytes]) -> tuple[dict, list[tuple]]:
+    # Distributor data, and the PDF file name, exhibitor data and annexure data of each
+    # document
+    distributor_data, df = st_prepare_frame(uploads)
+    docs = []
+    for count, (exhibitor_data, annexure) in enumerate(
+        extract_payloads(df, GROUP_COLS), start=1
+    ):
+        output_fname = get_fname(
+            FNAME_TPL,
+            count=count,
+            movie=exhibitor_data["movie"].lower(),
+            exhibitor=exhibitor_data["exhibitor"],
+            release_date=exhibitor_data["release_date"],
+        )
+        docs.append((f"{output_fname}.pdf", exhibitor_data, annexure))
+    return distributor_data, docs
+
+
+@st.cache_resource(ttl=CACHE_TTL, max_entries=4, show_spinner=False)
+def st_group_index(uploads: tuple[bytes, bytes, bytes]) -> tuple[dict, dict]:
+    # Distributor data and the rows of each document keyed by its group, partitioned from
+    # the cached prepared DataFrame and shared rather than copied on every rerun, so that
+    # a preview extracts the data of the selected document only
+    distributor_data, df = st_prepare_frame(uploads)
+    return distributor_data, index_groups(df, GROUP_COLS)
+
+
+def st_render_zip(
+    uploads: tuple[bytes, bytes, bytes],
+    tpl_fname: str,
+    tpl_type: str,
+    css_fname: str,
+    tpl_digest: str,
+) -> BinaryIO:
+    # ZIP file of the PDF files, opened for reading. It is written once to ZIP_CACHE_DIR
+    # under the hash of the uploads and of the template and stylesheet, so that reruns find
+    # it on disk and no ZIP file is held in memory between reruns. It is opened before
+    # ZIP files are pruned, so another session cannot remove it before it is read, and it
+    # is generated again if it was removed since it was written
+    h = hashlib.sha256(f"{tpl_type}:{tpl_digest}".encode("utf-8"))
+    for data in uploads:
+        h.update(hashlib.sha256(data).digest())
+    zip_fname = join(ZIP_CACHE_DIR, f"{h.hexdigest()[:32]}.zip")
+    try:
+        f = open(zip_fname, "rb")
+    except FileNotFoundError:
+        pass
+    else:
+        try:
+            os.utime(zip_fname)
+        except OSError:
+            # Removed since it was opened, which does not stop it from being read
+            pass
+        prune_zip_cache()
+        return f
+
+    distributor_data, docs = st_prepare_data(uploads)
+    if tpl_type in ["md", "html"]:
+        renderer = st_renderer(tpl_fname, tpl_type, css_fname, tpl_digest)
+    else:
+        soffice_path, _, _ = detect_soffice_path()
+    os.makedirs(ZIP_CACHE_DIR, exist_ok=True)
+    zip_file = tempfile.NamedTemporaryFile(
+        dir=ZIP_CACHE_DIR, suffix=".tmp", delete=False
+    )
+    # A failed run leaves no partial ZIP file behind
+    try:
+        with zip_file, zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED) as zipf:
+            for output_fname, exhibitor_data, annexure in docs:
+                st.write(f"Generating {output_fname}")
+                if tpl_type == "docx":
+                    pdf = docx_mergefields_pdf(
+                        tpl_fname,
+                        soffice_path,
+                        distributor_data,
+                        exhibitor_data,
+                        annexure,
+                    )
+                else:
+                    pdf = renderer.write_pdf(
+                        None, distributor_data, exhibitor_data, annexure
+                    )
+                zipf.writestr(output_fname, pdf)
+    except BaseException:
+        os.remove(zip_file.name)
+        raise
+    os.replace(zip_file.name, zip_fname)
+    f = open(zip_fname, "rb")
+    prune_zip_cache()
+    return f
+
+
+def prune_zip_cache():
+    # ZIP files not used for CACHE_TTL, and the least recently used ones beyond
+    # CACHE_MAX_ENTRIES, are removed, as st.cache_data does for the data sets
+    entries = []
+    for entry in os.scandir(ZIP_CACHE_DIR):
+        try:
+            if entry.name.endswith(".zip"):
+                entries.append((entry.stat().st_mtime, entry.path))
+        except OSError:
+            pass
+    entries.sort(reverse=True)
+    expired = datetime.now().timestamp() - CACHE_TTL.total_seconds()
+    for i, (mtime, path) in enumerate(entries):
+        if i >= CACHE_MAX_ENTRIES or mtime < expired:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
 
 def st_read_data(
@@ -45,14 +192,20 @@ def st_read_data(
         exhibitors = st.file_uploader("Upload exhibitors data file", type=["xlsx"])
         theatres = st.file_uploader("Upload theatres data file", type=["xlsx"])
         st.session_state.distributors = (
-            pl.read_excel(distributors) if distributors else pl.DataFrame()
+            st_read_excel(distributors.getvalue()) if distributors else pl.DataFrame()
         )
         st.session_state.exhibitors = (
-            pl.read_excel(exhibitors) if exhibitors else pl.DataFrame()
+            st_read_excel(exhibitors.getvalue()) if exhibitors else pl.DataFrame()
         )
         st.session_state.theatres = (
-            pl.read_excel(theatres) if theatres else pl.DataFrame()
+            st_read_excel(theatres.getvalue()) if theatres else pl.DataFrame()
         )
+        if distributors and exhibitors and theatres:
+            st.session_state.uploads = (
+                distributors.getvalue(),
+                exhibitors.getvalue(),
+                theatres.getvalue(),
+            )
         tpl = st.file_uploader("Upload agreement template file", type=["jinja", "docx"])
         st.session_state.tpl_fname = tpl.name if tpl else ""
         if tpl and tpl_suffix(tpl.name) in ["html", "md"]:
@@ -69,6 +222,10 @@ def st_read_data(
             )
             if tpl_suffix(st.session_state.tpl_fname) in ["html", "md"]:
                 button_enabled = button_enabled and st.session_state.css_fname
+            st.session_state.background = st.checkbox(
+                "Run as a background job",
+                help="Queue the job for the job service started with 'python main.py jobs serve' instead of generating the documents in this session",
+            )
             button = st.button(
                 "Continue",
                 disabled=not button_enabled,
@@ -78,9 +235,14 @@ def st_read_data(
                 st.session_state.read_data = "continue"
     else:
         st.session_state.run_mode = "batch"
-        st.session_state.distributors = pl.read_excel(distributors_fname)
-        st.session_state.exhibitors = pl.read_excel(exhibitors_fname)
-        st.session_state.theatres = pl.read_excel(theatres_fname)
+        uploads = []
+        for fname in (distributors_fname, exhibitors_fname, theatres_fname):
+            with open(fname, "rb") as f:
+                uploads.append(f.read())
+        st.session_state.uploads = tuple(uploads)
+        st.session_state.distributors = st_read_excel(uploads[0])
+        st.session_state.exhibitors = st_read_excel(uploads[1])
+        st.session_state.theatres = st_read_excel(uploads[2])
         st.session_state.tpl_fname = template_fname if isfile(template_fname) else ""
         st.session_state.css_fname = css_fname if isfile(css_fname) else ""
         st.session_state.read_data = "continue"
@@ -100,6 +262,86 @@ if "css_fname" not in st.session_state:
     st.session_state.css_fname = ""
 if "zip_downloaded" not in st.session_state:
     st.session_state.zip_downloaded = False
+if "uploads" not in st.session_state:
+    st.session_state.uploads = None
+if "background" not in st.session_state:
+    st.session_state.background = False
+if "job_id" not in st.session_state:
+    st.session_state.job_id = ""
+
+
+def st_submit_job():
+    # Queue the job once per session, however often the script reruns
+    if not st.session_state.job_id:
+        tpl_type = tpl_suffix(st.session_state.tpl_fname)
+        st.session_state.job_id = st_job_store().submit(
+            *st.session_state.uploads,
+            st.session_state.tpl_fname,
+            st.session_state.css_fname if tpl_type in ["html", "md"] else "",
+        )
+    st.success(f"Queued background job {st.session_state.job_id}")
+
+
+def st_preview():
+    # Render one selected document with the warm renderer, so that an edit of the
+    # template or stylesheet can be checked without generating all the documents
+    tpl_fname = st.session_state.tpl_fname
+    css_fname = st.session_state.css_fname
+    tpl_type = tpl_suffix(tpl_fname)
+    if not st.session_state.uploads or tpl_type not in ["html", "md"] or not css_fname:
+        return
+    with st.expander("Preview one agreement document"):
+        distributor_data, index = st_group_index(st.session_state.uploads)
+        key = st.selectbox(
+            "Exhibitor, place, movie, release date and agreement date",
+            list(index),
+            format_func=lambda key: " | ".join(str(value) for value in key),
+        )
+        if key is None:
+            return
+        t1 = perf_counter()
+        renderer = st_renderer(
+            tpl_fname, tpl_type, css_fname, template_hash(tpl_fname, css_fname)
+        )
+        exhibitor_data, annexure = extract_group_data(index, key)
+        html, pdf = renderer.render_preview(distributor_data, exhibitor_data, annexure)
+        st.caption(f"Rendered in {1000 * (perf_counter() - t1):.0f}ms")
+        with open(css_fname, encoding="utf-8") as f:
+            css = f.read()
+        components.html(f"<style>{css}</style>{html}", height=800, scrolling=True)
+        st.download_button(
+            label="Download first page as PDF",
+            data=pdf,
+            file_name="preview.pdf",
+            mime="application/pdf",
+        )
+
+
+def st_jobs():
+    # There are no jobs to list before the first is submitted, and the jobs directory is
+    # not created just to find that out
+    if not isdir(JOBS_DIR):
+        return
+    store = st_job_store()
+    with st.sidebar:
+        st.header("Background jobs")
+        if st.button("Refresh"):
+            st.rerun()
+        for job in store.jobs(limit=10):
+            st.write(f"**{job['id']}**: {job['status']}")
+            if job["total"]:
+                st.progress(job["done"] / job["total"], f"{job['done']}/{job['total']}")
+            if job["error"]:
+                st.error(job["error"])
+            if job["status"] == DONE and isfile(job["artifact"]):
+                with open(job["artifact"], "rb") as f:
+                    st.download_button(
+                        label="Download ZIP file",
+                        data=f,
+                        file_name=f"agreement_docs_{job['id']}.zip",
+                        mime="application/zip",
+                        key=f"download_{job['id']}",
+                    )
 
 
 # ---- Streamlit App ----
@@ -130,89 +372,34 @@ def st_app():
             )
             st.stop()
 
-        # Clean and prepare data for use
+        # Clean and prepare data for use; both steps are cached, so that reruns of the
+        # script, such as the one after clicking the download button, cost nothing
 
-        distributors, df = prepare_data(
-            st.session_state.distributors,
-            st.session_state.exhibitors,
-            st.session_state.theatres,
-        )
-
-        group_cols = [
-            "exhibitor",
-            "exhibitor_place",
-            "movie",
-            "release_date",
-            "agreement_date",
-        ]
-        grouped_df = group_data(df, group_cols)
-        num_exhibitors = unique_rows(df, group_cols)
+        _, docs = st_prepare_data(st.session_state.uploads)
+        num_exhibitors = len(docs)
         st.markdown(f"**Number of exhibitors: {num_exhibitors}**")
-
-        fname_tpl = "{count:02}_{movie}_{exhibitor}_{release_date}"
-
-        distributor_data = extract_distributor_data(distributors)
-
-        if tpl_type in ["md", "html"]:
-            jinja_template = get_jinja2_template(st.session_state.tpl_fname, "")
-        elif tpl_type == "docx":
-            soffice_path, cmd_list, shell = detect_soffice_path()
-        else:
-            print(
-                f"Unknown template type: {tpl_type}. Supported types are: md, html, docx\nProgram aborted"
-            )
-            sys.exit(1)
+        tpl_digest = template_hash(
+            st.session_state.tpl_fname, st.session_state.css_fname
+        )
 
         # --------------------------
         with st.status(
             "Generating agreement document files...", expanded=True
         ) as status:
-            count = 0
-            flist = []
-            for g_exhibitor, g_theatres in grouped_df:
-                count += 1
-                exhibitor_data = extract_exhibitor_data(g_exhibitor, g_theatres)
-                annexure = extract_annexure_data(g_theatres)
-
-                output_fname = get_fname(
-                    fname_tpl,
-                    count=count,
-                    movie=exhibitor_data["movie"].lower(),
-                    exhibitor=exhibitor_data["exhibitor"],
-                    release_date=exhibitor_data["release_date"],
+            try:
+                zip_file = st_render_zip(
+                    st.session_state.uploads,
+                    st.session_state.tpl_fname,
+                    tpl_type,
+                    st.session_state.css_fname,
+                    tpl_digest,
                 )
-
-                if tpl_type == "docx":
-                    output_fname = f"{output_fname}.docx"
-                    docx_mergefields(
-                        st.session_state.tpl_fname,
-                        output_fname,
-                        distributor_data,
-                        exhibitor_data,
-                        annexure,
-                    )
-                    st.write(f"Generating {with_suffix(output_fname, '.pdf')}")
-                    soffice_docx2pdf(output_fname, cmd_list, shell)
-                    os.remove(output_fname)
-                elif tpl_type in ["html", "md"]:
-                    # st.write(f"{st.session_state.css_fname}")
-                    output_fname = f"{output_fname}.pdf"
-                    md_html_mergefields(
-                        jinja_template,
-                        tpl_type,
-                        st.session_state.css_fname,
-                        output_fname,
-                        distributor_data=distributor_data,
-                        exhibitor_data=exhibitor_data,
-                        annexure=annexure,
-                    )
-                    st.write(f"Generating {output_fname}")
-                else:
-                    st.error(
-                        f"Unknown template type: {tpl_type}. Supported types are: md, html, docx"
-                    )
-                    sys.exit(1)
-                flist.append(output_fname)
+            except (OSError, RuntimeError) as e:
+                # A missing LibreOffice or a failed conversion; the result is not cached,
+                # so the next rerun tries again
+                status.update(label="Generation failed", state="error")
+                st.error(f"Agreement documents could not be generated: {e}")
+                st.stop()
             t2 = t_stop = perf_counter()
 
             status.update(
@@ -224,11 +411,10 @@ def st_app():
                 f"Generation of PDF files is complete in {t_stop - t2:.2f}s at {(t_stop - t_start) / num_exhibitors:.2f}s per file",
             )
 
-        # Zip PDF files for download
+        # Download the ZIP file of PDF files
         today = datetime.today().strftime("%Y-%m-%d")
         zip_fname = f"agreement_docs_{today}.zip"
-        create_zip(flist, zip_fname)
-        with open(zip_fname, "rb") as f:
+        with zip_file as f:
             st.download_button(
                 label="Download ZIP file",
                 data=f,
@@ -238,9 +424,6 @@ def st_app():
             )
         st.session_state.zip_downloaded = True
         st.success(f"ZIP file '{zip_fname}' downloaded successfully.")
-        # Clean up files
-        for file in flist:
-            os.remove(file)
 
         st.success(
             f"Total time taken: {t_stop - t_start:.2f}s at {(t_stop - t_start) / num_exhibitors:.2f}s per file"
@@ -258,6 +441,11 @@ def main(
 ):
     st.write(f"Theatres: '{theatres}'")
     st_read_data(distributors, exhibitors, theatres, template, css)
+    st_jobs()
+    st_preview()
+    if st.session_state.background and st.session_state.read_data == "continue":
+        st_submit_job()
+        st.stop()
     st_app()
     if st.session_state.zip_downloaded:
         st.stop()
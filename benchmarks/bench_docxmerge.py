@@ -0,0 +1,111 @@
+"""Benchmark of the DOCX merge of agreement documents.
+
+Compares merging each document with a new MailMerge object, which reads and parses the
+template every time, with the DocxTemplate engine, which parses it once. Checks that both
+write the same XML parts. Uses a synthetic template unless one is given. Run from the
+project directory with:
+
+    uv run -- python -m benchmarks.bench_docxmerge --docs 200
+    uv run -- python -m benchmarks.bench_docxmerge --template agreement_template.docx
+"""
+
+import os
+import tempfile
+import zipfile
+from time import perf_counter
+from typing_extensions import Annotated
+
+
+import typer
+from lxml import etree
+from mailmerge import MailMerge
+from rich.console import Console
+
+
+from benchmarks.synthetic import synthetic_data, write_docx_template
+from docxmerge import DocxTemplate
+from mergedata import clean_data, extract_distributor_data, extract_payloads, join_data
+
+
+con = Console()
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+
+
+def mailmerge_docx(docx_tpl, docx_fname, distributor_data, exhibitor_data, annexure):
+    tpl = MailMerge(docx_tpl)
+    tpl.merge(**distributor_data)
+    tpl.merge(**exhibitor_data)
+    tpl.merge_rows("slno", annexure)
+    tpl.write(docx_fname)
+
+
+def canonical_parts(docx_fname: str) -> dict[str, bytes]:
+    with zipfile.ZipFile(docx_fname) as docx:
+        return {
+            name: etree.tostring(etree.fromstring(docx.read(name)), method="c14n")
+            for name in docx.namelist()
+            if name.endswith(".xml") or name.endswith(".rels")
+        }
+
+
+def main(
+    docs: Annotated[
+        int, typer.Option("--docs", "-n", help="Number of documents")
+    ] = 200,
+    template: Annotated[
+        str,
+        typer.Option("--template", "-t", help="DOCX template, synthetic if not given"),
+    ] = "",
+):
+    with tempfile.TemporaryDirectory() as workdir:
+        template = template or write_docx_template(os.path.join(workdir, "tpl.docx"))
+        distributors, exhibitors, theatres = clean_data(*synthetic_data(docs))
+        distributor_data = extract_distributor_data(distributors)
+        payloads = extract_payloads(join_data(exhibitors, theatres), GROUP_COLS)
+
+        old_dir = os.path.join(workdir, "mailmerge")
+        new_dir = os.path.join(workdir, "docxtemplate")
+        os.makedirs(old_dir)
+        os.makedirs(new_dir)
+        t1 = perf_counter()
+        for i, (exhibitor_data, annexure) in enumerate(payloads):
+            mailmerge_docx(
+                template,
+                os.path.join(old_dir, f"{i:05}.docx"),
+                distributor_data,
+                exhibitor_data,
+                annexure,
+            )
+        t2 = perf_counter()
+        tpl = DocxTemplate(template)
+        for i, (exhibitor_data, annexure) in enumerate(payloads):
+            tpl.merge(
+                os.path.join(new_dir, f"{i:05}.docx"),
+                distributor_data,
+                exhibitor_data,
+                table_rows=annexure,
+            )
+        t3 = perf_counter()
+
+        for i in range(len(payloads)):
+            fname = f"{i:05}.docx"
+            old = canonical_parts(os.path.join(old_dir, fname))
+            new = canonical_parts(os.path.join(new_dir, fname))
+            if old != new:
+                diff = [name for name in old if old[name] != new.get(name)]
+                con.print(f"[red]{fname} differs from MailMerge in {diff}")
+                raise typer.Exit(1)
+
+    n = len(payloads)
+    con.print(f"Documents:    {n}")
+    con.print(
+        f"MailMerge:    {t2 - t1:.3f}s, {1000 * (t2 - t1) / n:.2f}ms per document"
+    )
+    con.print(
+        f"DocxTemplate: {t3 - t2:.3f}s, {1000 * (t3 - t2) / n:.2f}ms per document"
+    )
+    con.print(f"Speedup:      {(t2 - t1) / (t3 - t2):.1f}x")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,104 @@
+"""Benchmark of the Indian currency and long date formatting in clean_theatres_data.
+
+Compares the per-row map_elements implementation with the Polars expression helpers
+fmt_indian_expr and long_date_expr on a synthetic theatres frame, and checks that both
+produce identical output. Run from the project directory with:
+
+    uv run -- python -m benchmarks.bench_formatting --rows 1000000
+"""
+
+import random
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing_extensions import Annotated
+
+
+import pendulum
+import polars as pl
+import typer
+from rich.console import Console
+
+
+from mergedata import fmt_indian, fmt_indian_expr, long_date_expr
+
+
+con = Console()
+
+
+def synthetic_theatres(rows: int, seed: int = 0) -> pl.DataFrame:
+    """Generate a synthetic theatres frame with the columns formatted by
+    clean_theatres_data.
+
+    Args:
+        rows (int): Number of rows.
+        seed (int): Seed of the random number generator. Default is 0.
+
+    Returns:
+        pl.DataFrame: Frame with mg, release_date and agreement_date columns.
+    """
+    rng = random.Random(seed)
+    mg = [
+        0.0 if rng.random() < 0.2 else float(rng.randrange(50_000_000))
+        for _ in range(rows)
+    ]
+    start = datetime(2025, 1, 1)
+    days = [rng.randrange(365) for _ in range(rows)]
+    return pl.DataFrame(
+        {
+            "mg": mg,
+            "release_date": [start + timedelta(days=d) for d in days],
+            "agreement_date": [start + timedelta(days=d - 7) for d in days],
+        }
+    )
+
+
+def format_map_elements(df: pl.DataFrame) -> pl.DataFrame:
+    return df.select(
+        pl.col("release_date")
+        .map_elements(
+            lambda dt: pendulum.instance(dt).format("Do [day of] MMMM, YYYY"),
+            return_dtype=pl.String,
+        )
+        .alias("release_date_long"),
+        pl.col("agreement_date")
+        .map_elements(
+            lambda dt: pendulum.instance(dt).format("Do [day of] MMMM, YYYY"),
+            return_dtype=pl.String,
+        )
+        .alias("agreement_date_long"),
+        pl.col("mg").map_elements(fmt_indian, return_dtype=pl.String).alias("mg_str"),
+    )
+
+
+def format_expr(df: pl.DataFrame) -> pl.DataFrame:
+    return df.select(
+        long_date_expr(pl.col("release_date")).alias("release_date_long"),
+        long_date_expr(pl.col("agreement_date")).alias("agreement_date_long"),
+        fmt_indian_expr(pl.col("mg")).alias("mg_str"),
+    )
+
+
+def main(
+    rows: Annotated[
+        int, typer.Option("--rows", "-n", help="Number of rows")
+    ] = 1_000_000,
+):
+    con.log(f"Generating {rows} synthetic theatre rows")
+    df = synthetic_theatres(rows)
+
+    t1 = perf_counter()
+    expected = format_map_elements(df)
+    t2 = perf_counter()
+    actual = format_expr(df)
+    t3 = perf_counter()
+
+    if not actual.equals(expected):
+        con.print("[red]Output of the expression helpers differs from map_elements")
+        raise typer.Exit(1)
+    con.print(f"map_elements: {t2 - t1:.3f}s")
+    con.print(f"expressions:  {t3 - t2:.3f}s")
+    con.print(f"Speedup:      {(t2 - t1) / (t3 - t2):.1f}x")
+
+
+if __name__ == "__main__":
+    typer.run(main)
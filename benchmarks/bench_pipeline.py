@@ -0,0 +1,231 @@
+"""Benchmark of the stages of the agreement generation pipeline.
+
+Generates synthetic workbooks at several scales, times each stage separately and writes
+the results to a JSON file that can be compared with the results of another commit. Run
+from the project directory with:
+
+    uv run -- python -m benchmarks.bench_pipeline --output bench.json
+    uv run -- python -m benchmarks.bench_pipeline --compare bench.json
+
+Stages that need WeasyPrint, a .docx template or LibreOffice are skipped when these are
+not available.
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from datetime import datetime
+from time import perf_counter
+from typing_extensions import Annotated
+
+
+import polars as pl
+import typer
+from rich.console import Console
+from rich.table import Table
+
+
+from benchmarks.synthetic import write_workbooks
+from docxmerge import docx_mergefields, soffice_docx2pdf_batch
+from mergedata import (
+    clean_data,
+    extract_distributor_data,
+    extract_payloads,
+    group_data,
+    join_data,
+    read_data,
+)
+from utils import tpl_suffix
+
+
+con = Console()
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+
+
+def git_commit() -> str:
+    res = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True)
+    return res.stdout.decode("utf-8").strip() if res.returncode == 0 else ""
+
+
+class Timer:
+    """Collects the time taken by each stage of one benchmark scale."""
+
+    def __init__(self, groups: int):
+        self.groups = groups
+        self.results = []
+
+    def __call__(self, stage: str, fn, *args, count: int | None = None, **kwargs):
+        t1 = perf_counter()
+        res = fn(*args, **kwargs)
+        t2 = perf_counter()
+        self.results.append(
+            {
+                "groups": self.groups,
+                "stage": stage,
+                "seconds": t2 - t1,
+                "count": count or self.groups,
+            }
+        )
+        return res
+
+    def skip(self, stage: str, reason: str):
+        con.log(f"{self.groups} groups: skipped {stage}: {reason}")
+
+
+def bench_scale(
+    workdir: str,
+    n_groups: int,
+    template: str,
+    css: str,
+    docx_template: str,
+    max_docs: int,
+) -> list[dict]:
+    timer = Timer(n_groups)
+    fnames = write_workbooks(workdir, n_groups)
+
+    distributors, exhibitors, theatres = timer("read", read_data, *fnames, cache=False)
+    distributors, exhibitors, theatres = timer(
+        "clean_data", clean_data, distributors, exhibitors, theatres
+    )
+    df = timer("join_data", join_data, exhibitors, theatres)
+    timer(
+        "grouping",
+        lambda: sum(1 for _ in group_data(df, GROUP_COLS)),
+    )
+    payloads = timer("extraction", extract_payloads, df, GROUP_COLS)
+    distributor_data = extract_distributor_data(distributors)
+    sample = payloads[:max_docs]
+
+    try:
+        from weasyprint import HTML
+        from htmlmerge import PdfRenderer, get_font_config
+    except (ImportError, OSError) as e:
+        timer.skip("render, html2pdf", f"WeasyPrint not available ({e})")
+    else:
+        renderer = PdfRenderer(template, tpl_suffix(template), css)
+        html = timer(
+            "render",
+            lambda: [
+                renderer.render_html(distributor_data, exhibitor_data, annexure)
+                for exhibitor_data, annexure in sample
+            ],
+            count=len(sample),
+        )
+        timer(
+            "html2pdf",
+            lambda: [
+                HTML(string=content).write_pdf(
+                    stylesheets=[renderer.stylesheet], font_config=get_font_config()
+                )
+                for content in html
+            ],
+            count=len(sample),
+        )
+
+    if not docx_template or not os.path.isfile(docx_template):
+        timer.skip("docx_merge, soffice", "no .docx template")
+        return timer.results
+    docx_dir = os.path.join(workdir, "docx")
+    os.makedirs(docx_dir, exist_ok=True)
+    docx_fnames = [os.path.join(docx_dir, f"{i:05}.docx") for i in range(len(sample))]
+    timer(
+        "docx_merge",
+        lambda: [
+            docx_mergefields(
+                docx_template, fname, distributor_data, exhibitor_data, annexure
+            )
+            for fname, (exhibitor_data, annexure) in zip(docx_fnames, sample)
+        ],
+        count=len(sample),
+    )
+    soffice_path = shutil.which("soffice")
+    if not soffice_path:
+        timer.skip("soffice", "soffice not found")
+    else:
+        timer(
+            "soffice",
+            soffice_docx2pdf_batch,
+            docx_fnames,
+            soffice_path,
+            docx_dir,
+            count=len(sample),
+        )
+    return timer.results
+
+
+def print_results(results: list[dict], baseline: list[dict] | None = None):
+    table = Table("Groups", "Stage", "Seconds", "Per item (ms)", "Baseline", "Ratio")
+    base = {(r["groups"], r["stage"]): r for r in baseline or []}
+    for r in results:
+        b = base.get((r["groups"], r["stage"]))
+        table.add_row(
+            str(r["groups"]),
+            r["stage"],
+            f"{r['seconds']:.3f}",
+            f"{1000 * r['seconds'] / r['count']:.2f}",
+            f"{b['seconds']:.3f}" if b else "",
+            f"{r['seconds'] / b['seconds']:.2f}" if b and b["seconds"] else "",
+        )
+    con.print(table)
+
+
+def main(
+    scales: Annotated[
+        list[int],
+        typer.Option("--scale", "-s", help="Number of groups, may be repeated"),
+    ] = (10, 100, 1_000, 10_000),
+    template: Annotated[
+        str, typer.Option("--template", "-t", help="Markdown or HTML template")
+    ] = "agreement.html.jinja",
+    css: Annotated[str, typer.Option("--css", "-c", help="CSS stylesheet")] = (
+        "agreement.css"
+    ),
+    docx_template: Annotated[
+        str, typer.Option("--docx-template", help="DOCX template with MergeFields")
+    ] = "agreement_template.docx",
+    max_docs: Annotated[
+        int,
+        typer.Option(
+            "--max-docs", help="Maximum number of documents rendered per scale"
+        ),
+    ] = 100,
+    output: Annotated[
+        str, typer.Option("--output", "-o", help="JSON file to write results to")
+    ] = "",
+    compare: Annotated[
+        str, typer.Option("--compare", help="JSON results of an earlier run")
+    ] = "",
+):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_groups in scales:
+            con.log(f"Benchmarking {n_groups} groups")
+            results += bench_scale(
+                workdir, n_groups, template, css, docx_template, max_docs
+            )
+
+    baseline = None
+    if compare:
+        with open(compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if output:
+        report = {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "polars": pl.__version__,
+            "platform": platform.platform(),
+            "results": results,
+        }
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        con.log(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,113 @@
+"""Check of the import time of the CLI and of each template backend.
+
+Runs each command with python -X importtime, adds up the cumulative import time of the
+top level imports, and fails if it is over budget or if the command imports a module it
+should not load, for instance WeasyPrint for --help or a .docx run. Each command is run
+several times and the fastest run is kept. Run from the project directory with:
+
+    uv run -- python -m benchmarks.bench_startup
+    uv run -- python -m benchmarks.bench_startup --scale 2
+
+Backends whose libraries cannot be loaded, such as WeasyPrint without Pango, are
+reported and skipped.
+"""
+
+import re
+import subprocess
+import sys
+from typing_extensions import Annotated
+
+
+import typer
+from rich.console import Console
+from rich.table import Table
+
+
+con = Console()
+re_importtime = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+# Command, import time budget in milliseconds, and modules the command must not import
+CHECKS = {
+    "--help": (
+        ["main.py", "--help"],
+        400,
+        ["polars", "weasyprint", "mailmerge", "pikepdf", "fontTools"],
+    ),
+    "jobs status": (
+        ["main.py", "jobs", "status"],
+        400,
+        ["polars", "weasyprint", "mailmerge", "pikepdf"],
+    ),
+    "data": (["-c", "import mergedata"], 500, ["weasyprint", "mailmerge"]),
+    "docx": (["-c", "import docxmerge"], 500, ["weasyprint", "polars"]),
+    "html": (["-c", "import htmlmerge"], 1500, ["mailmerge", "polars"]),
+}
+
+
+def import_times(args: list[str]) -> tuple[float, set[str]] | None:
+    """Run python -X importtime with arguments and parse its report.
+
+    Args:
+        args (list[str]): Arguments after -X importtime.
+
+    Returns:
+        tuple[float, set[str]] | None: Total import time in milliseconds and the names
+            of the imported modules, or None if the command failed.
+    """
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", *args], capture_output=True, text=True
+    )
+    if res.returncode != 0:
+        return None
+    total = 0
+    modules = set()
+    for line in res.stderr.splitlines():
+        m = re_importtime.match(line)
+        if not m:
+            continue
+        modules.add(m.group(4))
+        # Nested imports are indented, and included in the time of their importer
+        if len(m.group(3)) == 1:
+            total += int(m.group(2))
+    return total / 1000, modules
+
+
+def main(
+    repeat: Annotated[
+        int, typer.Option("--repeat", "-r", help="Runs of each command")
+    ] = 3,
+    scale: Annotated[
+        float,
+        typer.Option("--scale", help="Multiply the budgets, for slower machines"),
+    ] = 1.0,
+):
+    table = Table(title="Import time")
+    for col in ("Check", "Time (ms)", "Budget (ms)", "Result"):
+        table.add_column(col)
+    failed = 0
+    for name, (args, budget, forbidden) in CHECKS.items():
+        runs = [import_times(args) for _ in range(repeat)]
+        if None in runs:
+            table.add_row(name, "-", f"{budget * scale:.0f}", "[yellow]unavailable")
+            continue
+        total, modules = min(runs, key=lambda run: run[0])
+        loaded = sorted(
+            module
+            for module in forbidden
+            if any(m == module or m.startswith(f"{module}.") for m in modules)
+        )
+        if loaded:
+            result = f"[red]imports {', '.join(loaded)}"
+        elif total > budget * scale:
+            result = "[red]over budget"
+        else:
+            result = "[green]ok"
+        failed += result != "[green]ok"
+        table.add_row(name, f"{total:.0f}", f"{budget * scale:.0f}", result)
+    con.print(table)
+    if failed:
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
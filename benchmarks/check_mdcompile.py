@@ -0,0 +1,131 @@
+"""Check that a compiled Markdown template renders the same HTML as the Markdown template.
+
+Renders the documents of synthetic data, and of edge cases such as names with Markdown
+characters, a nil advance or an empty annexure, both with the Markdown template followed
+by mistune, as htmlmerge does for a template that is not compiled, and with
+mdcompile.MarkdownTemplate. Fails if the template cannot be compiled or if any document
+differs, and prints how many documents the compiled template rendered and the time per
+document of each path. WeasyPrint is not needed. Run from the project directory with:
+
+    uv run -- python -m benchmarks.check_mdcompile
+    uv run -- python -m benchmarks.check_mdcompile --template agreement_template.md.jinja
+"""
+
+from os.path import abspath, dirname, basename
+from time import perf_counter
+from typing_extensions import Annotated
+
+
+import mistune
+import typer
+from jinja2 import Environment, FileSystemLoader
+from rich.console import Console
+
+
+from benchmarks.synthetic import synthetic_data
+from mdcompile import MarkdownTemplate, NotCompilable
+from mergedata import extract_distributor_data, extract_payloads, prepare_data_lazy
+
+
+con = Console()
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+# Changes of the distributor data, exhibitor data or annexure of a document
+EDGE_CASES = [
+    ("distributor", "dist_name", "SRI KRISHNA FILMS "),
+    ("distributor", "dist_name", "*SRI* KRISHNA_FILMS"),
+    ("distributor", "dist_address", "#12, 3rd Cross & Main Road"),
+    ("distributor", "bank_name", ""),
+    ("exhibitor", "exhibitor", "M/s Star & Co. <Films>"),
+    ("exhibitor", "exhibitor_place", "1. Hubballi"),
+    ("exhibitor", "movie", "`KANTARA`"),
+    ("exhibitor", "movie", '"KANTARA" - Chapter 1'),
+    ("exhibitor", "advance_amt", "-NIL-"),
+    ("exhibitor", "release_date_long", "14th February,\n2025"),
+    ("annexure", "theatre", "Theatre </td><td>"),
+    ("annexure", "station", "Station [1]"),
+    ("annexure", None, []),
+]
+
+
+def edge_cases(distributor_data: dict, exhibitor_data: dict, annexure: list):
+    # Yield the data of a document changed by each edge case in turn
+    for target, key, value in EDGE_CASES:
+        dd, ed, an = dict(distributor_data), dict(exhibitor_data), list(annexure)
+        if target == "distributor":
+            dd[key] = value
+        elif target == "exhibitor":
+            ed[key] = value
+        elif key is None:
+            an = value
+        else:
+            an = [{**row, key: value} for row in an]
+        yield dd, ed, an
+
+
+def main(
+    template: Annotated[
+        str, typer.Option("--template", "-t", help="Markdown template file")
+    ] = "agreement_template.md.jinja",
+    groups: Annotated[
+        int, typer.Option("--groups", "-n", help="Number of documents")
+    ] = 500,
+):
+    distributors, exhibitors, theatres = synthetic_data(groups)
+    distributors, df = prepare_data_lazy(distributors, exhibitors, theatres, GROUP_COLS)
+    distributor_data = extract_distributor_data(distributors)
+    docs = [
+        (distributor_data, exhibitor_data, annexure)
+        for exhibitor_data, annexure in extract_payloads(df.collect(), GROUP_COLS)
+    ]
+    docs += list(edge_cases(*docs[0]))
+
+    env = Environment(loader=FileSystemLoader(dirname(abspath(template))))
+    jinja_tpl = env.get_template(basename(template))
+    t1 = perf_counter()
+    md_template = MarkdownTemplate(jinja_tpl)
+    t_compile = perf_counter() - t1
+    if md_template.compiled is None:
+        con.print(f"[red]{template} could not be compiled")
+        raise typer.Exit(1)
+
+    contexts = [
+        {
+            **dd,
+            **ed,
+            "annexure": an,
+            "time_now": "2025-02-01T00:00:00Z",
+            "weasyprint_ver": "",
+        }
+        for dd, ed, an in docs
+    ]
+    t1 = perf_counter()
+    expected = [mistune.html(jinja_tpl.render(**context)) for context in contexts]
+    t_markdown = perf_counter() - t1
+    t1 = perf_counter()
+    rendered = [md_template.render(**context) for context in contexts]
+    t_compiled = perf_counter() - t1
+
+    compiled = 0
+    for context in contexts:
+        try:
+            md_template.compiled.render(**context)
+            compiled += 1
+        except NotCompilable:
+            pass
+    differ = [i for i, (a, b) in enumerate(zip(expected, rendered)) if a != b]
+
+    con.print(f"Compiled {template} in {t_compile * 1000:.1f}ms")
+    con.print(
+        f"Documents: {len(docs)}, rendered by the compiled template: {compiled}, "
+        f"by Markdown: {len(docs) - compiled}"
+    )
+    con.print(f"Markdown:  {t_markdown / len(docs) * 1000:.3f}ms per document")
+    con.print(f"Compiled:  {t_compiled / len(docs) * 1000:.3f}ms per document")
+    if differ:
+        con.print(f"[red]{len(differ)} documents differ, the first is {differ[0]}")
+        raise typer.Exit(1)
+    con.print("[green]All documents are identical")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,139 @@
+"""Check that the streaming pipeline stays under a memory ceiling.
+
+Writes synthetic data with a large theatres file in .csv format, then prepares the
+payloads of all the documents in two separate processes: once with the streaming pipeline
+of streaming.py, through its bounded queue and with its memory ceiling, and once by
+preparing all the data first, as main.py does without --stream-batch. Fails if the
+payloads differ or if the peak resident set size of the streaming process is over the
+ceiling. Nothing is rendered, so WeasyPrint and LibreOffice are not needed. Run from the
+project directory with:
+
+    uv run -- python -m benchmarks.check_streaming --groups 20000 --max-rss 256
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing_extensions import Annotated
+
+
+import typer
+from rich.console import Console
+
+
+con = Console()
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+
+
+def child(mode: str, workdir: str, batch_rows: int, max_rss: int):
+    # Prepare the payloads in this process and print their digest and the peak RSS
+    from mergedata import extract_payloads, prepare_data_lazy, read_excel
+    from streaming import (
+        iter_theatre_batches,
+        peak_rss,
+        run_stages,
+        stream_payloads,
+    )
+
+    import polars as pl
+
+    h = hashlib.sha256()
+
+    def consume(payload):
+        h.update(json.dumps(payload, sort_keys=True, default=str).encode("utf-8"))
+
+    distributors = read_excel(os.path.join(workdir, "distributors.xlsx"), cache=False)
+    exhibitors = read_excel(os.path.join(workdir, "exhibitors.xlsx"), cache=False)
+    theatres_fname = os.path.join(workdir, "theatres.csv")
+    if mode == "stream":
+        count = run_stages(
+            stream_payloads(
+                exhibitors, iter_theatre_batches(theatres_fname, batch_rows)
+            ),
+            consume,
+            max_rss=max_rss * 2**20,
+        )
+    else:
+        theatres = pl.read_csv(theatres_fname, try_parse_dates=True)
+        _, df = prepare_data_lazy(distributors, exhibitors, theatres, GROUP_COLS)
+        payloads = extract_payloads(df.collect(), GROUP_COLS)
+        for payload in payloads:
+            consume(payload)
+        count = len(payloads)
+    print(json.dumps({"count": count, "digest": h.hexdigest(), "peak": peak_rss()}))
+
+
+def run_child(mode: str, workdir: str, batch_rows: int, max_rss: int) -> dict:
+    res = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.check_streaming",
+            "--child",
+            mode,
+            "--workdir",
+            workdir,
+            "--batch-rows",
+            str(batch_rows),
+            "--max-rss",
+            str(max_rss),
+        ],
+        capture_output=True,
+        text=True,
+    )
+    if res.returncode != 0:
+        con.print(res.stderr)
+        raise typer.Exit(1)
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+def main(
+    groups: Annotated[
+        int, typer.Option("--groups", "-n", help="Number of documents")
+    ] = 20000,
+    batch_rows: Annotated[
+        int, typer.Option("--batch-rows", help="Theatre rows per batch")
+    ] = 5000,
+    max_rss: Annotated[
+        int,
+        typer.Option("--max-rss", help="Memory ceiling of the streaming process in MB"),
+    ] = 256,
+    child_mode: Annotated[str, typer.Option("--child", hidden=True)] = "",
+    workdir: Annotated[str, typer.Option("--workdir", hidden=True)] = "",
+):
+    if child_mode:
+        child(child_mode, workdir, batch_rows, max_rss)
+        return
+
+    from benchmarks.synthetic import synthetic_data
+
+    with tempfile.TemporaryDirectory() as workdir:
+        distributors, exhibitors, theatres = synthetic_data(groups)
+        distributors.write_excel(os.path.join(workdir, "distributors.xlsx"))
+        exhibitors.write_excel(os.path.join(workdir, "exhibitors.xlsx"))
+        theatres.write_csv(os.path.join(workdir, "theatres.csv"))
+        con.print(f"Documents: {groups}, theatres: {theatres.height}")
+        del distributors, exhibitors, theatres
+
+        stream = run_child("stream", workdir, batch_rows, max_rss)
+        full = run_child("full", workdir, batch_rows, 0)
+
+    con.print(f"Streaming peak RSS:   {stream['peak'] / 2**20:.0f} MB")
+    con.print(f"Prepare-all peak RSS: {full['peak'] / 2**20:.0f} MB")
+    failed = False
+    if (stream["count"], stream["digest"]) != (full["count"], full["digest"]):
+        con.print("[red]The streaming payloads differ from those prepared at once")
+        failed = True
+    if stream["peak"] > max_rss * 2**20:
+        con.print(f"[red]Streaming peak RSS is over the ceiling of {max_rss} MB")
+        failed = True
+    if failed:
+        raise typer.Exit(1)
+    con.print(f"[green]Streaming stayed under {max_rss} MB with identical payloads")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,239 @@
+"""Synthetic distributors, exhibitors and theatres data for the benchmarks."""
+
+import random
+import zipfile
+from datetime import datetime
+from os.path import join
+
+
+import polars as pl
+
+
+MOVIES = ["CHHAAVA", "KANTARA", "SALAAR", "VIKRANT RONA"]
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+DOCX_MEMBERS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '<Override PartName="/word/settings.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.settings+xml"/>'
+        "</Types>"
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+        "</Relationships>"
+    ),
+    "word/_rels/document.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/settings" Target="settings.xml"/>'
+        "</Relationships>"
+    ),
+    "word/settings.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<w:settings xmlns:w="{W_NS}"><w:mailMerge><w:mainDocumentType w:val="formLetters"/>'
+        '<w:dataType w:val="spreadsheet"/></w:mailMerge></w:settings>'
+    ),
+}
+
+
+def synthetic_data(n_groups: int, theatres_per_group: int = 3, seed: int = 0):
+    """Generate synthetic input data with the columns of distributors.xlsx, exhibitors.xlsx
+    and a theatres workbook. Every exhibitor screens one movie, so the data prepares into
+    n_groups agreement documents.
+
+    Args:
+        n_groups (int): Number of exhibitors, and so of agreement documents.
+        theatres_per_group (int): Average number of theatres per exhibitor. Default is 3.
+        seed (int): Seed of the random number generator. Default is 0.
+
+    Returns:
+        distributors (pl.DataFrame): Distributor data.
+        exhibitors (pl.DataFrame): Exhibitor data.
+        theatres (pl.DataFrame): Theatre data.
+    """
+    rng = random.Random(seed)
+    distributors = pl.DataFrame(
+        {
+            "dist_name": ["SRI KRISHNA FILMS"],
+            "dist_address": ["Koppikar Road"],
+            "dist_place": ["Hubballi"],
+            "dist_pin": ["580020"],
+            "dist_cell": ["9845552511"],
+            "dist_gst": ["29ABCDE1234F1Z5"],
+            "bank_name": ["State Bank of India"],
+            "bank_ac_number": ["12345678901"],
+            "bank_address": ["Station Road, Hubballi"],
+            "bank_ifsc": ["SBIN0001234"],
+        }
+    )
+    exhibitors = pl.DataFrame(
+        {
+            "exhibitor": [f"M/s Exhibitor {i:05} Films" for i in range(n_groups)],
+            "exhibitor_place": [f"Place {i % 97}" for i in range(n_groups)],
+            "exhibitor_gst": [f"29EXHIB{i:05}Z5" for i in range(n_groups)],
+        }
+    )
+    rows = []
+    for i in range(n_groups):
+        movie = MOVIES[i % len(MOVIES)]
+        for j in range(rng.randint(1, 2 * theatres_per_group - 1)):
+            rows.append(
+                {
+                    "exhibitor": f"m/s exhibitor {i:05}",
+                    "theatre": f"Theatre {i:05}-{j}",
+                    "station": f"Station {rng.randrange(200)}",
+                    "movie": movie,
+                    "movie_description": "Kannada U/A",
+                    "release_date": datetime(2025, 2, 14),
+                    "agreement_date": datetime(2025, 2, 1),
+                    "mg": float(rng.choice([0, 25_000, 50_000, 1_25_000])),
+                    "theatre_share": rng.choice([None, "50%", "45%"]),
+                    "advance_amt": float(rng.choice([0, 10_000, 1_00_000])),
+                    "daily_shows": rng.choice([4, 5]),
+                }
+            )
+    theatres = pl.DataFrame(rows)
+    return distributors, exhibitors, theatres
+
+
+def simple_field(name: str) -> str:
+    return (
+        f'<w:fldSimple w:instr=" MERGEFIELD {name} \\* MERGEFORMAT ">'
+        f"<w:r><w:rPr><w:b/></w:rPr><w:t>«{name}»</w:t></w:r></w:fldSimple>"
+    )
+
+
+def complex_field(name: str) -> str:
+    return (
+        '<w:r><w:fldChar w:fldCharType="begin"/></w:r>'
+        f'<w:r><w:instrText xml:space="preserve"> MERGEFIELD {name} </w:instrText></w:r>'
+        '<w:r><w:fldChar w:fldCharType="separate"/></w:r>'
+        f"<w:r><w:t>«{name}»</w:t></w:r>"
+        '<w:r><w:fldChar w:fldCharType="end"/></w:r>'
+    )
+
+
+def paragraph(*content: str) -> str:
+    return f"<w:p>{''.join(content)}</w:p>"
+
+
+def text(s: str) -> str:
+    return f'<w:r><w:t xml:space="preserve">{s}</w:t></w:r>'
+
+
+def write_docx_template(fname: str, paragraphs: int = 40):
+    """Write a synthetic DOCX agreement template with the MergeFields of the distributor
+    and exhibitor data, both as simple and as complex fields, and an annexure table whose
+    row of MergeFields is repeated for each theatre by merge_rows("slno", ...).
+
+    Args:
+        fname (str): DOCX file name.
+        paragraphs (int): Number of paragraphs of boilerplate text. Default is 40.
+
+    Returns:
+        str: The file name.
+    """
+    body = [
+        paragraph(simple_field("dist_name")),
+        paragraph(
+            complex_field("dist_address"), text(", "), simple_field("dist_place")
+        ),
+        paragraph(
+            text("PIN "),
+            simple_field("dist_pin"),
+            text(" Cell "),
+            complex_field("dist_cell"),
+        ),
+        paragraph(
+            text("This agreement made and entered herein at "),
+            simple_field("dist_place"),
+            text(" between "),
+            complex_field("dist_name"),
+            text(" and the Exhibitor "),
+            simple_field("exhibitor"),
+            text(", "),
+            complex_field("exhibitor_place"),
+            text(" GST "),
+            simple_field("dist_gst"),
+        ),
+        paragraph(
+            text("Film "),
+            simple_field("movie"),
+            text(" "),
+            complex_field("movie_description"),
+            text(" released on the "),
+            simple_field("release_date_long"),
+            text(" with "),
+            complex_field("daily_shows"),
+            text(" shows daily. Agreement dated the "),
+            simple_field("agreement_date_long"),
+        ),
+        paragraph(
+            text("Advance "),
+            complex_field("advance_amt"),
+            text(" to "),
+            simple_field("bank_name"),
+            text(" A/c "),
+            complex_field("bank_ac_number"),
+            text(" IFSC "),
+            simple_field("bank_ifsc"),
+            text(" "),
+            complex_field("bank_address"),
+            text(" Exhibitor GST "),
+            simple_field("exhibitor_gst"),
+        ),
+    ]
+    body += [
+        paragraph(
+            text(f"Clause {i + 1}. The exhibitor shall screen the film as agreed.")
+        )
+        for i in range(paragraphs)
+    ]
+    cols = ["slno", "theatre", "station", "mg_str", "theatre_share"]
+    header = "".join(f"<w:tc>{paragraph(text(col))}</w:tc>" for col in cols)
+    row = "".join(
+        f"<w:tc>{paragraph(simple_field(col) if i % 2 else complex_field(col))}</w:tc>"
+        for i, col in enumerate(cols)
+    )
+    body.append(f"<w:tbl><w:tr>{header}</w:tr><w:tr>{row}</w:tr></w:tbl>")
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<w:document xmlns:w="{W_NS}"><w:body>{"".join(body)}<w:sectPr/></w:body>'
+        "</w:document>"
+    )
+    with zipfile.ZipFile(fname, "w", zipfile.ZIP_DEFLATED) as docx:
+        docx.writestr("[Content_Types].xml", DOCX_MEMBERS["[Content_Types].xml"])
+        docx.writestr("_rels/.rels", DOCX_MEMBERS["_rels/.rels"])
+        docx.writestr("word/document.xml", document)
+        for member in ("word/_rels/document.xml.rels", "word/settings.xml"):
+            docx.writestr(member, DOCX_MEMBERS[member])
+    return fname
+
+
+def write_workbooks(outdir: str, n_groups: int, theatres_per_group: int = 3):
+    """Write synthetic distributors, exhibitors and theatres workbooks. Requires the
+    xlsxwriter package.
+
+    Args:
+        outdir (str): Directory to write the workbooks to.
+        n_groups (int): Number of agreement documents the data prepares into.
+        theatres_per_group (int): Average number of theatres per exhibitor. Default is 3.
+
+    Returns:
+        tuple[str, str, str]: File names of the distributors, exhibitors and theatres
+            workbooks.
+    """
+    fnames = (
+        join(outdir, "distributors.xlsx"),
+        join(outdir, "exhibitors.xlsx"),
+        join(outdir, f"theatres_{n_groups}.xlsx"),
+    )
+    for df, fname in zip(synthetic_data(n_groups, theatres_per_group), fnames):
+        df.write_excel(fname)
+    return fnames
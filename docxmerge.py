@@ -1,35 +1,85 @@
-from os.path import isfile
+import os
+from os.path import abspath, basename, isfile, join, splitext
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from copy import copy, deepcopy
+from functools import lru_cache
+from pathlib import Path
+import queue
+import shutil
+import socket
+import struct
 import subprocess
 import platform
+import tempfile
+import threading
+import time
+import zipfile
 
 
+from lxml import etree
 from mailmerge import MailMerge
+from mailmerge.constants import NAMESPACES
+from mailmerge.mergeoptions import OptionAutoUpdateFields
 from rich.console import Console
 
 
+from tracing import traced, tracer
+
+
 con = Console()
+W_NS = NAMESPACES["w"]
 
 
-# ---- Utility Functions ----
+# ---- Functions to merge prepared data with template ----
 
 
-def print_header(header: str, underline: str = "-"):
-    """Print header with underline.
+def read_compressed(f, zi: zipfile.ZipInfo) -> bytes:
+    """Read the compressed data of a ZIP member, as stored in the file.
 
     Args:
-        header (str): Header text.
-        underline (str): Underline character. Defaults to "-".
+        f (file): ZIP file opened in binary mode.
+        zi (zipfile.ZipInfo): The member, from the central directory of the file.
 
     Returns:
-        None
+        bytes: The compressed data of the member.
     """
-    print()
-    print(header)
-    print(f"{underline * len(header)}")
-    print()
+    f.seek(zi.header_offset)
+    header = f.read(zipfile.sizeFileHeader)
+    if header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header of {zi.filename}")
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    f.seek(name_length + extra_length, os.SEEK_CUR)
+    return f.read(zi.compress_size)
 
 
-# ---- Functions to merge prepared data with template ----
+def write_compressed(zipf: zipfile.ZipFile, zi: zipfile.ZipInfo, data: bytes):
+    """Write a ZIP member from its compressed data, as read by read_compressed, without
+    decompressing and compressing it again. This is what ZipFile.mkdir does for a
+    directory, with the data written after the local file header.
+
+    Args:
+        zipf (zipfile.ZipFile): ZIP file opened for writing.
+        zi (zipfile.ZipInfo): The member, with the CRC and sizes of its data.
+        data (bytes): The compressed data of the member.
+
+    Returns:
+        None
+    """
+    zinfo = copy(zi)
+    # The sizes and CRC are in the local file header, not in a data descriptor
+    zinfo.flag_bits &= ~0x08
+    with zipf._lock:
+        if zipf._seekable:
+            zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        zipf._writecheck(zinfo)
+        zipf._didModify = True
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        zipf.fp.write(zinfo.FileHeader(False))
+        zipf.fp.write(data)
+        zipf.start_dir = zipf.fp.tell()
 
 
 def get_docx_mergefields(docx_fname: str):
@@ -48,6 +98,119 @@ def get_docx_mergefields(docx_fname: str):
         return tpl.get_merge_fields()
 
 
+class DocxTemplate:
+    """A DOCX template parsed once by MailMerge and merged into any number of documents.
+    MailMerge replaces the MergeFields of the template parts with placeholder elements and
+    keeps the formatting of each field. For each document, only the parts that contain
+    MergeFields, usually just word/document.xml, are copied, merged, serialized and
+    compressed. The other members of the package are copied as compressed in the
+    template, see read_compressed and write_compressed.
+
+    The placeholders are filled in the same order as MailMerge.merge and merge_rows, and
+    fields without data are emptied as by MailMerge.write, so the merged documents are the
+    same as those of MailMerge. MailMerge keeps state in the MergeField objects it shares
+    between merges, so merges are serialized by a lock and a template, such as the one
+    cached by get_docx_template, can be shared by threads.
+
+    Args:
+        docx_tpl (str): DOCX template file name.
+        row_anchor (str): MergeField in the table row repeated for each annexure row.
+            Defaults to "slno".
+    """
+
+    def __init__(self, docx_tpl: str, row_anchor: str = "slno"):
+        self.docx_tpl = docx_tpl
+        self.row_anchor = row_anchor
+        self.lock = threading.Lock()
+        with MailMerge(docx_tpl) as tpl:
+            self.merge_data = tpl.merge_data
+            self.parts = {
+                part_info["zi"].filename: part_info["part"].getroot()
+                for part_info in tpl.docx.get_parts()
+                if part_info["part"].find(".//MergeField") is not None
+            }
+            settings = tpl.docx.category_part_map.get("settings", [])
+            self.settings_fname = settings[0].filename if settings else ""
+            # Settings of documents without and with fields left unmerged, as fixed by
+            # MailMerge.write
+            self.settings = {}
+            update_fields = (
+                tpl.options.auto_update_fields_on_open == OptionAutoUpdateFields.AUTO
+                and self.merge_data.has_nested_fields
+            ) or tpl.options.auto_update_fields_on_open == OptionAutoUpdateFields.ALWAYS
+            for unmerged in (False, True) if settings else ():
+                root = deepcopy(tpl.get_settings().getroot())
+                mail_merge = root.find(f"{{{W_NS}}}mailMerge")
+                if not unmerged and mail_merge is not None:
+                    root.remove(mail_merge)
+                if update_fields:
+                    element = root.find(f"{{{W_NS}}}updateFields")
+                    if element is None:
+                        element = etree.SubElement(root, f"{{{W_NS}}}updateFields")
+                    element.set(f"{{{W_NS}}}val", "true")
+                self.settings[unmerged] = self.tostring(root)
+        with open(docx_tpl, "rb") as f:
+            self.members = [
+                (zi, None if zi.filename in self.parts else read_compressed(f, zi))
+                for zi in tpl.docx.zip.filelist
+            ]
+
+    @staticmethod
+    def tostring(root) -> bytes:
+        return etree.tostring(root, encoding="UTF-8", xml_declaration=True)
+
+    def merge(self, docx_output_fname: str, *rows: dict, table_rows=()):
+        """Merge data into a copy of the template and write it to a DOCX file.
+
+        Args:
+            docx_output_fname (str): Output DOCX file name.
+            *rows (dict): Dictionaries of field values, merged in order.
+            table_rows (list[dict]): Field values of each row of the table with the
+                row_anchor field. Defaults to ().
+
+        Returns:
+            None
+        """
+        parts = {fname: deepcopy(root) for fname, root in self.parts.items()}
+        with self.lock:
+            for root in parts.values():
+                for row in rows:
+                    self.merge_data.replace(root, row)
+                self.merge_data.replace_table_rows(root, self.row_anchor, table_rows)
+            unmerged = {
+                field.get("name")
+                for root in parts.values()
+                for field in root.iter("MergeField")
+            }
+            if unmerged:
+                for root in parts.values():
+                    self.merge_data.replace(root, {name: "" for name in unmerged})
+
+        with zipfile.ZipFile(docx_output_fname, "w", zipfile.ZIP_DEFLATED) as output:
+            for zi, data in self.members:
+                if zi.filename in parts:
+                    output.writestr(zi.filename, self.tostring(parts[zi.filename]))
+                elif zi.filename == self.settings_fname:
+                    output.writestr(zi.filename, self.settings[bool(unmerged)])
+                else:
+                    write_compressed(output, zi, data)
+
+
+@lru_cache(maxsize=8)
+def get_docx_template(docx_tpl: str, mtime: float) -> DocxTemplate:
+    """Get the parsed DOCX template, parsed again when the template file changes.
+
+    Args:
+        docx_tpl (str): DOCX template file name.
+        mtime (float): Modification time of the template file.
+
+    Returns:
+        DocxTemplate: The parsed template.
+    """
+    return DocxTemplate(docx_tpl)
+
+
+@traced("docx_mergefields")
 def docx_mergefields(
     docx_tpl: str,
     docx_output_fname: str,
@@ -55,7 +218,8 @@ def docx_mergefields(
     exhibitor_data,
     annexure,
 ):
-    """Merge fields in DOCX template and write to output file.
+    """Merge fields in DOCX template and write to output file. The template is parsed once
+    and reused for every document, see DocxTemplate.
 
     Args:
         docx_tpl (str): DOCX template file name.
@@ -67,11 +231,59 @@ def docx_mergefields(
     Returns:
         None
     """
-    tpl = MailMerge(docx_tpl)
-    tpl.merge(**distributor_data)
-    tpl.merge(**exhibitor_data)
-    tpl.merge_rows("slno", annexure)
-    tpl.write(docx_output_fname)
+    tpl = get_docx_template(abspath(docx_tpl), os.path.getmtime(docx_tpl))
+    tpl.merge(docx_output_fname, distributor_data, exhibitor_data, table_rows=annexure)
+
+
+def docx_mergefields_pdf(
+    docx_tpl: str,
+    soffice_path: str,
+    distributor_data,
+    exhibitor_data,
+    annexure,
+) -> bytes:
+    """Merge fields in DOCX template, convert to PDF and return the PDF as bytes. The DOCX
+    and PDF files are written only to a private temporary directory, and soffice uses a
+    user profile of its own in that directory so that concurrent calls do not contend for
+    the profile lock.
+
+    Args:
+        docx_tpl (str): DOCX template file name.
+        soffice_path (str): Path to the soffice executable.
+        distributor_data (dict): Distributor data dictionary.
+        exhibitor_data (dict): Exhibitor data dictionary.
+        annexure (str): Annexure string.
+
+    Returns:
+        bytes: The PDF.
+
+    Raises:
+        RuntimeError: If soffice fails or does not write the PDF file.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        docx_fname = join(tmp_dir, "agreement.docx")
+        docx_mergefields(
+            docx_tpl, docx_fname, distributor_data, exhibitor_data, annexure
+        )
+        cmd_list = [
+            soffice_path,
+            "--headless",
+            f"-env:UserInstallation={Path(tmp_dir, 'profile').as_uri()}",
+            "--convert-to",
+            "pdf:writer_pdf_Export",
+            "--outdir",
+            tmp_dir,
+            docx_fname,
+        ]
+        with tracer.span("soffice_docx2pdf"):
+            res = subprocess.run(cmd_list, capture_output=True)
+        pdf_fname = join(tmp_dir, "agreement.pdf")
+        if res.returncode != 0 or not isfile(pdf_fname):
+            raise RuntimeError(
+                f"soffice failed with code {res.returncode}: {res.stderr.decode(errors='replace').strip()}"
+            )
+        with open(pdf_fname, "rb") as f:
+            return f.read()
 
 
 def detect_soffice_path(suggested_path: str = ""):
@@ -155,6 +367,7 @@ def detect_soffice_path(suggested_path: str = ""):
     return soffice_path, cmd_list, shell
 
 
+@traced("soffice_docx2pdf")
 def soffice_docx2pdf(
     docx_fname: str, cmd_list: list[str], shell: bool, verbose: bool = False
 ):
@@ -164,6 +377,358 @@ def soffice_docx2pdf(
         con.log(f"Converted {docx_fname} to PDF successfully.")
 
 
+def soffice_docx2pdf_batch(
+    docx_fnames: list[str],
+    soffice_path: str,
+    outdir: str = ".",
+    chunk_size: int = 50,
+    jobs: int = 1,
+    callback=None,
+) -> list[str]:
+    """Convert many DOCX files to PDF with one soffice invocation per chunk of files. With
+    jobs > 1, several chunks are converted at once, each job using its own LibreOffice user
+    profile so that the instances do not contend for the profile lock.
+
+    Args:
+        docx_fnames (list[str]): DOCX file names.
+        soffice_path (str): Path to the soffice executable.
+        outdir (str): Directory to write the PDF files to. Defaults to ".".
+        chunk_size (int): Number of files per soffice invocation. Defaults to 50.
+        jobs (int): Number of soffice invocations to run at once. Defaults to 1.
+        callback (callable): Called with the list of DOCX file names of each chunk after
+            it is converted. Defaults to None.
+
+    Returns:
+        list[str]: PDF file names written to outdir.
+    """
+    chunks = [
+        docx_fnames[i : i + chunk_size] for i in range(0, len(docx_fnames), chunk_size)
+    ]
+
+    def run_job(job: int):
+        with tempfile.TemporaryDirectory(prefix="soffice_profile_") as profile_dir:
+            for chunk in chunks[job::jobs]:
+                cmd_list = [
+                    soffice_path,
+                    "--headless",
+                    f"-env:UserInstallation={Path(profile_dir).as_uri()}",
+                    "--convert-to",
+                    "pdf:writer_pdf_Export",
+                    "--outdir",
+                    outdir,
+                    *chunk,
+                ]
+                with tracer.span("soffice_docx2pdf"):
+                    res = subprocess.run(cmd_list, capture_output=True)
+                if res.returncode != 0:
+                    con.log(f"soffice failed with code {res.returncode} for {chunk}")
+                if callback:
+                    callback(chunk)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(run_job, range(min(jobs, len(chunks)))))
+    return [
+        join(outdir, f"{splitext(basename(docx_fname))[0]}.pdf")
+        for docx_fname in docx_fnames
+    ]
+
+
+# ---- Persistent LibreOffice conversion server ----
+
+
+def require_uno():
+    """Check that the LibreOffice Python-UNO bridge, needed by SofficeServer and
+    SofficePool, can be imported by this Python.
+
+    Returns:
+        None
+
+    Raises:
+        ImportError: If the Python-UNO bridge is not available.
+    """
+    try:
+        import uno  # noqa: F401
+    except ImportError:
+        raise ImportError(
+            "LibreOffice Python-UNO bridge not found. Run with LibreOffice's Python or a Python with python3-uno installed, or convert without --soffice-pool."
+        )
+
+
+class SofficeServer:
+    """A long-lived headless LibreOffice instance listening on a UNO socket. Documents are
+    loaded into the running instance and exported to PDF without starting a new soffice
+    process for each document. Requires the LibreOffice Python-UNO bridge (the ``uno``
+    module), which is bundled with LibreOffice's own Python or packaged separately as
+    ``python3-uno`` on GNU/Linux.
+
+    Args:
+        soffice_path (str): Path to the soffice executable.
+        port (int): TCP port on which the instance accepts UNO connections.
+        timeout (float): Seconds to wait for the instance to accept connections.
+            Defaults to 30.
+    """
+
+    def __init__(self, soffice_path: str, port: int, timeout: float = 30.0):
+        self.soffice_path = soffice_path
+        self.port = port
+        self.timeout = timeout
+        self.process = None
+        self.desktop = None
+        self.profile_dir = ""
+
+    def start(self):
+        """Start the soffice process with its own user profile and connect to it.
+
+        Returns:
+            None
+
+        Raises:
+            ImportError: If the Python-UNO bridge is not available.
+            TimeoutError: If the instance does not accept connections within the timeout.
+        """
+        require_uno()
+        self.profile_dir = tempfile.mkdtemp(prefix="soffice_profile_")
+        cmd_list = [
+            self.soffice_path,
+            "--headless",
+            "--invisible",
+            "--nologo",
+            "--norestore",
+            "--nodefault",
+            f"-env:UserInstallation={Path(self.profile_dir).as_uri()}",
+            f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+        ]
+        self.process = subprocess.Popen(
+            cmd_list, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self._connect()
+
+    def _connect(self):
+        import uno
+
+        local_ctx = uno.getComponentContext()
+        resolver = local_ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_ctx
+        )
+        url = f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+        t_stop = time.perf_counter() + self.timeout
+        while True:
+            try:
+                ctx = resolver.resolve(url)
+                break
+            except Exception:
+                if self.process.poll() is not None:
+                    raise RuntimeError(
+                        f"LibreOffice exited with code {self.process.returncode} during startup"
+                    )
+                if time.perf_counter() > t_stop:
+                    raise TimeoutError(
+                        f"LibreOffice did not accept connections on port {self.port}"
+                    )
+                time.sleep(0.25)
+        self.desktop = ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", ctx
+        )
+
+    def is_alive(self) -> bool:
+        """Health check: the process is running and responds to a UNO call.
+
+        Returns:
+            bool: True if the instance is usable, False otherwise.
+        """
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self.desktop.getComponents()
+            return True
+        except Exception:
+            return False
+
+    def stop(self):
+        """Terminate the soffice process and remove its user profile.
+
+        Returns:
+            None
+        """
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            self.desktop = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self.profile_dir:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = ""
+
+    def restart(self):
+        """Stop the instance, if running, and start a fresh one.
+
+        Returns:
+            None
+        """
+        self.stop()
+        self.start()
+
+    def convert(self, docx_fname: str, pdf_fname: str = "", retries: int = 1):
+        """Convert a DOCX file to PDF. The instance is restarted if it has crashed, and the
+        conversion is retried if the instance fails while converting.
+
+        Args:
+            docx_fname (str): DOCX file name.
+            pdf_fname (str): PDF file name. Defaults to the DOCX file name with .pdf suffix.
+            retries (int): Number of restarts and retries after a failure. Defaults to 1.
+
+        Returns:
+            None
+        """
+        import uno
+
+        if not pdf_fname:
+            pdf_fname = f"{splitext(docx_fname)[0]}.pdf"
+        if not self.is_alive():
+            self.restart()
+        try:
+            doc = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(abspath(docx_fname)),
+                "_blank",
+                0,
+                (uno_property("Hidden", True),),
+            )
+            try:
+                doc.storeToURL(
+                    uno.systemPathToFileUrl(abspath(pdf_fname)),
+                    (uno_property("FilterName", "writer_pdf_Export"),),
+                )
+            finally:
+                doc.close(True)
+        except Exception:
+            if retries <= 0:
+                raise
+            self.restart()
+            self.convert(docx_fname, pdf_fname, retries - 1)
+
+
+def uno_property(name: str, value):
+    """Create a UNO PropertyValue.
+
+    Args:
+        name (str): Property name.
+        value: Property value.
+
+    Returns:
+        com.sun.star.beans.PropertyValue: The property.
+    """
+    from com.sun.star.beans import PropertyValue
+
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+def free_port() -> int:
+    """Find a free TCP port on the loopback interface.
+
+    Returns:
+        int: Port number.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class SofficePool:
+    """A pool of persistent LibreOffice instances found with detect_soffice_path. Each instance
+    converts one document at a time; conversions are distributed over idle instances.
+
+    Args:
+        size (int): Number of LibreOffice instances. Defaults to 1.
+        suggested_path (str): Suggested path to LibreOffice. Defaults to "".
+    """
+
+    def __init__(self, size: int = 1, suggested_path: str = ""):
+        require_uno()
+        self.soffice_path, _, _ = detect_soffice_path(suggested_path)
+        self.size = size
+        self.servers = [
+            SofficeServer(self.soffice_path, free_port()) for _ in range(size)
+        ]
+        self.idle = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=size)
+
+    def start(self):
+        """Start all the LibreOffice instances of the pool. If an instance fails to start,
+        the instances already started are stopped before the error is raised.
+
+        Returns:
+            None
+        """
+        try:
+            for server in self.servers:
+                server.start()
+                self.idle.put(server)
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        """Wait for pending conversions and stop all the LibreOffice instances of the pool.
+        Stopping a stopped pool does nothing.
+
+        Returns:
+            None
+        """
+        self.executor.shutdown(wait=True)
+        for server in self.servers:
+            server.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def convert(self, docx_fname: str, pdf_fname: str = ""):
+        """Convert a DOCX file to PDF on the next idle instance, blocking until done.
+
+        Args:
+            docx_fname (str): DOCX file name.
+            pdf_fname (str): PDF file name. Defaults to the DOCX file name with .pdf suffix.
+
+        Returns:
+            None
+        """
+        server = self.idle.get()
+        try:
+            with tracer.span("soffice_docx2pdf"):
+                server.convert(docx_fname, pdf_fname)
+        finally:
+            self.idle.put(server)
+
+    def submit(self, docx_fname: str, pdf_fname: str = "") -> Future:
+        """Schedule conversion of a DOCX file to PDF on the pool.
+
+        Args:
+            docx_fname (str): DOCX file name.
+            pdf_fname (str): PDF file name. Defaults to the DOCX file name with .pdf suffix.
+
+        Returns:
+            Future: Future that completes when the PDF file has been written.
+        """
+        # The conversion runs in the context of the caller, so that its span is attributed
+        # to the document being generated
+        context = contextvars.copy_context()
+        return self.executor.submit(context.run, self.convert, docx_fname, pdf_fname)
+
+
 if __name__ == "__main__":
     soffice_path, cmd_list, shell = detect_soffice_path()
     docx_fname = "test.docx"
@@ -0,0 +1,150 @@
+import os
+import hashlib
+from os.path import isdir, isfile, join
+
+
+import polars as pl
+
+
+CACHE_DIR = os.environ.get("AGREEMENT_CACHE_DIR", ".agreement_cache")
+CACHE_MAX_BYTES = int(
+    os.environ.get("AGREEMENT_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+)
+
+
+def file_hash(fname: str) -> str:
+    """Compute the SHA-256 hash of the contents of a file.
+
+    Args:
+        fname (str): File name.
+
+    Returns:
+        str: Hexadecimal digest of the file contents.
+    """
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_fname(digest: str, sheet_name: str | None, cache_dir: str = CACHE_DIR) -> str:
+    """Name of the cache file of a sheet of a workbook.
+
+    Args:
+        digest (str): Hash of the workbook contents.
+        sheet_name (str | None): Sheet name, None for the first sheet.
+        cache_dir (str): Cache directory. Defaults to CACHE_DIR.
+
+    Returns:
+        str: Path of the Arrow IPC cache file.
+    """
+    sheet = hashlib.sha256(str(sheet_name).encode("utf-8")).hexdigest()[:16]
+    return join(cache_dir, f"{digest}_{sheet}.arrow")
+
+
+def evict(cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES) -> int:
+    """Remove the least recently used cache files until the cache is within its size limit.
+    Cache hits update the modification time of a file, so the oldest files are the least
+    recently used.
+
+    Args:
+        cache_dir (str): Cache directory. Defaults to CACHE_DIR.
+        max_bytes (int): Maximum total size of the cache files. Defaults to CACHE_MAX_BYTES.
+
+    Returns:
+        int: Number of files removed.
+    """
+    if not isdir(cache_dir):
+        return 0
+    entries = [e for e in os.scandir(cache_dir) if e.name.endswith(".arrow")]
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    total = sum(e.stat().st_size for e in entries)
+    removed = 0
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        size = entry.stat().st_size
+        try:
+            os.remove(entry.path)
+        except OSError:
+            # Memory-mapped files cannot be removed on Windows while in use
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear_cache(cache_dir: str = CACHE_DIR) -> int:
+    """Remove all the cache files.
+
+    Args:
+        cache_dir (str): Cache directory. Defaults to CACHE_DIR.
+
+    Returns:
+        int: Number of files removed.
+    """
+    return evict(cache_dir, max_bytes=-1)
+
+
+def cached_scan_excel(
+    fname: str,
+    sheet_name: str | None = None,
+    cache_dir: str = CACHE_DIR,
+    max_bytes: int = CACHE_MAX_BYTES,
+) -> pl.LazyFrame:
+    """Scan a sheet of an Excel file through the cache. The sheet is parsed into the cache
+    by cached_read_excel if it is not there yet, and the cache file is then scanned, so
+    that a query reads only the columns and rows it needs.
+
+    Args:
+        fname (str): The path to the Excel file.
+        sheet_name (str | None): Sheet name, None for the first sheet. Defaults to None.
+        cache_dir (str): Cache directory. Defaults to CACHE_DIR.
+        max_bytes (int): Maximum total size of the cache files. Defaults to CACHE_MAX_BYTES.
+
+    Returns:
+        pl.LazyFrame: A LazyFrame of the data of the sheet.
+    """
+    path = cache_fname(file_hash(fname), sheet_name, cache_dir)
+    if isfile(path):
+        os.utime(path)
+    else:
+        cached_read_excel(fname, sheet_name, cache_dir, max_bytes)
+    return pl.scan_ipc(path, memory_map=True)
+
+
+def cached_read_excel(
+    fname: str,
+    sheet_name: str | None = None,
+    cache_dir: str = CACHE_DIR,
+    max_bytes: int = CACHE_MAX_BYTES,
+) -> pl.DataFrame:
+    """Read a sheet of an Excel file through the cache. The parsed sheet is stored in Arrow
+    IPC format, keyed by the hash of the workbook contents and the sheet name, and later
+    reads of an unchanged workbook are memory-mapped from the cache file.
+
+    Args:
+        fname (str): The path to the Excel file.
+        sheet_name (str | None): Sheet name, None for the first sheet. Defaults to None.
+        cache_dir (str): Cache directory. Defaults to CACHE_DIR.
+        max_bytes (int): Maximum total size of the cache files. Defaults to CACHE_MAX_BYTES.
+
+    Returns:
+        pl.DataFrame: A DataFrame containing the data from the sheet.
+    """
+    path = cache_fname(file_hash(fname), sheet_name, cache_dir)
+    try:
+        df = pl.read_ipc(path, memory_map=True)
+        os.utime(path)
+        return df
+    except (OSError, pl.exceptions.ComputeError):
+        pass
+
+    df = pl.read_excel(fname, sheet_name=sheet_name)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    df.write_ipc(tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+    evict(cache_dir, max_bytes)
+    return df
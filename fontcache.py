@@ -0,0 +1,263 @@
+import os
+import re
+import json
+import hashlib
+from html import unescape
+from os.path import abspath, basename, dirname, isdir, isfile, join, splitext
+from pathlib import Path
+from urllib.parse import urljoin
+
+
+from excelcache import file_hash
+
+
+FONT_CACHE_DIR = os.environ.get("AGREEMENT_FONT_CACHE_DIR", ".font_cache")
+
+re_font_face = re.compile(r"@font-face\s*{[^}]*}", re.I)
+re_css_url = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+re_html_tag = re.compile(r"<[^>]*>")
+re_url_scheme = re.compile(r"[a-z][a-z0-9+.-]*:", re.I)
+
+# Characters always kept in font subsets: printable ASCII and Latin-1, general punctuation
+# and the rupee sign
+BASE_CHARSET = "".join(
+    [chr(c) for c in range(0x20, 0x7F)]
+    + [chr(c) for c in range(0xA0, 0x100)]
+    + [chr(c) for c in range(0x2010, 0x2028)]
+    + ["₹"]
+)
+
+
+def text_chars(html: str) -> set[str]:
+    """Characters in the text of an HTML document or template, with tags removed and
+    character references resolved.
+
+    Args:
+        html (str): HTML or template source.
+
+    Returns:
+        set[str]: Characters in the text, other than whitespace.
+    """
+    return {c for c in unescape(re_html_tag.sub(" ", html)) if not c.isspace()}
+
+
+def data_chars(*data) -> set[str]:
+    """Characters in the string values of dictionaries and lists of dictionaries.
+
+    Args:
+        *data: Dictionaries, such as the distributor data, or lists of dictionaries, such as
+            annexure data.
+
+    Returns:
+        set[str]: Characters in the values.
+    """
+    chars = set()
+    for item in data:
+        rows = item if isinstance(item, list) else [item]
+        for row in rows:
+            for value in row.values():
+                chars.update(str(value))
+    return chars
+
+
+def subset_font(font_fname: str, charset: str, cache_dir: str = FONT_CACHE_DIR) -> str:
+    """Subset a font to the glyphs of a set of characters, keeping the OpenType layout
+    features needed to shape them. The subset is written to the cache directory once, keyed
+    by the hashes of the font file and the character set. Requires fontTools, which is
+    installed with WeasyPrint.
+
+    Args:
+        font_fname (str): Font file name.
+        charset (str): Characters to keep, in any order.
+        cache_dir (str): Cache directory. Defaults to FONT_CACHE_DIR.
+
+    Returns:
+        str: Absolute path of the subset font file.
+    """
+    digest = hashlib.sha256(
+        (file_hash(font_fname) + "".join(sorted(set(charset)))).encode("utf-8")
+    ).hexdigest()
+    stem, ext = splitext(basename(font_fname))
+    path = abspath(join(cache_dir, f"{stem}-{digest[:16]}{ext}"))
+    if isfile(path):
+        return path
+
+    from fontTools import subset
+
+    options = subset.Options()
+    options.layout_features = ["*"]
+    options.name_IDs = ["*"]
+    options.name_languages = ["*"]
+    options.notdef_outline = True
+    options.hinting = False
+    font = subset.load_font(font_fname, options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=[ord(c) for c in set(charset)])
+    subsetter.subset(font)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    subset.save_font(font, tmp_path, options)
+    font.close()
+    os.replace(tmp_path, path)
+    return path
+
+
+def subset_stylesheet(
+    css_fname: str, charset: str, cache_dir: str = FONT_CACHE_DIR
+) -> str:
+    """Write a copy of a stylesheet whose @font-face rules refer to subsets of their fonts.
+    Worker processes given the copy load only the subsets. Other relative URLs, such as
+    those of images, are made absolute, since the copy is not in the directory of the
+    stylesheet.
+
+    Args:
+        css_fname (str): CSS file name.
+        charset (str): Characters to keep in the font subsets.
+        cache_dir (str): Cache directory. Defaults to FONT_CACHE_DIR.
+
+    Returns:
+        str: Absolute path of the copy of the stylesheet.
+    """
+    with open(css_fname, encoding="utf-8") as f:
+        css = f.read()
+    css_dir = dirname(abspath(css_fname))
+
+    def replace_url(m: re.Match) -> str:
+        font_fname = join(css_dir, m.group(2))
+        if not isfile(font_fname):
+            return m.group(0)
+        return f'url("{Path(subset_font(font_fname, charset, cache_dir)).as_uri()}")'
+
+    def absolute_url(m: re.Match) -> str:
+        url = m.group(2)
+        if re_url_scheme.match(url) or url.startswith(("/", "#")):
+            return m.group(0)
+        return f'url("{urljoin(Path(css_dir).as_uri() + "/", url)}")'
+
+    subset_css = re_font_face.sub(
+        lambda rule: re_css_url.sub(replace_url, rule.group(0)), css
+    )
+    subset_css = re_css_url.sub(absolute_url, subset_css)
+    digest = hashlib.sha256(subset_css.encode("utf-8")).hexdigest()
+    stem, _ = splitext(basename(css_fname))
+    path = abspath(join(cache_dir, f"{stem}-{digest[:16]}.css"))
+    if not isfile(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(subset_css)
+        os.replace(tmp_path, path)
+    return path
+
+
+def clear_font_cache(cache_dir: str = FONT_CACHE_DIR) -> int:
+    """Remove all the font subsets and stylesheet copies.
+
+    Args:
+        cache_dir (str): Cache directory. Defaults to FONT_CACHE_DIR.
+
+    Returns:
+        int: Number of files removed.
+    """
+    if not isdir(cache_dir):
+        return 0
+    removed = 0
+    for entry in os.scandir(cache_dir):
+        if entry.is_file():
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+
+def agreement_charset(
+    tpl_fname: str, css_fname: str, distributor_data, payloads: list[tuple]
+) -> str:
+    """Characters that can appear in any of the agreement documents: those of the template
+    text, the stylesheet, the distributor data and the exhibitor and annexure data of every
+    document, and BASE_CHARSET.
+
+    Args:
+        tpl_fname (str): Template file name.
+        css_fname (str): CSS file name.
+        distributor_data (dict): Distributor data dictionary.
+        payloads (list[tuple]): Exhibitor data and annexure data of each document.
+
+    Returns:
+        str: The characters, sorted.
+    """
+    chars = set(BASE_CHARSET)
+    for fname in (tpl_fname, css_fname):
+        with open(fname, encoding="utf-8") as f:
+            chars |= text_chars(f.read())
+    chars |= data_chars(distributor_data)
+    for exhibitor_data, annexure in payloads:
+        chars |= data_chars(exhibitor_data, annexure)
+    return "".join(sorted(chars))
+
+
+class GlyphReport:
+    """Record of the characters used by each agreement document, and of those missing from
+    the font subsets.
+
+    Args:
+        charset (str): Characters in the font subsets, empty if fonts are not subset.
+    """
+
+    def __init__(self, charset: str = ""):
+        self.charset = set(charset)
+        self.docs = {}
+
+    def record(self, doc: str, html: str):
+        """Record the characters used in the HTML of a document.
+
+        Args:
+            doc (str): Document name, usually the output file name.
+            html (str): HTML content of the document.
+
+        Returns:
+            None
+        """
+        self.docs[doc] = "".join(sorted(text_chars(html)))
+
+    def drain(self) -> dict[str, str]:
+        """Remove and return the recorded characters, to be sent from a worker process to
+        the parent process.
+
+        Returns:
+            dict[str, str]: Characters used by each document.
+        """
+        docs, self.docs = self.docs, {}
+        return docs
+
+    def extend(self, docs: dict[str, str]):
+        """Add the characters recorded by a worker process.
+
+        Args:
+            docs (dict[str, str]): Characters returned by drain in the worker.
+
+        Returns:
+            None
+        """
+        self.docs.update(docs)
+
+    def write(self, fname: str) -> int:
+        """Write the number of characters used by each document, the characters, and the
+        characters missing from the font subsets, as JSON.
+
+        Args:
+            fname (str): Report file name.
+
+        Returns:
+            int: Number of documents that use characters missing from the font subsets.
+        """
+        report = {}
+        for doc, chars in sorted(self.docs.items()):
+            missing = [c for c in chars if self.charset and c not in self.charset]
+            report[doc] = {
+                "count": len(chars),
+                "chars": chars,
+                "missing": "".join(missing),
+            }
+        with open(fname, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        return sum(1 for entry in report.values() if entry["missing"])
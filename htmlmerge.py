@@ -1,5 +1,7 @@
+import os
 import re
 import time
+from functools import lru_cache
 from os.path import abspath, splitext
 
 
@@ -7,17 +9,47 @@ from rich.console import Console
 
 
 import pendulum
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 import mistune
-from weasyprint import HTML, __version__ as wezp_ver
+from weasyprint import CSS, HTML, __version__ as wezp_ver
 from weasyprint.text.fonts import FontConfiguration
 
 
+from fontcache import GlyphReport
+from mdcompile import MarkdownTemplate
+from tracing import current_document, tracer
+
+
 re_html_fname = re.compile(r".*[.]html$", re.I)
+re_html_head = re.compile(r"<head[^>]*>(.*?)</head>", re.I | re.S)
+re_html_body = re.compile(r"<body[^>]*>(.*)</body>", re.I | re.S)
+JINJA_CACHE_DIR = os.environ.get("AGREEMENT_JINJA_CACHE_DIR", ".jinja_cache")
 
-font_config = FontConfiguration()
 con = Console()
 
+# Per-process renderer of render workers, set up once by init_render_worker
+_worker_renderer = None
+
+# Each agreement of a batch starts on a new page
+BATCH_CSS = """
+section.agreement-batch { page: agreement; }
+section.agreement-batch + section.agreement-batch { break-before: page; }
+"""
+# Page numbers of each agreement start from 1 when a batch is split into agreements
+BATCH_SPLIT_CSS = "@page :nth(1 of agreement) { counter-reset: page 1; }"
+
+
+@lru_cache(maxsize=None)
+def get_font_config() -> FontConfiguration:
+    """FontConfiguration shared by every document rendered in the process. It is created
+    when the first stylesheet or document needs it rather than when this module is
+    imported, since it initialises Fontconfig and Pango.
+
+    Returns:
+        FontConfiguration: The font configuration.
+    """
+    return FontConfiguration()
+
 
 def is_html_fname(s: str) -> bool:
     """Check if the file name ends in  .html, case insensitive.
@@ -34,6 +66,26 @@ def is_html_fname(s: str) -> bool:
         return False
 
 
+@lru_cache
+def get_jinja2_env(tpl_dir: str, cache_dir: str = JINJA_CACHE_DIR) -> Environment:
+    """Get the Jinja2 environment of a template directory. The environment is created once
+    per directory and compiles templates through a filesystem bytecode cache, so that
+    compiled templates are reused within a run and across runs.
+
+    Args:
+        tpl_dir (str): Absolute path of the template directory.
+        cache_dir (str): Bytecode cache directory. Defaults to JINJA_CACHE_DIR.
+
+    Returns:
+        jinja2.Environment: Jinja2 environment.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    return Environment(
+        loader=FileSystemLoader(tpl_dir),
+        bytecode_cache=FileSystemBytecodeCache(cache_dir),
+    )
+
+
 def get_jinja2_template(tpl_fname: str, tpl_dir: str):
     """Get Jinja2 template.
 
@@ -45,7 +97,7 @@ def get_jinja2_template(tpl_fname: str, tpl_dir: str):
         jinja2.Template: Jinja2 template object.
     """
     tpl_dir = abspath(tpl_dir)
-    env = Environment(loader=FileSystemLoader(tpl_dir))
+    env = get_jinja2_env(tpl_dir)
     tpl = env.get_template(tpl_fname)
     return tpl
 
@@ -69,52 +121,336 @@ def md2html(md_fname: str) -> str:
         return ""
 
 
+def render_html(
+    jinja_tpl, tpl_type: str, distributor_data, exhibitor_data, annexure
+) -> str:
+    """Merge fields in Markdown or HTML template and return the HTML. A Markdown template
+    compiled to HTML by MarkdownTemplate is not converted from Markdown again.
+
+    Args:
+        jinja_tpl (jinja2.Template | MarkdownTemplate): Jinja2 template object.
+        tpl_type (str): Template type, either "md" or "html".
+        distributor_data (dict): Distributor data dictionary.
+        exhibitor_data (dict): Exhibitor data dictionary.
+        annexure (list): Annexure data.
+
+    Returns:
+        str: HTML content of the document.
+    """
+    time_now = pendulum.now().format("YYYY-MM-DDTHH:MM:SSZ")
+    with tracer.span("jinja render"):
+        content = jinja_tpl.render(
+            **distributor_data,
+            **exhibitor_data,
+            annexure=annexure,
+            time_now=time_now,
+            weasyprint_ver=wezp_ver,
+        )
+    if tpl_type == "md" and not isinstance(jinja_tpl, MarkdownTemplate):
+        with tracer.span("mistune.html"):
+            content = mistune.html(content)
+    return content
+
+
+def batch_html(contents: list[str]) -> str:
+    """Combine the HTML of several agreement documents into one HTML document. The body of
+    each document is wrapped in a section with the id agreement-batch-<index>, and the head
+    of the first document is used for the combined document.
+
+    Args:
+        contents (list[str]): HTML of each document, either complete documents or
+            fragments, as produced by mistune.
+
+    Returns:
+        str: HTML of the combined document.
+    """
+    head = re_html_head.search(contents[0]) if contents else None
+    sections = []
+    for i, content in enumerate(contents):
+        body = re_html_body.search(content)
+        sections.append(
+            f'<section class="agreement-batch" id="agreement-batch-{i}">'
+            f"{body.group(1) if body else content}</section>"
+        )
+    return (
+        f"<!DOCTYPE html><html><head>{head.group(1) if head else ''}</head>"
+        f"<body>{''.join(sections)}</body></html>"
+    )
+
+
 def md_html_mergefields(
     jinja_tpl,
     tpl_type: str,
-    css_fname: str,
-    pdf_fname: str,
+    css_fname: str | CSS,
+    pdf_fname: str | None,
     distributor_data,
     exhibitor_data,
     annexure,
-):
-    """Merge fields in Markdown or HTML template and write to PDF.
+) -> bytes | None:
+    """Merge fields in Markdown or HTML template and write to PDF. If pdf_fname is None,
+    the PDF is returned as bytes instead of being written to a file.
 
     Args:
-        jinja_tpl (jinja2.Template): Jinja2 template object.
+        jinja_tpl (jinja2.Template | MarkdownTemplate): Jinja2 template object.
         tpl_type (str): Template type, either "md" or "html".
-        css_fname (str): CSS file name.
-        pdf_fname (str): PDF file name.
+        css_fname (str | CSS): CSS file name or parsed stylesheet.
+        pdf_fname (str | None): PDF file name, None to return the PDF as bytes.
         distributor_data (dict): Distributor data dictionary.
         exhibitor_data (dict): Exhibitor data dictionary.
         annexure (str): Annexure string.
 
     Returns:
-        None
+        bytes | None: The PDF if pdf_fname is None, None otherwise.
     """
-    time_now = pendulum.now().format("YYYY-MM-DDTHH:MM:SSZ")
-    if tpl_type == "md":
-        md_content = jinja_tpl.render(
-            **distributor_data,
-            **exhibitor_data,
-            annexure=annexure,
-            time_now=time_now,
-            weasyprint_ver=wezp_ver,
+    html_content = render_html(
+        jinja_tpl, tpl_type, distributor_data, exhibitor_data, annexure
+    )
+    with tracer.span("write_pdf"):
+        return HTML(string=html_content).write_pdf(
+            pdf_fname, stylesheets=[css_fname], font_config=get_font_config()
         )
-        html_content = mistune.html(md_content)
-    elif tpl_type == "html":
-        html_content = jinja_tpl.render(
-            **distributor_data,
-            **exhibitor_data,
-            annexure=annexure,
-            time_now=time_now,
-            weasyprint_ver=wezp_ver,
+
+
+class PdfRenderer:
+    """Renderer of agreement documents that keeps the compiled Jinja2 template and the parsed
+    CSS stylesheet, with its @font-face rules, for reuse across all the documents rendered.
+    The template is recompiled only when its file changes. A Markdown template is compiled
+    to an HTML template by MarkdownTemplate, so that documents are not converted from
+    Markdown one by one.
+
+    Args:
+        tpl_fname (str): Template file name.
+        tpl_type (str): Template type, either "md" or "html".
+        css_fname (str): CSS file name.
+        tpl_dir (str): Template directory. Defaults to "".
+        glyph_report (GlyphReport | None): If given, the characters used by each document
+            are recorded in it. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        tpl_fname: str,
+        tpl_type: str,
+        css_fname: str,
+        tpl_dir: str = "",
+        glyph_report: GlyphReport | None = None,
+    ):
+        self.tpl_fname = tpl_fname
+        self.glyph_report = glyph_report
+        self.tpl_type = tpl_type
+        self.css_fname = css_fname
+        self.env = get_jinja2_env(abspath(tpl_dir))
+        self.md_template = None
+        self.stylesheet = CSS(filename=css_fname, font_config=get_font_config())
+        self.batch_stylesheets = [
+            CSS(string=BATCH_CSS, font_config=get_font_config()),
+            CSS(string=BATCH_SPLIT_CSS, font_config=get_font_config()),
+        ]
+        with open(css_fname, encoding="utf-8") as f:
+            # The total number of pages of a batch is not that of each of its documents
+            self.counts_pages = "counter(pages)" in f.read()
+
+    @property
+    def template(self):
+        """The compiled Jinja2 template, or MarkdownTemplate of a Markdown template,
+        reloaded if the template file has changed."""
+        template = self.env.get_template(self.tpl_fname)
+        if self.tpl_type != "md":
+            return template
+        if self.md_template is None or self.md_template.template is not template:
+            self.md_template = MarkdownTemplate(template)
+        return self.md_template
+
+    def render_html(self, distributor_data, exhibitor_data, annexure) -> str:
+        """Merge fields in the template and return the HTML.
+
+        Args:
+            distributor_data (dict): Distributor data dictionary.
+            exhibitor_data (dict): Exhibitor data dictionary.
+            annexure (list): Annexure data.
+
+        Returns:
+            str: HTML content of the document.
+        """
+        content = render_html(
+            self.template, self.tpl_type, distributor_data, exhibitor_data, annexure
         )
-    HTML(string=html_content).write_pdf(
-        pdf_fname, stylesheets=[css_fname], font_config=font_config
+        if self.glyph_report is not None:
+            self.glyph_report.record(current_document.get(), content)
+        return content
+
+    def write_pdf(
+        self, pdf_fname: str | None, distributor_data, exhibitor_data, annexure
+    ) -> bytes | None:
+        """Merge fields in the template and write to PDF, or return the PDF as bytes if
+        pdf_fname is None.
+
+        Args:
+            pdf_fname (str | None): PDF file name, None to return the PDF as bytes.
+            distributor_data (dict): Distributor data dictionary.
+            exhibitor_data (dict): Exhibitor data dictionary.
+            annexure (list): Annexure data.
+
+        Returns:
+            bytes | None: The PDF if pdf_fname is None, None otherwise.
+        """
+        content = self.render_html(distributor_data, exhibitor_data, annexure)
+        with tracer.span("write_pdf"):
+            return HTML(string=content).write_pdf(
+                pdf_fname, stylesheets=[self.stylesheet], font_config=get_font_config()
+            )
+
+    def render_preview(
+        self, distributor_data, exhibitor_data, annexure, pages: int = 1
+    ) -> tuple[str, bytes]:
+        """Merge fields in the template and return the HTML and a PDF of the first pages,
+        to check a change of the template or stylesheet on one document. WeasyPrint lays
+        out the whole document, but only the first pages are written.
+
+        Args:
+            distributor_data (dict): Distributor data dictionary.
+            exhibitor_data (dict): Exhibitor data dictionary.
+            annexure (list): Annexure data.
+            pages (int): Number of pages to write. Defaults to 1.
+
+        Returns:
+            tuple[str, bytes]: HTML content of the document and the PDF of its first pages.
+        """
+        content = self.render_html(distributor_data, exhibitor_data, annexure)
+        with tracer.span("layout_preview"):
+            document = HTML(string=content).render(
+                stylesheets=[self.stylesheet], font_config=get_font_config()
+            )
+        with tracer.span("write_pdf"):
+            pdf = document.copy(document.pages[:pages]).write_pdf()
+        return content, pdf
+
+    def write_pdf_batch(
+        self,
+        distributor_data,
+        payloads: list[tuple],
+        combined: bool = False,
+        doc_names: list[str] | None = None,
+    ) -> list[bytes]:
+        """Merge fields in the template for several documents and lay them out in one
+        WeasyPrint layout pass, saving the per-document cost of font matching, stylesheet
+        cascade and page setup. The laid out pages are split at the start of each document.
+
+        Page numbers restart from 1 in each document when the batch is split. Documents are
+        rendered one at a time if the stylesheet uses counter(pages), which would count the
+        pages of the whole batch. In the combined PDF pages are numbered continuously.
+
+        Args:
+            distributor_data (dict): Distributor data dictionary.
+            payloads (list[tuple]): Exhibitor data and annexure data of each document.
+            combined (bool): If True, return one PDF of all the documents instead of one
+                PDF per document. Defaults to False.
+            doc_names (list[str] | None): Names of the documents, to which the spans and
+                glyphs recorded while rendering them are attributed. Defaults to None.
+
+        Returns:
+            list[bytes]: PDF of each document, or a list with the one combined PDF.
+        """
+        doc_names = doc_names or [current_document.get()] * len(payloads)
+        if self.counts_pages and not combined:
+            pdfs = []
+            for doc, (exhibitor_data, annexure) in zip(doc_names, payloads):
+                with tracer.document(doc):
+                    pdfs.append(
+                        self.write_pdf(None, distributor_data, exhibitor_data, annexure)
+                    )
+            return pdfs
+        contents = []
+        for doc, (exhibitor_data, annexure) in zip(doc_names, payloads):
+            with tracer.document(doc):
+                contents.append(
+                    self.render_html(distributor_data, exhibitor_data, annexure)
+                )
+        with tracer.span("layout_batch"):
+            stylesheets = (
+                self.batch_stylesheets[:1] if combined else self.batch_stylesheets
+            )
+            document = HTML(string=batch_html(contents)).render(
+                stylesheets=[self.stylesheet, *stylesheets],
+                font_config=get_font_config(),
+            )
+        with tracer.span("write_pdf"):
+            if combined:
+                return [document.write_pdf()]
+            # A document starts on the first page with its anchor; the anchor is repeated
+            # on the following pages when its section is split across them
+            starts = []
+            seen = set()
+            for i, page in enumerate(document.pages):
+                anchors = {
+                    a for a in page.anchors if a.startswith("agreement-batch-")
+                } - seen
+                if anchors:
+                    starts.append(i)
+                    seen |= anchors
+            if len(starts) != len(payloads):
+                raise ValueError(
+                    f"Found {len(starts)} of {len(payloads)} documents in the batch layout"
+                )
+            ends = starts[1:] + [len(document.pages)]
+            return [
+                document.copy(document.pages[start:end]).write_pdf()
+                for start, end in zip(starts, ends)
+            ]
+
+
+def init_render_worker(
+    tpl_fname: str,
+    tpl_type: str,
+    css_fname: str,
+    trace: bool = False,
+    glyph_report: bool = False,
+):
+    """Initialise a process pool worker with a PdfRenderer, so that the Jinja2 template and
+    the stylesheet are loaded once per worker. The FontConfiguration of get_font_config is
+    created by the renderer and is reused for every document rendered by the worker.
+
+    Args:
+        tpl_fname (str): Template file name.
+        tpl_type (str): Template type, either "md" or "html".
+        css_fname (str): CSS file name.
+        trace (bool): If True, record spans in the worker. Defaults to False.
+        glyph_report (bool): If True, record the characters used by each document.
+            Defaults to False.
+
+    Returns:
+        None
+    """
+    global _worker_renderer
+    tracer.enabled = trace
+    _worker_renderer = PdfRenderer(
+        tpl_fname,
+        tpl_type,
+        css_fname,
+        glyph_report=GlyphReport() if glyph_report else None,
     )
 
 
+def render_worker(job: tuple) -> tuple[str, list[dict], dict[str, str]]:
+    """Render one agreement document in a process pool worker initialised with
+    init_render_worker.
+
+    Args:
+        job (tuple): Tuple of PDF file name, distributor data, exhibitor data and annexure.
+
+    Returns:
+        tuple[str, list[dict], dict[str, str]]: PDF file name that was written, the spans
+            recorded while rendering it and the characters it uses, if recorded.
+    """
+    pdf_fname, distributor_data, exhibitor_data, annexure = job
+    with tracer.document(pdf_fname):
+        _worker_renderer.write_pdf(
+            pdf_fname, distributor_data, exhibitor_data, annexure
+        )
+    glyph_report = _worker_renderer.glyph_report
+    return pdf_fname, tracer.drain(), glyph_report.drain() if glyph_report else {}
+
+
 if __name__ == "__main__":
     t1 = time.perf_counter()
     title = "Generating Agreement Documents"
@@ -138,7 +474,7 @@ if __name__ == "__main__":
     if html_content:
         print(f"Writing: {pdf_fname}")
         HTML(string=html_content).write_pdf(
-            pdf_fname, stylesheets=["agreement.css"], font_config=font_config
+            pdf_fname, stylesheets=["agreement.css"], font_config=get_font_config()
         )
     t2 = time.perf_counter()
     print(f"Total time: {t2 - t1:.4f}s")
@@ -0,0 +1,554 @@
+import os
+import time
+import uuid
+import shutil
+import sqlite3
+import asyncio
+import zipfile
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from os.path import abspath, isfile, join
+from typing import TYPE_CHECKING
+
+
+from rich.console import Console
+
+
+# The data preparation and template backends are imported when a job runs, so that
+# submitting and listing jobs does not load Polars, WeasyPrint or MailMerge
+from utils import tpl_suffix, get_fname
+
+if TYPE_CHECKING:
+    from htmlmerge import PdfRenderer
+
+
+JOBS_DIR = os.environ.get("AGREEMENT_JOBS_DIR", ".agreement_jobs")
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+FNAME_TPL = "{count:02}_{movie}_{exhibitor}_{release_date}"
+# Job states, in order
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+con = Console()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    template TEXT NOT NULL,
+    css TEXT NOT NULL,
+    workdir TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    artifact TEXT NOT NULL DEFAULT '',
+    error TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    time REAL NOT NULL,
+    done INTEGER NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_job ON events (job_id, seq);
+"""
+
+
+class JobStore:
+    """SQLite-backed queue of agreement generation jobs and their progress events. The CLI,
+    the Streamlit app and the job service each open the same database, so any of them can
+    enqueue jobs and follow their progress.
+
+    Args:
+        jobs_dir (str): Directory of the database and of the input and output files of each
+            job. Defaults to JOBS_DIR.
+    """
+
+    def __init__(self, jobs_dir: str = JOBS_DIR):
+        self.jobs_dir = abspath(jobs_dir)
+        self.db_fname = join(self.jobs_dir, "jobs.sqlite3")
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        with closing(self.connect()) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a connection to the database in autocommit mode.
+
+        Returns:
+            sqlite3.Connection: Database connection.
+        """
+        db = sqlite3.connect(self.db_fname, timeout=30.0, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def submit(
+        self,
+        distributors: str | bytes,
+        exhibitors: str | bytes,
+        theatres: str | bytes,
+        template: str,
+        css: str = "",
+    ) -> str:
+        """Enqueue a job. The workbooks are copied into the job directory, so that later
+        changes to them, or the end of an upload session, do not affect the job.
+
+        Args:
+            distributors (str | bytes): Distributor workbook, its file name or contents.
+            exhibitors (str | bytes): Exhibitor workbook, its file name or contents.
+            theatres (str | bytes): Theatre workbook, its file name or contents.
+            template (str): Template file name.
+            css (str): CSS file name for Markdown and HTML templates. Defaults to "".
+
+        Returns:
+            str: Job id.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        workdir = join(self.jobs_dir, job_id)
+        os.makedirs(workdir)
+        for name, workbook in (
+            ("distributors", distributors),
+            ("exhibitors", exhibitors),
+            ("theatres", theatres),
+        ):
+            fname = join(workdir, f"{name}.xlsx")
+            if isinstance(workbook, bytes):
+                with open(fname, "wb") as f:
+                    f.write(workbook)
+            else:
+                shutil.copyfile(workbook, fname)
+        now = time.time()
+        with closing(self.connect()) as db:
+            db.execute(
+                "INSERT INTO jobs (id, status, created, updated, template, css, workdir)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    QUEUED,
+                    now,
+                    now,
+                    abspath(template),
+                    abspath(css) if css else "",
+                    workdir,
+                ),
+            )
+        self.event(job_id, "Queued")
+        return job_id
+
+    def claim(self) -> dict | None:
+        """Mark the oldest queued job as running and return it. Several services may share
+        a database, and each job is claimed by only one of them.
+
+        Returns:
+            dict | None: The job, or None if no job is queued.
+        """
+        with closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created LIMIT 1",
+                (QUEUED,),
+            ).fetchone()
+            if row:
+                db.execute(
+                    "UPDATE jobs SET status = ?, updated = ? WHERE id = ?",
+                    (RUNNING, time.time(), row["id"]),
+                )
+            db.execute("COMMIT")
+        if not row:
+            return None
+        self.event(row["id"], "Running")
+        return dict(row) | {"status": RUNNING}
+
+    def requeue(self, stale_after: float = 0.0) -> list[str]:
+        """Queue again the running jobs that have not been updated for stale_after seconds,
+        such as those of a service that was stopped while running them.
+
+        Args:
+            stale_after (float): Seconds since the last update after which a running job
+                is taken as abandoned. Defaults to 0.0.
+
+        Returns:
+            list[str]: Ids of the jobs queued again.
+        """
+        with closing(self.connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute(
+                "SELECT id FROM jobs WHERE status = ? AND updated <= ?",
+                (RUNNING, time.time() - stale_after),
+            ).fetchall()
+            job_ids = [row["id"] for row in rows]
+            for job_id in job_ids:
+                db.execute(
+                    "UPDATE jobs SET status = ?, done = 0, updated = ? WHERE id = ?",
+                    (QUEUED, time.time(), job_id),
+                )
+            db.execute("COMMIT")
+        for job_id in job_ids:
+            self.event(job_id, "Queued again")
+        return job_ids
+
+    def update(self, job_id: str, **fields):
+        """Update columns of a job.
+
+        Args:
+            job_id (str): Job id.
+            **fields: Column values, such as status, total, done, artifact and error.
+
+        Returns:
+            None
+        """
+        fields["updated"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with closing(self.connect()) as db:
+            db.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id)
+            )
+
+    def event(self, job_id: str, message: str, done: int = 0):
+        """Record a progress event of a job.
+
+        Args:
+            job_id (str): Job id.
+            message (str): Event message.
+            done (int): Number of documents generated so far. Defaults to 0.
+
+        Returns:
+            None
+        """
+        with closing(self.connect()) as db:
+            db.execute(
+                "INSERT INTO events (job_id, time, done, message) VALUES (?, ?, ?, ?)",
+                (job_id, time.time(), done, message),
+            )
+
+    def get(self, job_id: str) -> dict | None:
+        """Get a job.
+
+        Args:
+            job_id (str): Job id.
+
+        Returns:
+            dict | None: The job, or None if there is no such job.
+        """
+        with closing(self.connect()) as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def jobs(self, limit: int = 20) -> list[dict]:
+        """Get the most recently submitted jobs.
+
+        Args:
+            limit (int): Maximum number of jobs. Defaults to 20.
+
+        Returns:
+            list[dict]: The jobs, newest first.
+        """
+        with closing(self.connect()) as db:
+            rows = db.execute(
+                "SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def events(self, job_id: str, after: int = 0) -> list[dict]:
+        """Get the progress events of a job.
+
+        Args:
+            job_id (str): Job id.
+            after (int): Sequence number of the last event already seen. Defaults to 0.
+
+        Returns:
+            list[dict]: The events after the given one, in order.
+        """
+        with closing(self.connect()) as db:
+            rows = db.execute(
+                "SELECT * FROM events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+async def in_thread(func, *args, **kwargs):
+    """Run a blocking call, such as a query of the job store, in the default thread pool so
+    that it does not block the event loop.
+
+    Args:
+        func (callable): Function to call.
+        *args: Positional arguments of the function.
+        **kwargs: Keyword arguments of the function.
+
+    Returns:
+        The return value of the function.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+@lru_cache
+def job_renderer(tpl_fname: str, tpl_type: str, css_fname: str) -> "PdfRenderer":
+    """PdfRenderer of a template and stylesheet, created once per worker process.
+
+    Args:
+        tpl_fname (str): Template file name.
+        tpl_type (str): Template type, either "md" or "html".
+        css_fname (str): CSS file name.
+
+    Returns:
+        PdfRenderer: The renderer.
+    """
+    from htmlmerge import PdfRenderer
+
+    tpl_dir, tpl_name = os.path.split(tpl_fname)
+    return PdfRenderer(tpl_name, tpl_type, css_fname, tpl_dir)
+
+
+def render_document(
+    tpl_fname: str, css_fname: str, distributor_data, exhibitor_data, annexure
+) -> bytes:
+    """Render one agreement document from a Markdown or HTML template in a worker process.
+
+    Args:
+        tpl_fname (str): Template file name.
+        css_fname (str): CSS file name.
+        distributor_data (dict): Distributor data dictionary.
+        exhibitor_data (dict): Exhibitor data dictionary.
+        annexure (list): Annexure data.
+
+    Returns:
+        bytes: The PDF.
+    """
+    renderer = job_renderer(tpl_fname, tpl_suffix(tpl_fname), css_fname)
+    return renderer.write_pdf(None, distributor_data, exhibitor_data, annexure)
+
+
+def prepare_job(job: dict) -> tuple[dict, list[tuple]]:
+    """Read and prepare the data of a job.
+
+    Args:
+        job (dict): The job.
+
+    Returns:
+        tuple[dict, list[tuple]]: Distributor data, and the output file name, exhibitor
+            data and annexure data of each document.
+    """
+    from mergedata import (
+        read_data,
+        prepare_data_lazy,
+        extract_distributor_data,
+        extract_payloads,
+    )
+
+    distributors, exhibitors, theatres = read_data(
+        join(job["workdir"], "distributors.xlsx"),
+        join(job["workdir"], "exhibitors.xlsx"),
+        join(job["workdir"], "theatres.xlsx"),
+        cache=False,
+    )
+    distributors, df = prepare_data_lazy(distributors, exhibitors, theatres, GROUP_COLS)
+    docs = []
+    for count, (exhibitor_data, annexure) in enumerate(
+        extract_payloads(df.collect(), GROUP_COLS), start=1
+    ):
+        output_fname = get_fname(
+            FNAME_TPL,
+            count=count,
+            movie=exhibitor_data["movie"].lower(),
+            exhibitor=exhibitor_data["exhibitor"],
+            release_date=exhibitor_data["release_date"],
+        )
+        docs.append((f"{output_fname}.pdf", exhibitor_data, annexure))
+    return extract_distributor_data(distributors), docs
+
+
+class JobService:
+    """Asyncio service that runs the queued jobs of a JobStore one after another. The
+    documents of a Markdown or HTML job are rendered in a pool of worker processes, and those
+    of a DOCX job are converted by parallel soffice invocations. The PDF files of a job are
+    written to agreements.zip in its directory.
+
+    Args:
+        store (JobStore): The job store.
+        workers (int): Number of worker processes or soffice invocations. Defaults to 1.
+        poll_interval (float): Seconds between checks for queued jobs. Defaults to 1.0.
+        requeue_after (float): Seconds since its last update after which a running job is
+            queued again when the service starts. The default of 0.0 suits one service per
+            database; services sharing a database need more than the longest job.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        workers: int = 1,
+        poll_interval: float = 1.0,
+        requeue_after: float = 0.0,
+    ):
+        self.store = store
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.requeue_after = requeue_after
+
+    async def run(self, once: bool = False):
+        """Run queued jobs until cancelled.
+
+        Args:
+            once (bool): If True, return when no job is queued. Defaults to False.
+
+        Returns:
+            None
+        """
+        for job_id in await in_thread(self.store.requeue, self.requeue_after):
+            con.log(f"Job {job_id} was left running and is queued again")
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                job = await in_thread(self.store.claim)
+                if job:
+                    await self.run_job(job, executor)
+                elif once:
+                    return
+                else:
+                    await asyncio.sleep(self.poll_interval)
+
+    async def run_job(self, job: dict, executor: ProcessPoolExecutor):
+        """Run one job, recording its progress in the store.
+
+        Args:
+            job (dict): The job, as returned by JobStore.claim.
+            executor (ProcessPoolExecutor): Pool of render worker processes.
+
+        Returns:
+            None
+        """
+        loop = asyncio.get_running_loop()
+        job_id = job["id"]
+        artifact = join(job["workdir"], "agreements.zip")
+        try:
+            distributor_data, docs = await loop.run_in_executor(None, prepare_job, job)
+            await in_thread(self.store.update, job_id, total=len(docs))
+            await in_thread(self.store.event, job_id, f"Prepared {len(docs)} documents")
+            with zipfile.ZipFile(artifact, "w", zipfile.ZIP_DEFLATED) as zipf:
+                if tpl_suffix(job["template"]) == "docx":
+                    await self.convert_docx(job, distributor_data, docs, zipf)
+                else:
+                    await self.render_html(job, distributor_data, docs, zipf, executor)
+        except Exception as e:
+            await in_thread(self.store.event, job_id, f"Failed: {e}")
+            await in_thread(self.store.update, job_id, status=FAILED, error=str(e))
+            con.log(f"Job {job_id} failed: {e}")
+            return
+        # The last event is recorded before the status, so that watchers see it
+        await in_thread(self.store.event, job_id, "Done", len(docs))
+        await in_thread(self.store.update, job_id, status=DONE, artifact=artifact)
+
+    async def render_html(self, job, distributor_data, docs, zipf, executor):
+        """Render the documents of a Markdown or HTML job in the worker processes and write
+        them to the ZIP file as they are completed. If a document fails, the documents not
+        yet rendered are cancelled."""
+        loop = asyncio.get_running_loop()
+
+        async def render(pdf_fname, exhibitor_data, annexure):
+            pdf = await loop.run_in_executor(
+                executor,
+                render_document,
+                job["template"],
+                job["css"],
+                distributor_data,
+                exhibitor_data,
+                annexure,
+            )
+            return pdf_fname, pdf
+
+        tasks = [asyncio.ensure_future(render(*doc)) for doc in docs]
+        done = 0
+        try:
+            for task in asyncio.as_completed(tasks):
+                pdf_fname, pdf = await task
+                await in_thread(zipf.writestr, pdf_fname, pdf)
+                done += 1
+                await in_thread(self.store.update, job["id"], done=done)
+                await in_thread(
+                    self.store.event, job["id"], f"Generated {pdf_fname}", done
+                )
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def convert_docx(self, job, distributor_data, docs, zipf):
+        """Merge the documents of a DOCX job and convert them with parallel soffice
+        invocations in a thread, then write them to the ZIP file. The job fails if any
+        document was not converted, rather than leaving it out of the ZIP file."""
+        from docxmerge import (
+            docx_mergefields,
+            detect_soffice_path,
+            soffice_docx2pdf_batch,
+        )
+
+        docx_dir = join(job["workdir"], "docx")
+        done = 0
+
+        def converted(chunk: list[str]):
+            nonlocal done
+            done += len(chunk)
+            self.store.update(job["id"], done=done)
+            self.store.event(job["id"], f"Converted {len(chunk)} documents", done)
+
+        def merge_and_convert() -> list[str]:
+            os.makedirs(docx_dir, exist_ok=True)
+            docx_fnames = []
+            for pdf_fname, exhibitor_data, annexure in docs:
+                docx_fname = join(docx_dir, pdf_fname.replace(".pdf", ".docx"))
+                docx_mergefields(
+                    job["template"],
+                    docx_fname,
+                    distributor_data,
+                    exhibitor_data,
+                    annexure,
+                )
+                docx_fnames.append(docx_fname)
+            soffice_path, _, _ = detect_soffice_path()
+            return soffice_docx2pdf_batch(
+                docx_fnames, soffice_path, docx_dir, 50, self.workers, converted
+            )
+
+        def write_pdfs(pdf_fnames: list[str]):
+            for pdf_fname in pdf_fnames:
+                zipf.write(pdf_fname, os.path.basename(pdf_fname))
+
+        try:
+            pdf_fnames = await in_thread(merge_and_convert)
+            missing = [
+                os.path.basename(pdf_fname)
+                for pdf_fname in pdf_fnames
+                if not isfile(pdf_fname)
+            ]
+            if missing:
+                raise RuntimeError(
+                    f"{len(missing)} of {len(docs)} documents were not converted: "
+                    + ", ".join(missing)
+                )
+            await in_thread(write_pdfs, pdf_fnames)
+        finally:
+            shutil.rmtree(docx_dir, ignore_errors=True)
+
+
+async def watch(store: JobStore, job_id: str, poll_interval: float = 0.5):
+    """Stream the progress events of a job until it is done or has failed.
+
+    Args:
+        store (JobStore): The job store.
+        job_id (str): Job id.
+        poll_interval (float): Seconds between checks for new events. Defaults to 0.5.
+
+    Yields:
+        dict: Each progress event.
+    """
+    seq = 0
+    while True:
+        job = await in_thread(store.get, job_id)
+        for event in await in_thread(store.events, job_id, seq):
+            seq = event["seq"]
+            yield event
+        if job is None or job["status"] in (DONE, FAILED):
+            return
+        await asyncio.sleep(poll_interval)
@@ -1,6 +1,10 @@
 import sys
+import contextlib
 import os
 import time
+import tempfile
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing_extensions import Annotated
 
 
@@ -16,31 +20,93 @@ from rich.progress import (
 import typer
 
 
-from utils import tpl_suffix, get_fname, with_suffix
-from mergedata import (
-    read_data,
-    prepare_data,
-    group_data,
-    unique_rows,
-    extract_distributor_data,
-    extract_exhibitor_data,
-    extract_annexure_data,
-)
-from docxmerge import (
-    docx_mergefields,
-    print_header,
-    detect_soffice_path,
-    soffice_docx2pdf,
-)
-from htmlmerge import md_html_mergefields, get_jinja2_template
+# Polars, pikepdf and the template backends are imported by the commands that use them,
+# and the backends only once the template type is known, so that --help and the jobs
+# commands start quickly and .docx runs do not load WeasyPrint
+from tracing import tracer
+from utils import tpl_suffix, get_fname, with_suffix, print_header
 
 
 app = typer.Typer()
+cache_app = typer.Typer(help="Manage the cache of parsed Excel files")
+app.add_typer(cache_app, name="cache")
+jobs_app = typer.Typer(help="Queue agreement generation jobs and run the job service")
+app.add_typer(jobs_app, name="jobs")
 con = Console()
 
 
+def converted(docx_fname: str, progress: Progress, task, future):
+    """Remove the DOCX file converted by a SofficePool, whether or not the conversion
+    succeeded, and advance the progress bar.
+
+    Args:
+        docx_fname (str): DOCX file name.
+        progress (Progress): Progress bar.
+        task: Progress bar task.
+        future (Future): Completed conversion.
+
+    Returns:
+        None
+    """
+    if future.exception():
+        con.print(f"Conversion of {docx_fname} failed: {future.exception()}")
+    if os.path.isfile(docx_fname):
+        os.remove(docx_fname)
+    progress.advance(task)
+
+
+def check_uno():
+    """Exit with a message if the LibreOffice Python-UNO bridge needed by --soffice-pool is
+    not available, before any data is read.
+
+    Returns:
+        None
+    """
+    from docxmerge import require_uno
+
+    try:
+        require_uno()
+    except ImportError as e:
+        con.print(f"{e}\nProgram aborted")
+        sys.exit(1)
+
+
+def new_progress() -> Progress:
+    """Progress bar of the generation of agreement documents.
+
+    Returns:
+        Progress: The progress bar.
+    """
+    return Progress(
+        TaskProgressColumn(),
+        SpinnerColumn(),
+        TimeElapsedColumn(),
+        MofNCompleteColumn(),
+        TextColumn("[cyan]{task.fields[progress_description]}"),
+        TextColumn("[bold cyan]{task.fields[task_description]}"),
+    )
+
+
+def bookmark_title(exhibitor_data: dict) -> str:
+    """Title of the bookmark of an agreement document in a merged PDF.
+
+    Args:
+        exhibitor_data (dict): Exhibitor data dictionary.
+
+    Returns:
+        str: Bookmark title.
+    """
+    return f"{exhibitor_data['exhibitor']}, {exhibitor_data['exhibitor_place']} - {exhibitor_data['movie']}"
+
+
+@app.command("run")
 def main(
-    theatre: Annotated[str, typer.Argument(help="Theatres data in .xlsx format")],
+    theatre: Annotated[
+        str,
+        typer.Argument(
+            help="Theatres data in .xlsx format, or .csv format with --stream-batch"
+        ),
+    ],
     template: Annotated[
         str,
         typer.Option(
@@ -64,25 +130,198 @@ def main(
     exhibitor: Annotated[
         str, typer.Option("--exhibitor", "-e", help="Exhibitors data in .xlsx format")
     ] = "exhibitors.xlsx",
+    workers: Annotated[
+        int,
+        typer.Option(
+            "--workers",
+            "-w",
+            help="Number of worker processes for Markdown and HTML templates",
+            min=1,
+        ),
+    ] = 1,
+    soffice_pool: Annotated[
+        int,
+        typer.Option(
+            "--soffice-pool",
+            help="Number of persistent LibreOffice instances for .docx templates, 0 to start soffice for each document",
+        ),
+    ] = 0,
+    batch_size: Annotated[
+        int,
+        typer.Option(
+            "--batch-size",
+            help="Number of .docx files converted by one soffice invocation, 0 to convert one file at a time",
+        ),
+    ] = 0,
+    soffice_jobs: Annotated[
+        int,
+        typer.Option(
+            "--soffice-jobs",
+            help="Number of soffice invocations run at once when --batch-size is given",
+            min=1,
+        ),
+    ] = 1,
+    no_cache: Annotated[
+        bool,
+        typer.Option("--no-cache", help="Do not use the cache of parsed Excel files"),
+    ] = False,
+    profile: Annotated[
+        bool,
+        typer.Option(
+            "--profile", help="Print a summary of the time taken by each stage"
+        ),
+    ] = False,
+    trace: Annotated[
+        str,
+        typer.Option("--trace", help="Write a Chrome trace-event JSON file"),
+    ] = "",
+    incremental: Annotated[
+        bool,
+        typer.Option(
+            "--incremental",
+            help="Generate only the documents whose data, template or stylesheet changed since the last run",
+        ),
+    ] = False,
+    render_batch: Annotated[
+        int,
+        typer.Option(
+            "--render-batch",
+            help="Number of Markdown or HTML documents laid out together by WeasyPrint, 0 to lay out one document at a time",
+        ),
+    ] = 0,
+    subset_fonts: Annotated[
+        bool,
+        typer.Option(
+            "--subset-fonts",
+            help="Subset the fonts of the stylesheet to the characters used in the documents",
+        ),
+    ] = False,
+    font_report: Annotated[
+        str,
+        typer.Option(
+            "--font-report",
+            help="Write the characters used by each Markdown or HTML document to this JSON file",
+        ),
+    ] = "",
+    merge: Annotated[
+        str,
+        typer.Option(
+            "--merge",
+            help="Merge all the agreement documents into this PDF file, with a bookmark for each",
+        ),
+    ] = "",
+    watch: Annotated[
+        bool,
+        typer.Option(
+            "--watch",
+            help="After generating the documents, watch the workbooks, template and stylesheet and generate the documents affected by each change",
+        ),
+    ] = False,
+    stream_batch: Annotated[
+        int,
+        typer.Option(
+            "--stream-batch",
+            help="Read the theatres data in batches of this many rows and generate each document as soon as its rows are read, 0 to read all the data first",
+        ),
+    ] = 0,
+    max_rss: Annotated[
+        int,
+        typer.Option(
+            "--max-rss",
+            help="Memory ceiling in MB of the main process with --stream-batch, 0 for none",
+        ),
+    ] = 0,
 ):
+    tracer.enabled = profile or bool(trace)
     t_start = time.perf_counter()
     t1 = t_start
     print_header("Preparing Agreement Documents")
+    from manifest import Manifest, manifest_scope, payload_hash, template_hash
+    from mergedata import (
+        scan_data,
+        prepare_data_lazy,
+        extract_distributor_data,
+        extract_payloads,
+    )
 
+    if soffice_pool > 0 and batch_size > 0:
+        con.print(
+            "--soffice-pool and --batch-size cannot be used together\nProgram aborted"
+        )
+        sys.exit(1)
+    if soffice_pool > 0 and tpl_suffix(template) == "docx":
+        check_uno()
     distributor_fname = distributor
     exhibitor_fname = exhibitor
     theatre_fname = theatre
     template_fname = template
     css_fname = css
 
-    distributors, exhibitors, theatres = read_data(
-        distributor_fname, exhibitor_fname, theatre_fname, verbose=True
+    if stream_batch > 0:
+        from streaming import generate_streaming, peak_rss
+
+        options = {
+            "--incremental": incremental,
+            "--merge": merge,
+            "--render-batch": render_batch,
+            "--subset-fonts": subset_fonts,
+            "--font-report": font_report,
+            "--watch": watch,
+            "--soffice-pool": soffice_pool,
+            "--batch-size": batch_size,
+        }
+        ignored = [option for option, value in options.items() if value]
+        if ignored:
+            con.print(f"{', '.join(ignored)} ignored with --stream-batch")
+        tpl_type = tpl_suffix(template_fname)
+        if tpl_type not in ["md", "html", "docx"]:
+            print(
+                f"Unknown template type: {tpl_type}. Supported types are: md, html, docx\nProgram aborted"
+            )
+            sys.exit(1)
+        progress = new_progress()
+        with progress:
+            task = progress.add_task(
+                "", total=None, progress_description="Generating", task_description=""
+            )
+
+            def generated(pdf_fname: str):
+                progress.update(task, task_description=pdf_fname)
+                progress.advance(task)
+
+            num_docs = generate_streaming(
+                distributor_fname,
+                exhibitor_fname,
+                theatre_fname,
+                template_fname,
+                css_fname,
+                stream_batch,
+                soffice_jobs if tpl_type == "docx" else workers,
+                max_rss * 2**20,
+                cache=not no_cache,
+                callback=generated,
+            )
+        t_total = time.perf_counter() - t_start
+        con.print(
+            f"\nTotal execution time: {t_total:.2f}s for {num_docs} files. Average: {t_total / max(num_docs, 1):.2f}s per file. Peak memory: {peak_rss() / 2**20:.0f} MB."
+        )
+        if profile:
+            tracer.summary()
+        if trace:
+            tracer.write_chrome_trace(trace)
+            con.print(f"Trace written to {trace}")
+        return
+
+    distributors, exhibitors, theatres = scan_data(
+        distributor_fname,
+        exhibitor_fname,
+        theatre_fname,
+        verbose=True,
+        cache=not no_cache,
     )
     tpl_type = tpl_suffix(template_fname)
     if tpl_type in ["md", "html"]:
         print(f"Stylesheet: {css}")
-    distributors, df = prepare_data(distributors, exhibitors, theatres)
-
     group_cols = [
         "exhibitor",
         "exhibitor_place",
@@ -90,93 +329,572 @@ def main(
         "release_date",
         "agreement_date",
     ]
-    grouped_df = group_data(df, group_cols)
-    num_groups = unique_rows(df, group_cols)
+    distributors, df = prepare_data_lazy(distributors, exhibitors, theatres, group_cols)
+    with tracer.span("prepare_data"):
+        df = df.collect()
+    payloads = extract_payloads(df, group_cols)
+    num_groups = len(payloads)
     t2 = time.perf_counter()
     con.log(f"Data preparation complete {t2 - t1:.2f}s")
     fname_tpl = "{count:02}_{movie}_{exhibitor}_{release_date}"
 
     distributor_data = extract_distributor_data(distributors)
 
-    count = 0
+    # Output file names without suffix, and the hash of the payload of each document
+    if merge and incremental:
+        con.print("--incremental is ignored with --merge")
+        incremental = False
+    if merge and watch:
+        con.print("--watch is ignored with --merge")
+        watch = False
+    manifest = Manifest(manifest_scope(".", theatre_fname))
+    tpl_digest = template_hash(template_fname, css_fname)
+    docs = []
+    for count, (exhibitor_data, annexure) in enumerate(payloads, start=1):
+        output_fname = get_fname(
+            fname_tpl,
+            count=count,
+            movie=exhibitor_data["movie"].lower(),
+            exhibitor=exhibitor_data["exhibitor"],
+            release_date=exhibitor_data["release_date"],
+        )
+        digest = payload_hash(distributor_data, exhibitor_data, annexure, tpl_digest)
+        # Merged documents leave no PDF files of their own to record
+        if not merge:
+            manifest.record(f"{output_fname}.pdf", digest)
+        if incremental and manifest.is_current(f"{output_fname}.pdf", digest):
+            continue
+        docs.append((output_fname, exhibitor_data, annexure))
+    if incremental:
+        for stale_fname in manifest.remove_stale():
+            con.log(f"Removed stale {stale_fname}")
+        con.log(f"{num_groups - len(docs)} of {num_groups} documents are up to date")
+    num_docs = len(docs)
+    if merge:
+        from pdfmerge import PdfMerger
+    merger = PdfMerger(merge) if merge else None
+    pool = None
+
+    glyph_report = None
     if tpl_type in ["md", "html"]:
-        jinja_template = get_jinja2_template(template_fname, "")
+        from fontcache import GlyphReport, agreement_charset, subset_stylesheet
+        from htmlmerge import PdfRenderer, init_render_worker, render_worker
+
+        charset = ""
+        if subset_fonts:
+            with tracer.span("subset_fonts"):
+                charset = agreement_charset(
+                    template_fname, css_fname, distributor_data, payloads
+                )
+                css_fname = subset_stylesheet(css_fname, charset)
+            con.log(f"Fonts subset to {len(charset)} characters")
+        if font_report:
+            glyph_report = GlyphReport(charset)
+        renderer = PdfRenderer(
+            template_fname, tpl_type, css_fname, glyph_report=glyph_report
+        )
+        if render_batch > 1 and workers > 1:
+            con.print("--render-batch is ignored with --workers greater than 1")
+        elif render_batch > 1 and renderer.counts_pages:
+            con.print(
+                "--render-batch has no effect: the stylesheet uses counter(pages), so documents are rendered one at a time"
+            )
     elif tpl_type == "docx":
+        from docxmerge import (
+            docx_mergefields,
+            detect_soffice_path,
+            soffice_docx2pdf,
+            soffice_docx2pdf_batch,
+            SofficePool,
+        )
+
         soffice_path, cmd_list, shell = detect_soffice_path()
+        if soffice_pool > 0:
+            pool = SofficePool(soffice_pool, soffice_path)
+        batch_dir = tempfile.TemporaryDirectory() if batch_size > 0 else None
+        batch_fnames = []
     else:
         print(
             f"Unknown template type: {tpl_type}. Supported types are: md, html, docx\nProgram aborted"
         )
         sys.exit(1)
 
-    progress = Progress(
-        TaskProgressColumn(),
-        SpinnerColumn(),
-        TimeElapsedColumn(),
-        MofNCompleteColumn(),
-        TextColumn("[cyan]{task.fields[progress_description]}"),
-        TextColumn("[bold cyan]{task.fields[task_description]}"),
-    )
-    with progress:
+    progress = new_progress()
+    # The pool is stopped on errors too, so that no LibreOffice instance is left running
+    with pool or contextlib.nullcontext(), progress:
         task = progress.add_task(
             "",
-            total=num_groups,
+            total=num_docs,
             progress_description="Generating",
             task_description="",
         )
         # --------------------------
-        for g_exhibitor, g_theatres in grouped_df:
-            count += 1
-            exhibitor_data = extract_exhibitor_data(g_exhibitor, g_theatres)
-            annexure = extract_annexure_data(g_theatres)
-
-            output_fname = get_fname(
-                fname_tpl,
-                count=count,
-                movie=exhibitor_data["movie"].lower(),
-                exhibitor=exhibitor_data["exhibitor"],
-                release_date=exhibitor_data["release_date"],
-            )
-
-            if tpl_type == "docx":
-                output_fname = f"{output_fname}.docx"
-                progress.update(
-                    task, task_description=f"=== {with_suffix(output_fname, '.pdf')}"
-                )
-                docx_mergefields(
+        if workers > 1 and tpl_type in ["html", "md"]:
+            jobs = [
+                (f"{output_fname}.pdf", distributor_data, exhibitor_data, annexure)
+                for output_fname, exhibitor_data, annexure in docs
+            ]
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_render_worker,
+                initargs=(
                     template_fname,
-                    output_fname,
-                    distributor_data,
-                    exhibitor_data,
-                    annexure,
-                )
-                soffice_docx2pdf(output_fname, cmd_list, shell)
-                os.remove(output_fname)
-            elif tpl_type in ["html", "md"]:
-                output_fname = f"{output_fname}.pdf"
-                progress.update(task, task_description=f"{output_fname}")
-                md_html_mergefields(
-                    jinja_template,
                     tpl_type,
                     css_fname,
-                    output_fname,
-                    distributor_data=distributor_data,
-                    exhibitor_data=exhibitor_data,
-                    annexure=annexure,
+                    tracer.enabled,
+                    bool(glyph_report),
+                ),
+            ) as executor:
+                futures = [executor.submit(render_worker, job) for job in jobs]
+                for future in as_completed(futures):
+                    pdf_fname, events, glyphs = future.result()
+                    tracer.extend(events)
+                    if glyph_report:
+                        glyph_report.extend(glyphs)
+                    progress.update(task, task_description=f"{pdf_fname}")
+                    progress.advance(task)
+        elif render_batch > 1 and tpl_type in ["html", "md"]:
+            for start in range(0, num_docs, render_batch):
+                batch = docs[start : start + render_batch]
+                progress.update(task, task_description=f"{batch[0][0]}.pdf")
+                pdfs = renderer.write_pdf_batch(
+                    distributor_data,
+                    [
+                        (exhibitor_data, annexure)
+                        for _, exhibitor_data, annexure in batch
+                    ],
+                    doc_names=[f"{output_fname}.pdf" for output_fname, _, _ in batch],
                 )
-            else:
-                con.print("Unknown template type. Exiting...")
-                sys.exit(1)
-            progress.advance(task)
+                for (output_fname, exhibitor_data, _), pdf in zip(batch, pdfs):
+                    if merger:
+                        merger.append(pdf, bookmark_title(exhibitor_data))
+                    else:
+                        with open(f"{output_fname}.pdf", "wb") as f:
+                            f.write(pdf)
+                progress.advance(task, len(batch))
+        else:
+            for output_fname, exhibitor_data, annexure in docs:
+                with tracer.document(f"{output_fname}.pdf"):
+                    if tpl_type == "docx":
+                        output_fname = f"{output_fname}.docx"
+                        if batch_dir:
+                            output_fname = os.path.join(batch_dir.name, output_fname)
+                        progress.update(
+                            task,
+                            task_description=f"=== {with_suffix(output_fname, '.pdf')}",
+                        )
+                        docx_mergefields(
+                            template_fname,
+                            output_fname,
+                            distributor_data,
+                            exhibitor_data,
+                            annexure,
+                        )
+                        if batch_dir:
+                            batch_fnames.append(output_fname)
+                            continue
+                        if pool:
+                            future = pool.submit(output_fname)
+                            future.add_done_callback(
+                                partial(converted, output_fname, progress, task)
+                            )
+                            continue
+                        soffice_docx2pdf(output_fname, cmd_list, shell)
+                        os.remove(output_fname)
+                    elif tpl_type in ["html", "md"] and merger:
+                        progress.update(task, task_description=f"{output_fname}.pdf")
+                        pdf = renderer.write_pdf(
+                            None, distributor_data, exhibitor_data, annexure
+                        )
+                        merger.append(pdf, bookmark_title(exhibitor_data))
+                    elif tpl_type in ["html", "md"]:
+                        output_fname = f"{output_fname}.pdf"
+                        progress.update(task, task_description=f"{output_fname}")
+                        renderer.write_pdf(
+                            output_fname, distributor_data, exhibitor_data, annexure
+                        )
+                    else:
+                        con.print("Unknown template type. Exiting...")
+                        sys.exit(1)
+                    progress.advance(task)
+            if pool:
+                pool.stop()
+            if tpl_type == "docx" and batch_dir:
+                progress.update(task, task_description="Converting to PDF")
+                soffice_docx2pdf_batch(
+                    batch_fnames,
+                    soffice_path,
+                    ".",
+                    batch_size,
+                    soffice_jobs,
+                    callback=lambda chunk: progress.advance(task, len(chunk)),
+                )
+                batch_dir.cleanup()
+        if merger:
+            progress.update(task, task_description=f"Merging into {merge}")
+            # Documents not appended as they were rendered were written to files by this
+            # run, which are appended and then removed. Files of earlier runs with the same
+            # names are left alone when the documents were appended in memory
+            written = not merger.bookmarks
+            if written:
+                for output_fname, exhibitor_data, annexure in docs:
+                    merger.append(f"{output_fname}.pdf", bookmark_title(exhibitor_data))
+            pages = merger.save()
+            if written:
+                for output_fname, exhibitor_data, annexure in docs:
+                    if os.path.isfile(f"{output_fname}.pdf"):
+                        os.remove(f"{output_fname}.pdf")
         t3 = time.perf_counter()
     # --------------------------
+    if not merger:
+        manifest.save()
+    if merger:
+        con.print(f"Merged {num_docs} documents, {pages} pages, into {merge}")
+    if glyph_report:
+        missing = glyph_report.write(font_report)
+        con.print(f"Font report written to {font_report}")
+        if missing:
+            con.print(
+                f"[red]{missing} documents use characters missing from the font subsets"
+            )
 
     t_stop = t3
     t_total = t_stop - t_start
     con.print(
-        f"\nTotal execution time: {t_total:.2f}s for {num_groups} files. Average: {t_total / num_groups:.2f}s per file."
+        f"\nTotal execution time: {t_total:.2f}s for {num_docs} files. Average: {t_total / max(num_docs, 1):.2f}s per file."
     )
+    if profile:
+        tracer.summary()
+    if trace:
+        tracer.write_chrome_trace(trace)
+        con.print(f"Trace written to {trace}")
+    if watch:
+        from watcher import WatchSession
+
+        # The stylesheet as given, not its copy with font subsets
+        WatchSession(
+            distributor_fname,
+            exhibitor_fname,
+            theatre_fname,
+            template_fname,
+            css,
+            Manifest(manifest_scope(".", theatre_fname)),
+            soffice_jobs if tpl_type == "docx" else workers,
+            cache=not no_cache,
+        ).run()
+
+
+@app.command("batch")
+def batch(
+    manifest_fname: Annotated[
+        str, typer.Argument(help="Release manifest in TOML format")
+    ],
+    workers: Annotated[
+        int,
+        typer.Option(
+            "--workers",
+            "-w",
+            help="Number of worker processes for Markdown and HTML templates",
+            min=1,
+        ),
+    ] = 1,
+    soffice_pool: Annotated[
+        int,
+        typer.Option(
+            "--soffice-pool",
+            help="Number of persistent LibreOffice instances for .docx templates, 0 to convert in batches",
+        ),
+    ] = 0,
+    batch_size: Annotated[
+        int,
+        typer.Option(
+            "--batch-size",
+            help="Number of .docx files converted by one soffice invocation, 0 for 50",
+        ),
+    ] = 0,
+    soffice_jobs: Annotated[
+        int,
+        typer.Option(
+            "--soffice-jobs",
+            help="Number of soffice invocations run at once",
+            min=1,
+        ),
+    ] = 1,
+    no_cache: Annotated[
+        bool,
+        typer.Option("--no-cache", help="Do not use the cache of parsed Excel files"),
+    ] = False,
+    profile: Annotated[
+        bool,
+        typer.Option(
+            "--profile", help="Print a summary of the time taken by each stage"
+        ),
+    ] = False,
+    trace: Annotated[
+        str,
+        typer.Option("--trace", help="Write a Chrome trace-event JSON file"),
+    ] = "",
+    incremental: Annotated[
+        bool,
+        typer.Option(
+            "--incremental",
+            help="Generate only the documents whose data, template or stylesheet changed since the last run",
+        ),
+    ] = False,
+):
+    """Generate the agreement documents of all the releases of a manifest in one run."""
+    tracer.enabled = profile or bool(trace)
+    t_start = time.perf_counter()
+    if soffice_pool > 0 and batch_size > 0:
+        con.print(
+            "--soffice-pool and --batch-size cannot be used together\nProgram aborted"
+        )
+        sys.exit(1)
+    print_header("Preparing Agreement Documents")
+    from manifest import Manifest, manifest_scope, payload_hash, template_hash
+    from releases import load_releases, prepare_releases
+
+    settings, releases = load_releases(manifest_fname)
+    template_fname = settings["template"]
+    css_fname = settings["css"]
+    tpl_type = tpl_suffix(template_fname)
+    if tpl_type not in ["md", "html", "docx"]:
+        print(
+            f"Unknown template type: {tpl_type}. Supported types are: md, html, docx\nProgram aborted"
+        )
+        sys.exit(1)
+    if tpl_type == "docx":
+        from docxmerge import (
+            docx_mergefields,
+            detect_soffice_path,
+            soffice_docx2pdf_batch,
+            SofficePool,
+        )
+
+        if soffice_pool > 0:
+            check_uno()
+        soffice_path, _, _ = detect_soffice_path()
+    else:
+        from htmlmerge import PdfRenderer, init_render_worker, render_worker
+    prepared = prepare_releases(releases, cache=not no_cache)
+    con.log(
+        f"Data preparation of {len(releases)} releases complete {time.perf_counter() - t_start:.2f}s"
+    )
+
+    # All the documents of all the releases, each with the distributor data of its release
+    # One manifest scope per output directory and theatres sheet, so that a release only
+    # skips or removes the documents it generated itself
+    manifests = {}
+    tpl_digest = template_hash(template_fname, css_fname)
+    docs = []
+    num_groups = 0
+    for release, (distributor_data, release_docs) in zip(releases, prepared):
+        con.log(f"{release['theatre']}: {len(release_docs)} documents")
+        scope = manifest_scope(
+            release["output_dir"], release["theatre"], release["sheet"]
+        )
+        if scope not in manifests:
+            manifests[scope] = Manifest(scope)
+        manifest = manifests[scope]
+        for output_fname, exhibitor_data, annexure in release_docs:
+            num_groups += 1
+            digest = payload_hash(
+                distributor_data, exhibitor_data, annexure, tpl_digest
+            )
+            manifest.record(f"{output_fname}.pdf", digest)
+            if incremental and manifest.is_current(f"{output_fname}.pdf", digest):
+                continue
+            docs.append((output_fname, distributor_data, exhibitor_data, annexure))
+    if incremental:
+        for manifest in manifests.values():
+            for stale_fname in manifest.remove_stale():
+                con.log(f"Removed stale {stale_fname}")
+        con.log(f"{num_groups - len(docs)} of {num_groups} documents are up to date")
+    num_docs = len(docs)
+
+    pool = (
+        SofficePool(soffice_pool, soffice_path)
+        if tpl_type == "docx" and soffice_pool > 0
+        else None
+    )
+    progress = new_progress()
+    with pool or contextlib.nullcontext(), progress:
+        task = progress.add_task(
+            "",
+            total=num_docs,
+            progress_description="Generating",
+            task_description="",
+        )
+        if tpl_type in ["html", "md"] and workers > 1:
+            with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_render_worker,
+                initargs=(template_fname, tpl_type, css_fname, tracer.enabled),
+            ) as executor:
+                futures = [
+                    executor.submit(render_worker, (f"{output_fname}.pdf", *data))
+                    for output_fname, *data in docs
+                ]
+                for future in as_completed(futures):
+                    pdf_fname, events, _ = future.result()
+                    tracer.extend(events)
+                    progress.update(task, task_description=f"{pdf_fname}")
+                    progress.advance(task)
+        elif tpl_type in ["html", "md"]:
+            renderer = PdfRenderer(template_fname, tpl_type, css_fname)
+            for output_fname, *data in docs:
+                with tracer.document(f"{output_fname}.pdf"):
+                    progress.update(task, task_description=f"{output_fname}.pdf")
+                    renderer.write_pdf(f"{output_fname}.pdf", *data)
+                    progress.advance(task)
+        else:
+            # The .docx files are written to a temporary directory, one subdirectory per
+            # output directory, and converted into the output directory
+            docx_dir = tempfile.TemporaryDirectory()
+            outdirs = {}
+            for output_fname, *data in docs:
+                with tracer.document(f"{output_fname}.pdf"):
+                    outdir, name = os.path.split(output_fname)
+                    fnames = outdirs.setdefault(outdir, [])
+                    docx_fname = os.path.join(
+                        docx_dir.name, str(list(outdirs).index(outdir)), f"{name}.docx"
+                    )
+                    os.makedirs(os.path.dirname(docx_fname), exist_ok=True)
+                    progress.update(task, task_description=f"=== {output_fname}.pdf")
+                    docx_mergefields(template_fname, docx_fname, *data)
+                    if pool:
+                        future = pool.submit(docx_fname, f"{output_fname}.pdf")
+                        future.add_done_callback(
+                            partial(converted, docx_fname, progress, task)
+                        )
+                    else:
+                        fnames.append(docx_fname)
+            if pool:
+                pool.stop()
+            else:
+                progress.update(task, task_description="Converting to PDF")
+                for outdir, fnames in outdirs.items():
+                    soffice_docx2pdf_batch(
+                        fnames,
+                        soffice_path,
+                        outdir or ".",
+                        batch_size or 50,
+                        soffice_jobs,
+                        callback=lambda chunk: progress.advance(task, len(chunk)),
+                    )
+            docx_dir.cleanup()
+    for manifest in manifests.values():
+        manifest.save()
+
+    t_total = time.perf_counter() - t_start
+    con.print(
+        f"\nTotal execution time: {t_total:.2f}s for {num_docs} files of {len(releases)} releases. Average: {t_total / max(num_docs, 1):.2f}s per file."
+    )
+    if profile:
+        tracer.summary()
+    if trace:
+        tracer.write_chrome_trace(trace)
+        con.print(f"Trace written to {trace}")
+
+
+@cache_app.command("clear")
+def cache_clear():
+    """Remove all the cached Excel files and font subsets."""
+    from excelcache import clear_cache
+    from fontcache import clear_font_cache
+
+    removed = clear_cache() + clear_font_cache()
+    con.print(f"Removed {removed} cached files")
+
+
+@jobs_app.command("submit")
+def jobs_submit(
+    theatre: Annotated[str, typer.Argument(help="Theatres data in .xlsx format")],
+    template: Annotated[
+        str,
+        typer.Option(
+            "--template",
+            "-t",
+            help="Template file in .docx, .md.jinja or .html.jinja format",
+        ),
+    ] = "agreement_template.docx",
+    css: Annotated[
+        str,
+        typer.Option(
+            "--css",
+            "-c",
+            help="CSS stylesheet file for Markdown and HTML template files",
+        ),
+    ] = "agreement.css",
+    distributor: Annotated[
+        str,
+        typer.Option("--distributor", "-d", help="Distributor data in .xlsx format"),
+    ] = "distributors.xlsx",
+    exhibitor: Annotated[
+        str, typer.Option("--exhibitor", "-e", help="Exhibitors data in .xlsx format")
+    ] = "exhibitors.xlsx",
+):
+    """Queue a job to generate agreement documents."""
+    from jobs import JobStore
+
+    css = css if tpl_suffix(template) in ["md", "html"] else ""
+    job_id = JobStore().submit(distributor, exhibitor, theatre, template, css)
+    con.print(f"Queued job {job_id}")
+
+
+@jobs_app.command("serve")
+def jobs_serve(
+    workers: Annotated[
+        int,
+        typer.Option(
+            "--workers",
+            "-w",
+            help="Number of worker processes or soffice invocations per job",
+            min=1,
+        ),
+    ] = 1,
+    requeue_after: Annotated[
+        float,
+        typer.Option(
+            "--requeue-after",
+            help="Seconds since its last update after which a running job left by a stopped service is queued again",
+        ),
+    ] = 0.0,
+):
+    """Run queued jobs until interrupted."""
+    import asyncio
+    from jobs import JobService, JobStore
+
+    con.print("Waiting for jobs, press Ctrl+C to stop")
+    try:
+        asyncio.run(JobService(JobStore(), workers, requeue_after=requeue_after).run())
+    except KeyboardInterrupt:
+        pass
+
+
+@jobs_app.command("status")
+def jobs_status():
+    """List the most recent jobs."""
+    from jobs import JobStore
+
+    for job in JobStore().jobs():
+        con.print(
+            f"{job['id']}  {job['status']:8}  {job['done']}/{job['total']}  {job['artifact'] or job['error']}"
+        )
+
+
+@jobs_app.command("watch")
+def jobs_watch(job_id: Annotated[str, typer.Argument(help="Job id")]):
+    """Print the progress events of a job until it is done."""
+    import asyncio
+    from jobs import JobStore, watch
+
+    async def print_events():
+        async for event in watch(JobStore(), job_id):
+            con.print(f"[{event['done']}] {event['message']}")
+
+    asyncio.run(print_events())
 
 
 if __name__ == "__main__":
-    typer.run(main)
+    app()
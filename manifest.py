@@ -0,0 +1,166 @@
+import os
+import json
+import hashlib
+from os.path import abspath, isfile
+
+
+from excelcache import file_hash
+
+
+MANIFEST_FNAME = ".agreement_manifest.json"
+
+
+def payload_hash(
+    distributor_data, exhibitor_data, annexure, template_digest: str
+) -> str:
+    """Compute the hash of everything that determines the content of one agreement
+    document.
+
+    Args:
+        distributor_data (dict): Distributor data dictionary.
+        exhibitor_data (dict): Exhibitor data dictionary.
+        annexure (list[dict]): Annexure data of the exhibitor.
+        template_digest (str): Hash of the template and stylesheet, as returned by
+            template_hash.
+
+    Returns:
+        str: Hexadecimal digest of the payload.
+    """
+    payload = json.dumps(
+        [distributor_data, exhibitor_data, annexure, template_digest],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def template_hash(*fnames: str) -> str:
+    """Compute the combined hash of the template and stylesheet files. Files that do not
+    exist, such as the stylesheet of a .docx template, are ignored.
+
+    Args:
+        *fnames (str): Template and stylesheet file names.
+
+    Returns:
+        str: Hexadecimal digest of the file contents.
+    """
+    h = hashlib.sha256()
+    for fname in fnames:
+        h.update(file_hash(fname).encode("utf-8") if isfile(fname) else b"-")
+    return h.hexdigest()
+
+
+def manifest_scope(
+    output_dir: str, theatre_fname: str, sheet_name: str | None = None
+) -> str:
+    """Key of the documents generated into an output directory from a sheet of a theatres
+    workbook. Runs for different releases have different scopes and do not see or remove
+    each other's documents.
+
+    Args:
+        output_dir (str): Output directory of the documents.
+        theatre_fname (str): Theatres workbook file name.
+        sheet_name (str | None): Sheet of the theatres workbook. Defaults to None.
+
+    Returns:
+        str: The scope.
+    """
+    return f"{abspath(output_dir)}|{abspath(theatre_fname)}|{sheet_name or ''}"
+
+
+def read_manifest(fname: str = MANIFEST_FNAME) -> dict[str, dict[str, str]]:
+    """Read the payload hashes of all the scopes of a manifest file.
+
+    Args:
+        fname (str): Manifest file name. Defaults to MANIFEST_FNAME.
+
+    Returns:
+        dict[str, dict[str, str]]: The payload hash of each output file, by scope. Empty if
+            the file does not exist or cannot be read.
+    """
+    try:
+        with open(fname, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    # Entries of a manifest written before scopes are dropped
+    return {
+        scope: entries for scope, entries in data.items() if isinstance(entries, dict)
+    }
+
+
+class Manifest:
+    """Record of the payload hash of each generated agreement document of one scope, used
+    to skip documents whose inputs have not changed since the last run of that scope.
+
+    Args:
+        scope (str): Scope of the documents, as returned by manifest_scope.
+        fname (str): Manifest file name, shared by all the scopes. Defaults to
+            MANIFEST_FNAME.
+    """
+
+    def __init__(self, scope: str, fname: str = MANIFEST_FNAME):
+        self.scope = scope
+        self.fname = fname
+        self.previous = read_manifest(fname).get(scope, {})
+        self.current = {}
+
+    def is_current(self, output_fname: str, digest: str) -> bool:
+        """Check whether an output file exists and was generated from the same payload.
+
+        Args:
+            output_fname (str): Output file name.
+            digest (str): Payload hash of the output file.
+
+        Returns:
+            bool: True if the output file need not be generated again.
+        """
+        return self.previous.get(output_fname) == digest and isfile(output_fname)
+
+    def record(self, output_fname: str, digest: str):
+        """Record the payload hash of an output file of this run.
+
+        Args:
+            output_fname (str): Output file name.
+            digest (str): Payload hash of the output file.
+
+        Returns:
+            None
+        """
+        self.current[output_fname] = digest
+
+    def remove_stale(self) -> list[str]:
+        """Remove the output files of the last run of the same scope that are not outputs
+        of this run.
+
+        Returns:
+            list[str]: File names of the removed files.
+        """
+        removed = []
+        for output_fname in self.previous.keys() - self.current.keys():
+            if isfile(output_fname):
+                os.remove(output_fname)
+                removed.append(output_fname)
+        return removed
+
+    def save(self):
+        """Write the payload hashes of the output files of this run that exist, replacing
+        those of the last run of the same scope and keeping those of other scopes. Files
+        whose generation failed are left out, so that they are generated again in the next
+        run.
+
+        Returns:
+            None
+        """
+        data = read_manifest(self.fname)
+        data[self.scope] = {
+            output_fname: digest
+            for output_fname, digest in sorted(self.current.items())
+            if isfile(output_fname)
+        }
+        tmp_fname = f"{self.fname}.{os.getpid()}.tmp"
+        with open(tmp_fname, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_fname, self.fname)
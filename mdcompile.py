@@ -0,0 +1,434 @@
+import re
+from itertools import product
+from math import prod
+
+
+import mistune
+from jinja2 import TemplateSyntaxError
+from mistune.renderers.html import HTMLRenderer
+from rich.console import Console
+
+
+from tracing import tracer
+
+
+con = Console()
+
+re_jinja_tag = re.compile(r"\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\}", re.S)
+re_stmt_name = re.compile(r"\{%[-+]?\s*(\w+)")
+# Characters of a value that Markdown may give a meaning to within text
+re_md_active = re.compile(r"[\\`*_\[\]<~|\t\r\n]|&(?=[#\w]|$)")
+# Characters of a value that may end an HTML block or tag in Markdown
+re_raw_block_unsafe = re.compile(r"[\r\n]|-->|\?>|]]>|</")
+re_raw_inline_unsafe = re.compile(r"[<>\"'\r\n]")
+# Plugins of mistune.html, which renders Markdown templates that are not compiled
+MARKDOWN_PLUGINS = ["strikethrough", "footnotes", "table"]
+# Statements that render their body in place, or nothing
+STATEMENTS = {"if", "elif", "else", "for", "with", "set"}
+# Most combinations of if branches and loop counts checked when compiling a template;
+# templates with more are not compiled
+MAX_VARIANTS = 256
+
+_html_text = HTMLRenderer(escape=False).text
+
+
+class NotCompilable(Exception):
+    """Raised when a Markdown template, or a value merged into it, cannot be rendered by
+    the compiled HTML template exactly as Markdown would render it."""
+
+
+class ContextRenderer(HTMLRenderer):
+    """HTML renderer of mistune that records whether each placeholder is rendered as text,
+    in an HTML block or in an inline HTML tag.
+
+    Args:
+        re_placeholder (re.Pattern): Regular expression of the placeholders.
+    """
+
+    def __init__(self, re_placeholder: re.Pattern):
+        super().__init__(escape=False)
+        self.re_placeholder = re_placeholder
+        self.contexts = {}
+
+    def record(self, s: str, context: str):
+        for placeholder in self.re_placeholder.findall(s):
+            self.contexts.setdefault(placeholder, []).append(context)
+
+    def text(self, text: str) -> str:
+        self.record(text, "text")
+        return super().text(text)
+
+    def block_html(self, html: str) -> str:
+        self.record(html, "block")
+        return super().block_html(html)
+
+    def inline_html(self, html: str) -> str:
+        self.record(html, "inline")
+        return super().inline_html(html)
+
+
+def text_value(value, strict: int = 0) -> str:
+    """Escape a value merged into the text of a compiled Markdown template as Markdown
+    would, or raise NotCompilable if Markdown could give any of its characters a meaning.
+
+    Args:
+        value: The value.
+        strict (int): 1 if the value is next to an emphasis delimiter or at the end of a
+            line, 2 if it is at the start of a line, where it must start with a letter.
+            Defaults to 0.
+
+    Returns:
+        str: HTML of the value.
+
+    Raises:
+        NotCompilable: If the value may not render as plain text.
+    """
+    s = str(value)
+    if re_md_active.search(s):
+        raise NotCompilable(f"Markdown characters in {s!r}")
+    if strict and not (s and s[0].isalnum() and s[-1].isalnum()):
+        raise NotCompilable(f"{s!r} next to Markdown syntax")
+    if strict == 2 and not s[0].isalpha():
+        raise NotCompilable(f"{s!r} at the start of a line")
+    return _html_text(s)
+
+
+def raw_value(value, inline: bool = False) -> str:
+    """Check a value merged into HTML of a compiled Markdown template, which Markdown
+    copies as is, or raise NotCompilable if the value could end the HTML block or tag.
+
+    Args:
+        value: The value.
+        inline (bool): True if the value is in an inline HTML tag. Defaults to False.
+
+    Returns:
+        str: The value as a string.
+
+    Raises:
+        NotCompilable: If the value may change where the HTML ends.
+    """
+    s = str(value)
+    if (re_raw_inline_unsafe if inline else re_raw_block_unsafe).search(s):
+        raise NotCompilable(f"{s!r} in HTML")
+    return s
+
+
+def strip_whitespace_control(tag: str) -> str:
+    """Remove the - and + whitespace control signs of a Jinja2 tag.
+
+    Args:
+        tag (str): The tag, such as "{%- if x -%}".
+
+    Returns:
+        str: The tag without them, such as "{% if x %}".
+    """
+    inner = tag[2:-2]
+    if inner[:1] in "-+":
+        inner = inner[1:]
+    if inner[-1:] in "-+":
+        inner = inner[:-1]
+    return f"{tag[:2]}{inner}{tag[-2:]}"
+
+
+def block_choices(block: list) -> range:
+    """Choices of expand for a block statement: the number of times a for loop body is
+    rendered, or the index of the branch taken by an if statement, including taking none
+    if there is no else branch.
+
+    Args:
+        block (list): Number of the closing statement, name, numbers of the elif and else
+            statements and whether there is an else statement.
+
+    Returns:
+        range: The choices.
+    """
+    _, name, branches, has_else = block
+    if name == "for":
+        return range(3)
+    if name == "if":
+        return range(len(branches) + (1 if has_else else 2))
+    return range(1)
+
+
+def expand(parts: list, blocks: dict[int, list], choices: dict[int, int]) -> str:
+    """Join text split at statement placeholders as Jinja2 would render it, with the
+    branches taken and the number of loop iterations given for each block statement.
+
+    Args:
+        parts (list): Strings and statement numbers.
+        blocks (dict[int, list]): Number of the closing statement, name, numbers of the
+            elif and else statements and whether there is an else statement, of each
+            block statement.
+        choices (dict[int, int]): For each block statement, the number of times a loop
+            body is rendered, the else branch of a for loop being rendered if 0, or the
+            index of the branch taken by an if statement, none being taken if there are
+            fewer branches. The body of a loop is rendered the same way each time.
+
+    Returns:
+        str: The joined text.
+    """
+    out = []
+    i = 0
+    while i < len(parts):
+        part = parts[i]
+        if isinstance(part, str):
+            out.append(part)
+        elif part in blocks:
+            close, name, branches, has_else = blocks[part]
+            j = parts.index(close, i)
+            bounds = [i, *(parts.index(b, i) for b in branches), j]
+            bodies = [
+                expand(parts[start + 1 : end], blocks, choices)
+                for start, end in zip(bounds, bounds[1:])
+            ]
+            choice = choices.get(part, 0)
+            if name == "for":
+                out.append(bodies[0] * choice if choice or not has_else else bodies[-1])
+            elif name == "if":
+                out.append(bodies[choice] if choice < len(bodies) else "")
+            else:
+                out.append(bodies[0])
+            i = j
+        i += 1
+    return "".join(out)
+
+
+def compile_markdown(source: str, env) -> str:
+    """Compile a Markdown Jinja2 template into an HTML Jinja2 template, so that each
+    document is rendered by Jinja2 alone instead of by Jinja2 and then mistune.
+
+    Each expression and statement of the template is replaced by a placeholder and the
+    template is converted to HTML once. Each placeholder is then replaced by its
+    expression, wrapped in text_value or raw_value depending on whether Markdown renders
+    it as text or copies it as HTML, or by its statement. A statement alone on its line,
+    which Jinja2 renders as a blank line, is moved to the end of the previous line when
+    it is in Markdown text, such as an if statement around a list item. The compiled
+    template is checked against mistune with every combination of the branches of the if
+    statements and of the for loops run zero, one and two times.
+
+    Args:
+        source (str): Source of the Markdown template.
+        env (jinja2.Environment): Environment of the template.
+
+    Returns:
+        str: Source of the HTML template.
+
+    Raises:
+        NotCompilable: If the template uses Jinja2 features that cannot be compiled, has
+            more than MAX_VARIANTS combinations of branches and loop counts, or if the
+            compiled template does not render as the Markdown template.
+    """
+    syntax = (
+        env.block_start_string,
+        env.variable_start_string,
+        env.comment_start_string,
+    )
+    if syntax != ("{%", "{{", "{#") or env.line_statement_prefix:
+        raise NotCompilable("custom Jinja2 syntax")
+    if env.trim_blocks or env.lstrip_blocks:
+        raise NotCompilable("trim_blocks or lstrip_blocks")
+    # Newlines as normalised by the Jinja2 lexer
+    keep_newline = env.keep_trailing_newline and source.endswith(("\n", "\r"))
+    source = env.newline_sequence.join(source.splitlines())
+    if keep_newline:
+        source += env.newline_sequence
+
+    prefix = "jinjamd"
+    while prefix in source:
+        prefix += "z"
+    re_placeholder = re.compile(rf"{prefix}\d+[es]")
+
+    # Data, expression and statement segments, with whitespace control applied
+    segments = []
+    pos = 0
+    for m in re_jinja_tag.finditer(source):
+        segments.append(["data", source[pos : m.start()]])
+        segments.append(["expr" if m.group().startswith("{{") else "stmt", m.group()])
+        pos = m.end()
+    segments.append(["data", source[pos:]])
+    for i, (kind, tag) in enumerate(segments):
+        if kind != "data":
+            if tag[2] == "-":
+                segments[i - 1][1] = segments[i - 1][1].rstrip()
+            if tag[-3] == "-":
+                segments[i + 1][1] = segments[i + 1][1].lstrip()
+
+    blocks = {}
+    stack = []
+    tags = {}
+    real_parts = []
+    for n, (kind, tag) in enumerate(segments):
+        if kind == "data":
+            real_parts.append(tag)
+            continue
+        tags[n] = tag
+        if kind == "expr":
+            real_parts.append(f"{prefix}{n}e")
+            continue
+        real_parts.append(n)
+        m = re_stmt_name.match(tag)
+        name = m.group(1) if m else None
+        if name in ("if", "for", "with"):
+            stack.append(n)
+            blocks[n] = [None, name, [], False]
+        elif name in ("elif", "else"):
+            if not stack or blocks[stack[-1]][3]:
+                raise NotCompilable(f"unexpected {tag}")
+            blocks[stack[-1]][2].append(n)
+            blocks[stack[-1]][3] = name == "else"
+        elif name and name.startswith("end") and stack:
+            if blocks[stack[-1]][1] != name[3:]:
+                raise NotCompilable(f"unexpected {tag}")
+            blocks[stack.pop()][0] = n
+        elif name and name not in STATEMENTS:
+            raise NotCompilable(f"unsupported statement {tag}")
+    if stack:
+        raise NotCompilable(f"unclosed {tags[stack[-1]]}")
+
+    # Statements alone on their line, which Jinja2 renders as a blank line
+    standalone = set()
+    rendered = ""
+    for part in real_parts:
+        if isinstance(part, str):
+            rendered += part
+            continue
+        line_start = rendered.rsplit("\n", 1)[-1]
+        if not line_start.strip():
+            standalone.add(part)
+    for part in list(standalone):
+        i = real_parts.index(part)
+        following = "".join(p for p in real_parts[i + 1 :] if isinstance(p, str))
+        if following.split("\n", 1)[0].strip():
+            standalone.discard(part)
+
+    def to_html(attached: set[int]) -> tuple[str, dict]:
+        # HTML of the template with placeholders, and the contexts of the placeholders
+        markdown = ""
+        for part in real_parts:
+            if isinstance(part, str):
+                markdown += part
+            elif part in attached:
+                end = len(markdown.rstrip())
+                if not end:
+                    raise NotCompilable(f"{tags[part]} at the start of the template")
+                markdown = f"{markdown[:end]} {prefix}{part}s{markdown[end:]}"
+            else:
+                markdown += f"{prefix}{part}s"
+        renderer = ContextRenderer(re_placeholder)
+        md = mistune.create_markdown(
+            escape=False, renderer=renderer, plugins=MARKDOWN_PLUGINS
+        )
+        html = md(markdown)
+        for part in attached:
+            if f" {prefix}{part}s" not in html:
+                raise NotCompilable(f"{tags[part]} is not at the end of a line")
+            html = html.replace(f" {prefix}{part}s", f"{prefix}{part}s")
+        return html, renderer.contexts
+
+    _, contexts = to_html(set())
+    attached = {n for n in standalone if contexts.get(f"{prefix}{n}s") != ["block"]}
+    html, contexts = to_html(attached)
+
+    for n, tag in tags.items():
+        placeholder = f"{prefix}{n}{'e' if tag.startswith('{{') else 's'}"
+        if html.count(placeholder) != 1:
+            raise NotCompilable(f"{tag} is not rendered once")
+        if placeholder.endswith("e") and len(contexts.get(placeholder, [])) != 1:
+            raise NotCompilable(f"{tag} is not rendered as text or HTML")
+    re_stmt_placeholder = re.compile(rf"{prefix}(\d+)s")
+    stmts = [int(n) for n in re_stmt_placeholder.findall(html)]
+    if stmts != sorted(stmts):
+        raise NotCompilable("statements are reordered by Markdown")
+
+    html_parts = re_stmt_placeholder.split(html)
+    html_parts[1::2] = [int(n) for n in html_parts[1::2]]
+    # Every combination of the choices of the block statements, since the Markdown of one
+    # block can depend on what another renders
+    numbers = sorted(blocks)
+    all_choices = [block_choices(blocks[n]) for n in numbers]
+    if prod(len(choices) for choices in all_choices) > MAX_VARIANTS:
+        raise NotCompilable(
+            f"more than {MAX_VARIANTS} combinations of if branches and loop counts"
+        )
+    variants = [dict(zip(numbers, choices)) for choices in product(*all_choices)]
+    for choices in variants:
+        expected = mistune.html(expand(real_parts, blocks, choices))
+        if expand(html_parts, blocks, choices) != expected:
+            taken = ", ".join(f"{tags[n]} {choices[n]}" for n in numbers)
+            raise NotCompilable(f"the HTML differs with {taken}")
+
+    # Strictness of the checks of values in text, the highest in any variant
+    strictness = {}
+    for choices in variants:
+        rendered = expand(real_parts, blocks, choices)
+        for m in re.finditer(rf"{prefix}\d+e", rendered):
+            before = rendered[: m.start()].rsplit("\n", 1)[-1]
+            after = rendered[m.end() :].split("\n", 1)[0]
+            strict = 0
+            if not after.strip() or before[-1:] in "*_~" or after[:1] in "*_~":
+                strict = 1
+            if not before.strip():
+                strict = 2
+            strictness[m.group()] = max(strict, strictness.get(m.group(), 0))
+
+    def restore(m: re.Match) -> str:
+        placeholder = m.group()
+        n = int(placeholder[len(prefix) : -1])
+        tag = tags[n]
+        if placeholder.endswith("s"):
+            return "" if tag.startswith("{#") else strip_whitespace_control(tag)
+        expr = strip_whitespace_control(tag)[2:-2].strip()
+        context = contexts[placeholder][0]
+        if context != "text":
+            return f"{{{{ _md_raw(({expr}), {context == 'inline'}) }}}}"
+        return f"{{{{ _md_text(({expr}), {strictness[placeholder]}) }}}}"
+
+    compiled = re_placeholder.sub(restore, html)
+    # Jinja2 drops the last newline of the compiled template as of any template
+    return compiled if env.keep_trailing_newline else f"{compiled}\n"
+
+
+class MarkdownTemplate:
+    """Markdown Jinja2 template compiled to an HTML Jinja2 template by compile_markdown.
+    Documents are rendered by the compiled template, without converting Markdown to HTML
+    for each one, except those with values that Markdown could render other than as
+    plain text, such as names with asterisks, which are rendered by the Markdown template
+    and mistune. If the template cannot be compiled, all documents are rendered that way.
+
+    Args:
+        template (jinja2.Template): Markdown template.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.compiled = None
+        env = template.environment
+        try:
+            source, _, _ = env.loader.get_source(env, template.name)
+            with tracer.span("compile markdown"):
+                self.compiled = env.from_string(
+                    compile_markdown(source, env),
+                    globals={"_md_text": text_value, "_md_raw": raw_value},
+                )
+        except (NotCompilable, TemplateSyntaxError) as e:
+            con.log(
+                f"{template.name} is converted from Markdown for each document: {e}"
+            )
+
+    def render(self, **context) -> str:
+        """Render the template to HTML.
+
+        Args:
+            **context: Template variables.
+
+        Returns:
+            str: HTML content of the document.
+        """
+        if self.compiled is not None:
+            try:
+                return self.compiled.render(**context)
+            except NotCompilable:
+                pass
+        content = self.template.render(**context)
+        with tracer.span("mistune.html"):
+            return mistune.html(content)
@@ -1,10 +1,14 @@
 from os.path import isfile
 from math import isclose
+from bisect import bisect_left
 import polars as pl
-import pendulum
 from rich.console import Console
 
 
+from excelcache import cached_read_excel, cached_scan_excel
+from tracing import traced
+
+
 con = Console()
 
 
@@ -47,15 +51,164 @@ def fmt_indian(n: float, currency: str = "₹", trunc: bool = True):
     return c
 
 
+def fmt_indian_expr(expr: pl.Expr, currency: str = "₹") -> pl.Expr:
+    """
+    Polars expression that formats a numeric column in Indian currency format. This is the
+    vectorized equivalent of fmt_indian with trunc=True: amounts are truncated to integers,
+    grouped in lakhs and crores and suffixed with "/-", and null or zero amounts are
+    formatted as "-NIL-".
+
+    Args:
+        expr (pl.Expr): Expression for the numeric column to format.
+        currency (str): The currency symbol to use. Default is "₹".
+
+    Returns:
+        pl.Expr: String expression with the formatted amounts, to be aliased by the caller.
+    """
+    n = expr.cast(pl.Float64).cast(pl.Int64)
+    units = n.abs() % 1000
+    rest = n.abs() // 1000
+    # Two digit groups of lakhs, crores, etc., built arithmetically from the most
+    # significant group down, zero padded except for the leading group
+    groups = []
+    for i in range(7, -1, -1):
+        group = ((rest // 100**i) % 100).cast(pl.String)
+        groups.append(
+            pl.when(rest >= 100 ** (i + 1))
+            .then(pl.concat_str(group.str.zfill(2), pl.lit(",")))
+            .when(rest >= 100**i)
+            .then(pl.concat_str(group, pl.lit(",")))
+            .otherwise(pl.lit(""))
+        )
+    units = (
+        pl.when(rest > 0)
+        .then(units.cast(pl.String).str.zfill(3))
+        .otherwise(units.cast(pl.String))
+    )
+    sign = pl.when(n < 0).then(pl.lit("-")).otherwise(pl.lit(""))
+    return (
+        pl.when(expr.is_null() | (expr == 0))
+        .then(pl.lit(f"{currency} -NIL-"))
+        .otherwise(
+            pl.concat_str(pl.lit(f"{currency} "), sign, *groups, units, pl.lit("/-"))
+        )
+    )
+
+
+def long_date_expr(expr: pl.Expr) -> pl.Expr:
+    """
+    Polars expression that formats a date column in the long format "Do [day of] MMMM, YYYY",
+    for example "1st day of March, 2025".
+
+    Args:
+        expr (pl.Expr): Expression for the date or datetime column to format.
+
+    Returns:
+        pl.Expr: String expression with the formatted dates, to be aliased by the caller.
+    """
+    day = expr.dt.day()
+    suffix = (
+        pl.when((day % 100).is_between(11, 13))
+        .then(pl.lit("th"))
+        .when(day % 10 == 1)
+        .then(pl.lit("st"))
+        .when(day % 10 == 2)
+        .then(pl.lit("nd"))
+        .when(day % 10 == 3)
+        .then(pl.lit("rd"))
+        .otherwise(pl.lit("th"))
+    )
+    return pl.concat_str(
+        day.cast(pl.String), suffix, pl.lit(" day of "), expr.dt.strftime("%B, %Y")
+    )
+
+
+class PrefixIndex:
+    """
+    Index of names for prefix lookup. The names are sorted once so that the names starting
+    with a prefix form a contiguous range found by binary search, and a sparse table of
+    the original positions over the sorted names gives the first name in the original
+    order within that range in constant time. A lookup therefore costs O(log M) for M names.
+
+    Args:
+        names (list[str]): The names to index, in order of preference.
+    """
+
+    def __init__(self, names: list[str]):
+        self.names = names
+        self.order = sorted(range(len(names)), key=names.__getitem__)
+        self.sorted_names = [names[i] for i in self.order]
+        # table[k][i] is the smallest original position among sorted_names[i : i + 2**k]
+        self.table = [self.order]
+        k = 1
+        while 2**k <= len(names):
+            prev = self.table[-1]
+            half = 2 ** (k - 1)
+            self.table.append(
+                [min(prev[i], prev[i + half]) for i in range(len(names) - 2**k + 1)]
+            )
+            k += 1
+
+    def span(self, prefix: str) -> tuple[int, int]:
+        """
+        Range of positions in the sorted names of the names starting with prefix.
+
+        Args:
+            prefix (str): The prefix to look up.
+
+        Returns:
+            tuple[int, int]: Start and stop positions of the range.
+        """
+        lo = bisect_left(self.sorted_names, prefix)
+        hi = bisect_left(self.sorted_names, prefix + "\U0010ffff", lo)
+        return lo, hi
+
+    def first(self, prefix: str) -> str | None:
+        """
+        The first name, in the original order, that starts with prefix.
+
+        Args:
+            prefix (str): The prefix to look up.
+
+        Returns:
+            str | None: The matching name, or None if no name starts with prefix.
+        """
+        lo, hi = self.span(prefix)
+        if lo == hi:
+            return None
+        k = (hi - lo).bit_length() - 1
+        pos = min(self.table[k][lo], self.table[k][hi - 2**k])
+        return self.names[pos]
+
+    def candidates(self, prefix: str) -> list[str]:
+        """
+        All the names that start with prefix, in the original order.
+
+        Args:
+            prefix (str): The prefix to look up.
+
+        Returns:
+            list[str]: The matching names.
+        """
+        lo, hi = self.span(prefix)
+        return [self.names[i] for i in sorted(self.order[lo:hi])]
+
+
 # ---- Functions for preparing data to be merged into docx MergeFields ----
 
 
-def read_excel(fname: str) -> pl.DataFrame:
+@traced("read_excel")
+def read_excel(
+    fname: str, sheet_name: str | None = None, cache: bool = True
+) -> pl.DataFrame:
     """
     Read an Excel file and return a DataFrame.
 
     Args:
         fname (str): The path to the Excel file.
+        sheet_name (str | None): Sheet to read, None for the first sheet. Default is None.
+        cache (bool): If True, read the parsed sheet from the on-disk cache when the file
+            is unchanged. Default is True.
 
     Returns:
         pl.DataFrame: A DataFrame containing the data from the Excel file.
@@ -63,12 +216,39 @@ def read_excel(fname: str) -> pl.DataFrame:
     Raises:
         FileNotFoundError: If the file does not exist."""
     if isfile(fname):
-        df = pl.read_excel(fname)
+        if cache:
+            return cached_read_excel(fname, sheet_name)
+        df = pl.read_excel(fname, sheet_name=sheet_name)
         return df
     else:
         raise FileNotFoundError(f"{fname}: File not found")
 
 
+def scan_excel(
+    fname: str, sheet_name: str | None = None, cache: bool = True
+) -> pl.LazyFrame:
+    """
+    Scan an Excel file. The parsed sheet is scanned from the on-disk cache, so that a query
+    reads only what it needs; without the cache the whole sheet is read.
+
+    Args:
+        fname (str): The path to the Excel file.
+        sheet_name (str | None): Sheet to read, None for the first sheet. Default is None.
+        cache (bool): If True, scan the parsed sheet from the on-disk cache. Default is
+            True.
+
+    Returns:
+        pl.LazyFrame: A LazyFrame of the data from the Excel file.
+
+    Raises:
+        FileNotFoundError: If the file does not exist."""
+    if not isfile(fname):
+        raise FileNotFoundError(f"{fname}: File not found")
+    if cache:
+        return cached_scan_excel(fname, sheet_name)
+    return pl.read_excel(fname, sheet_name=sheet_name).lazy()
+
+
 def read_csv(fname: str) -> pl.DataFrame:
     """
     Read a CSV file and return a DataFrame.
@@ -93,6 +273,7 @@ def read_data(
     exhibitor_fname: str,
     theatre_fname: str,
     verbose: bool = False,
+    cache: bool = True,
 ):
     """
     Read data from Excel files and return DataFrames.
@@ -103,6 +284,8 @@ def read_data(
         theatre_fname (str): The path to the theatre Excel file.
         verbose (bool): If True, print the names of the files being read.
             Default is False.
+        cache (bool): If True, read unchanged files from the on-disk cache.
+            Default is True.
 
     Returns:
         distributors (pl.DataFrame): A DataFrame containing distributor data.
@@ -114,29 +297,64 @@ def read_data(
     """
     if verbose:
         print(f"Reading: {distributor_fname}")
-    distributors = read_excel(distributor_fname)
+    distributors = read_excel(distributor_fname, cache=cache)
     if verbose:
         print(f"Reading: {exhibitor_fname}")
-    exhibitors = read_excel(exhibitor_fname)
+    exhibitors = read_excel(exhibitor_fname, cache=cache)
     if verbose:
         print(f"Reading: {theatre_fname}")
-    theatres = read_excel(theatre_fname)
+    theatres = read_excel(theatre_fname, cache=cache)
 
     return distributors, exhibitors, theatres
 
 
-def clean_distributors_data(df: pl.DataFrame) -> pl.DataFrame:
+def scan_data(
+    distributor_fname: str,
+    exhibitor_fname: str,
+    theatre_fname: str,
+    verbose: bool = False,
+    cache: bool = True,
+):
+    """
+    Lazy equivalent of read_data, for prepare_data_lazy.
+
+    Args:
+        distributor_fname (str): The path to the distributor Excel file.
+        exhibitor_fname (str): The path to the exhibitor Excel file.
+        theatre_fname (str): The path to the theatre Excel file.
+        verbose (bool): If True, print the names of the files being read.
+            Default is False.
+        cache (bool): If True, scan the files from the on-disk cache. Default is True.
+
+    Returns:
+        distributors (pl.LazyFrame): Distributor data.
+        exhibitors (pl.LazyFrame): Exhibitor data.
+        theatres (pl.LazyFrame): Theatre data.
+
+    Raises:
+        FileNotFoundError: If any of the files do not exist.
+    """
+    frames = []
+    for fname in (distributor_fname, exhibitor_fname, theatre_fname):
+        if verbose:
+            print(f"Reading: {fname}")
+        frames.append(scan_excel(fname, cache=cache))
+    return tuple(frames)
+
+
+def clean_distributors_data(df: pl.DataFrame, row: int = 0) -> pl.DataFrame:
     """
-    Returns all the columns of the initial row of the DataFrame,
-        assuming it is the only one we want..
+    Returns all the columns of one row of the DataFrame, the initial row unless another
+        distributor is selected.
 
     Args:
         df (pl.DataFrame): The DataFrame containing distributor data.
+        row (int): Index of the distributor row. Default is 0.
 
     Returns:
         pl.DataFrame: The cleaned DataFrame with uppercase columns.
     """
-    return df[0]
+    return df[row]
 
 
 def clean_exhibitors_data(df: pl.DataFrame) -> pl.DataFrame:
@@ -168,19 +386,9 @@ def clean_theatres_data(df: pl.DataFrame) -> pl.DataFrame:
     df = df.with_columns(
         pl.col("theatre").str.to_uppercase(),
         pl.col("station").str.to_uppercase(),
-        pl.col("release_date")
-        .map_elements(
-            lambda dt: pendulum.instance(dt).format("Do [day of] MMMM, YYYY"),
-            return_dtype=pl.String,
-        )
-        .alias("release_date_long"),
-        pl.col("agreement_date")
-        .map_elements(
-            lambda dt: pendulum.instance(dt).format("Do [day of] MMMM, YYYY"),
-            return_dtype=pl.String,
-        )
-        .alias("agreement_date_long"),
-        pl.col("mg").map_elements(fmt_indian, return_dtype=pl.String).alias("mg_str"),
+        long_date_expr(pl.col("release_date")).alias("release_date_long"),
+        long_date_expr(pl.col("agreement_date")).alias("agreement_date_long"),
+        fmt_indian_expr(pl.col("mg")).alias("mg_str"),
         pl.col("theatre_share").fill_null("-Nil-"),
         pl.col("release_date").dt.strftime("%d-%m-%Y"),
         pl.col("agreement_date").dt.strftime("%d-%m-%Y"),
@@ -210,9 +418,56 @@ def clean_data(
     return distributors, exhibitors, theatres
 
 
+def match_exhibitors(exhibitors: pl.DataFrame, theatres: pl.DataFrame):
+    """
+    Match the exhibitor prefix of each theatre with the first exhibitor whose name starts
+    with it, ignoring case, using a PrefixIndex over the exhibitor names.
+
+    Args:
+        exhibitors (pl.DataFrame): The DataFrame containing exhibitor data.
+        theatres (pl.DataFrame): The DataFrame containing theatre data.
+
+    Returns:
+        theatres (pl.DataFrame): The theatres with the matched lowercase exhibitor name in
+            column ex_a, null where there is no match.
+        unmatched (pl.DataFrame): The theatres whose prefix matches no exhibitor.
+        ambiguous (pl.DataFrame): The prefixes that match more than one exhibitor, with the
+            exhibitor chosen in column ex_a and all candidates in column candidates.
+    """
+    names = exhibitors["exhibitor"].drop_nulls().str.to_lowercase().to_list()
+    index = PrefixIndex(names)
+    prefixes = theatres["exhibitor"].drop_nulls().unique(maintain_order=True)
+    prefixes = prefixes.str.to_lowercase().unique(maintain_order=True).to_list()
+    matches = {prefix: index.first(prefix) for prefix in prefixes}
+    theatres = theatres.with_columns(
+        pl.col("exhibitor")
+        .str.to_lowercase()
+        .replace_strict(matches, default=None, return_dtype=pl.String)
+        .alias("ex_a")
+    )
+    unmatched = theatres.filter(pl.col("ex_a").is_null())
+    # Only the prefixes whose range holds more than one name need their candidates listed
+    ambiguous = [
+        (prefix, matches[prefix], index.candidates(prefix))
+        for prefix in prefixes
+        if (span := index.span(prefix))[1] - span[0] > 1
+    ]
+    ambiguous = pl.DataFrame(
+        ambiguous,
+        schema={
+            "exhibitor": pl.String,
+            "ex_a": pl.String,
+            "candidates": pl.List(pl.String),
+        },
+        orient="row",
+    )
+    return theatres, unmatched, ambiguous
+
+
 def join_data(exhibitors: pl.DataFrame, theatres: pl.DataFrame) -> pl.DataFrame:
     """
-    Join the exhibitors and theatres DataFrames on the exhibitor column.
+    Join the exhibitors and theatres DataFrames on the exhibitor column. Theatres whose
+    exhibitor prefix matches no exhibitor, or more than one, are reported on the console.
 
     Args:
         exhibitors (pl.DataFrame): The DataFrame containing exhibitor data.
@@ -224,21 +479,20 @@ def join_data(exhibitors: pl.DataFrame, theatres: pl.DataFrame) -> pl.DataFrame:
     exhibitors = exhibitors.with_columns(
         pl.col("exhibitor").str.to_lowercase().alias("ex_b"),
     )
-    theatres = theatres.with_columns(
-        pl.col("exhibitor")
-        .str.to_lowercase()
-        .map_elements(
-            lambda x: next((ex for ex in exhibitors["ex_b"] if ex.startswith(x)), None),
-            return_dtype=pl.String,
-        )
-        .alias("ex_a")
+    theatres, unmatched, ambiguous = match_exhibitors(exhibitors, theatres)
+    for row in unmatched.select("exhibitor", "theatre", "station").iter_rows():
+        con.log(f"No exhibitor matches '{row[0]}', skipped {row[1]}, {row[2]}")
+    for row in ambiguous.iter_rows():
+        con.log(f"'{row[0]}' matches {len(row[2])} exhibitors, using '{row[1]}'")
+    df = theatres.join(
+        exhibitors, left_on="ex_a", right_on="ex_b", how="inner", maintain_order="left"
     )
-    df = theatres.join(exhibitors, left_on="ex_a", right_on="ex_b", how="inner")
     df = df.drop("exhibitor", "ex_a")
     df = df.rename({"exhibitor_right": "exhibitor"})
     return df
 
 
+@traced("prepare_data")
 def prepare_data(
     distributors: pl.DataFrame, exhibitors: pl.DataFrame, theatres: pl.DataFrame
 ):
@@ -259,6 +513,121 @@ def prepare_data(
     return distributors, df
 
 
+def exhibitor_index(exhibitors: pl.LazyFrame) -> PrefixIndex:
+    """
+    Build the PrefixIndex of the lowercase exhibitor names used by join_data_lazy.
+
+    Args:
+        exhibitors (pl.LazyFrame): The LazyFrame containing exhibitor data.
+
+    Returns:
+        PrefixIndex: Index of the exhibitor names.
+    """
+    names = exhibitors.select(pl.col("exhibitor").str.to_lowercase()).collect()
+    return PrefixIndex(names["exhibitor"].drop_nulls().to_list())
+
+
+def join_data_lazy(
+    exhibitors: pl.LazyFrame,
+    theatres: pl.LazyFrame,
+    index: PrefixIndex | None = None,
+) -> pl.LazyFrame:
+    """
+    Lazy equivalent of join_data. The exhibitors master file is small and is collected to
+    build a PrefixIndex, while the theatres are matched inside the query plan. Theatres whose
+    exhibitor prefix matches no exhibitor, or more than one, are reported on the console
+    when the plan is collected.
+
+    Args:
+        exhibitors (pl.LazyFrame): The LazyFrame containing exhibitor data.
+        theatres (pl.LazyFrame): The LazyFrame containing theatre data.
+        index (PrefixIndex | None): Index of the lowercase exhibitor names, built from
+            exhibitors if None, for callers that join many batches of theatres with the
+            same exhibitors. Default is None.
+
+    Returns:
+        pl.LazyFrame: A LazyFrame containing the joined data.
+    """
+    exhibitors = exhibitors.with_columns(
+        pl.col("exhibitor").str.to_lowercase().alias("ex_b"),
+    )
+    if index is None:
+        index = exhibitor_index(exhibitors)
+
+    def match(rows: pl.Series) -> pl.Series:
+        rows = rows.struct.unnest()
+        prefixes = rows["exhibitor"].str.to_lowercase()
+        spans = {
+            prefix: index.span(prefix)
+            for prefix in prefixes.drop_nulls().unique(maintain_order=True)
+        }
+        matches = {prefix: index.first(prefix) for prefix in spans}
+        ex_a = prefixes.replace_strict(matches, default=None, return_dtype=pl.String)
+        unmatched = rows.filter(ex_a.is_null())
+        for row in unmatched.select("exhibitor", "theatre", "station").iter_rows():
+            con.log(f"No exhibitor matches '{row[0]}', skipped {row[1]}, {row[2]}")
+        for prefix, (lo, hi) in spans.items():
+            if hi - lo > 1:
+                con.log(
+                    f"'{prefix}' matches {hi - lo} exhibitors, using '{matches[prefix]}'"
+                )
+        return ex_a
+
+    theatres = theatres.with_columns(
+        pl.struct("exhibitor", "theatre", "station")
+        .map_batches(match, return_dtype=pl.String)
+        .alias("ex_a")
+    )
+    df = theatres.join(
+        exhibitors, left_on="ex_a", right_on="ex_b", how="inner", maintain_order="left"
+    )
+    df = df.drop("exhibitor", "ex_a")
+    df = df.rename({"exhibitor_right": "exhibitor"})
+    return df
+
+
+def prepare_data_lazy(
+    distributors: pl.DataFrame | pl.LazyFrame,
+    exhibitors: pl.DataFrame | pl.LazyFrame,
+    theatres: pl.DataFrame | pl.LazyFrame,
+    group_cols: list[str],
+    distributor_row: int = 0,
+):
+    """
+    Prepare the data as a single lazy query that cleans and joins the data and numbers the
+    groups in order of first appearance. Column _group holds the group number, starting at
+    1, and column _num_groups the number of groups, so that the group count is computed in
+    the same plan instead of a separate pass over the data. The work is done when the
+    returned query is collected, which callers record as the prepare_data span.
+
+    Args:
+        distributors (pl.DataFrame | pl.LazyFrame): Distributor data.
+        exhibitors (pl.DataFrame | pl.LazyFrame): Exhibitor data.
+        theatres (pl.DataFrame | pl.LazyFrame): Theatre data.
+        group_cols (list[str]): The columns to group by.
+        distributor_row (int): Index of the distributor row to use. Default is 0.
+
+    Returns:
+        distributors (pl.DataFrame): The cleaned DataFrame with distributor data.
+        df (pl.LazyFrame): A LazyFrame of the joined data sorted by group.
+    """
+    distributors = clean_distributors_data(
+        distributors.lazy().head(distributor_row + 1).collect(), distributor_row
+    )
+    exhibitors = clean_exhibitors_data(exhibitors.lazy())
+    theatres = clean_theatres_data(theatres.lazy())
+    df = join_data_lazy(exhibitors, theatres)
+    df = (
+        df.with_columns(
+            pl.struct(group_cols).is_first_distinct().cum_sum().alias("_group")
+        )
+        .with_columns(pl.col("_group").first().over(group_cols))
+        .with_columns(pl.col("_group").max().alias("_num_groups"))
+        .sort("_group", maintain_order=True)
+    )
+    return distributors, df
+
+
 def group_data(df: pl.DataFrame, group_cols: list[str]):
     """
     Group the DataFrame by the specified columns and maintain the order.
@@ -272,6 +641,43 @@ def group_data(df: pl.DataFrame, group_cols: list[str]):
     return df.group_by(group_cols, maintain_order=True)
 
 
+def index_groups(df: pl.DataFrame, group_cols: list[str]) -> dict[tuple, pl.DataFrame]:
+    """
+    Index the groups of the DataFrame by their key, so that a single group can be looked up
+    without iterating over group_data.
+
+    Args:
+        df (pl.DataFrame): The DataFrame to group.
+        group_cols (list[str]): The columns to group by.
+
+    Returns:
+        dict[tuple, pl.DataFrame]: The DataFrame of each group, keyed by the tuple of the
+            values of group_cols, in order of first appearance.
+    """
+    return df.partition_by(group_cols, as_dict=True, maintain_order=True)
+
+
+def extract_group_data(
+    index: dict[tuple, pl.DataFrame], key: tuple
+) -> tuple[dict[str, str], list[dict[str, str]]]:
+    """
+    Extract the exhibitor data and annexure data of one group of an index.
+
+    Args:
+        index (dict[tuple, pl.DataFrame]): The index returned by index_groups.
+        key (tuple): The key of the group.
+
+    Returns:
+        tuple[dict[str, str], list[dict[str, str]]]: Exhibitor data and annexure data of
+            the group.
+
+    Raises:
+        KeyError: If there is no group with the key.
+    """
+    group = index[tuple(key)]
+    return extract_exhibitor_data(key, group), extract_annexure_data(group)
+
+
 def unique_rows(df: pl.DataFrame, cols: str | list[str]) -> int:
     """
     Count the number of unique rows in the DataFrame based on the specified columns.
@@ -286,6 +692,7 @@ def unique_rows(df: pl.DataFrame, cols: str | list[str]) -> int:
     return df.select(cols).unique().height
 
 
+@traced("extract_distributor_data")
 def extract_distributor_data(distributors) -> list[dict[str, str]]:
     """
     Extract distributor data from the DataFrame.
@@ -299,6 +706,7 @@ def extract_distributor_data(distributors) -> list[dict[str, str]]:
     return distributors.to_dicts()[0]
 
 
+@traced("extract_exhibitor_data")
 def extract_exhibitor_data(key, group) -> dict[str, str]:
     """
     Extract exhibitor data from the grouped DataFrame.
@@ -327,6 +735,7 @@ def extract_exhibitor_data(key, group) -> dict[str, str]:
     return data
 
 
+@traced("extract_annexure_data")
 def extract_annexure_data(g_theatres) -> list[dict[str, str]]:
     """
     Extract annexure data from the grouped DataFrame to fill the table of annexures in the template.
@@ -344,6 +753,63 @@ def extract_annexure_data(g_theatres) -> list[dict[str, str]]:
     return annexure.to_dicts()
 
 
+@traced("extract_payloads")
+def extract_payloads(
+    df: pl.DataFrame, group_cols: list[str]
+) -> list[tuple[dict[str, str], list[dict[str, str]]]]:
+    """
+    Extract the exhibitor data and annexure data of every group at once. The header fields
+    and advance totals of all the groups are computed by a single aggregation, and the
+    annexure rows of all the groups are sorted and numbered in one pass and then split by
+    group. The result is identical to calling extract_exhibitor_data and
+    extract_annexure_data on each group of group_data(df, group_cols).
+
+    Args:
+        df (pl.DataFrame): The prepared DataFrame, as returned by prepare_data or collected
+            from prepare_data_lazy.
+        group_cols (list[str]): The columns to group by, in the order exhibitor,
+            exhibitor_place, movie, release_date, agreement_date.
+
+    Returns:
+        list[tuple[dict[str, str], list[dict[str, str]]]]: Exhibitor data and annexure data
+            of each group, in order of first appearance of the group.
+    """
+    if "_group" not in df.columns:
+        df = df.with_columns(
+            pl.struct(group_cols).is_first_distinct().cum_sum().alias("_group")
+        ).with_columns(pl.col("_group").first().over(group_cols))
+    header = (
+        df.group_by("_group", maintain_order=True)
+        .agg(
+            *[pl.col(col).first() for col in group_cols],
+            pl.col("release_date_long").first(),
+            pl.col("agreement_date_long").first(),
+            fmt_indian_expr(pl.col("advance_amt").sum()).alias("advance_amt"),
+            pl.col("exhibitor_gst").first(),
+            pl.col("movie_description").first(),
+            pl.col("daily_shows").first(),
+            pl.len().alias("_len"),
+        )
+        .sort("_group")
+    )
+    annexure = (
+        df.select("_group", "theatre", "station", "mg_str", "theatre_share")
+        .sort("_group", "station", "theatre", maintain_order=True)
+        .with_columns(pl.int_range(1, pl.len() + 1).over("_group").alias("slno"))
+        .drop("_group")
+        .to_dicts()
+    )
+    payloads = []
+    start = 0
+    lengths = header["_len"].to_list()
+    for exhibitor_data, length in zip(
+        header.drop("_group", "_len").to_dicts(), lengths
+    ):
+        payloads.append((exhibitor_data, annexure[start : start + length]))
+        start += length
+    return payloads
+
+
 if __name__ == "__main__":
     distributors_fname = "distributors.xlsx"
     exhibitors_fname = "exhibitors.xlsx"
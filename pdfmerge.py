@@ -0,0 +1,118 @@
+import hashlib
+from io import BytesIO
+
+
+import pikepdf
+
+
+from tracing import tracer
+
+
+FONT_FILE_KEYS = ("/FontFile", "/FontFile2", "/FontFile3")
+
+
+class PdfMerger:
+    """Merge agreement documents into one PDF, with an outline entry for each document.
+    Font programs and images that are identical in several documents are stored once, and
+    the merged PDF is written with compressed object streams.
+
+    The source documents are kept open until the merged PDF is saved, since the copied
+    pages read their stream data from them.
+    """
+
+    def __init__(self, pdf_fname: str):
+        self.pdf_fname = pdf_fname
+        self.pdf = pikepdf.new()
+        self.sources = []
+        self.bookmarks = []
+        self.streams = {}
+
+    def append(self, pdf, title: str):
+        """Append the pages of a PDF document and add an outline entry for it.
+
+        Args:
+            pdf (bytes | str): PDF document as bytes, or its file name.
+            title (str): Title of the outline entry.
+
+        Returns:
+            None
+        """
+        with tracer.span("merge_pdf"):
+            if isinstance(pdf, str):
+                # Read the file, so that no file handle is held until the merged PDF is saved
+                with open(pdf, "rb") as f:
+                    pdf = f.read()
+            src = pikepdf.open(BytesIO(pdf))
+            self.sources.append(src)
+            start = len(self.pdf.pages)
+            self.pdf.pages.extend(src.pages)
+            self.bookmarks.append((title, start))
+            for page in self.pdf.pages[start:]:
+                self.dedup_resources(page.obj.get("/Resources"))
+
+    def dedup_resources(self, resources):
+        """Replace the font programs and images of a page's resources with identical ones
+        already in the merged PDF.
+
+        Args:
+            resources (pikepdf.Dictionary | None): Resources dictionary of a page.
+
+        Returns:
+            None
+        """
+        if resources is None:
+            return
+        for font in resources.get("/Font", {}).values():
+            descendants = font.get("/DescendantFonts", [])
+            for f in [font, *descendants]:
+                descriptor = f.get("/FontDescriptor")
+                if descriptor is None:
+                    continue
+                for key in FONT_FILE_KEYS:
+                    if key in descriptor:
+                        descriptor[key] = self.shared(descriptor[key])
+        xobjects = resources.get("/XObject", {})
+        for name in list(xobjects.keys()):
+            xobject = xobjects[name]
+            if xobject.get("/Subtype") == pikepdf.Name.Image:
+                if "/SMask" in xobject:
+                    xobject.SMask = self.shared(xobject.SMask)
+                xobjects[name] = self.shared(xobject)
+            elif xobject.get("/Subtype") == pikepdf.Name.Form:
+                self.dedup_resources(xobject.get("/Resources"))
+
+    def shared(self, stream: pikepdf.Stream) -> pikepdf.Stream:
+        """Return the first stream appended with the same data and dictionary as stream.
+
+        Args:
+            stream (pikepdf.Stream): Font program or image stream.
+
+        Returns:
+            pikepdf.Stream: Stream to be referred to in place of stream.
+        """
+        h = hashlib.sha256(stream.read_raw_bytes())
+        for key, value in sorted(stream.items()):
+            h.update(f"{key}={value!r}".encode("utf-8"))
+        return self.streams.setdefault(h.hexdigest(), stream)
+
+    def save(self) -> int:
+        """Write the merged PDF. Objects no longer referred to after deduplication are not
+        written.
+
+        Returns:
+            int: Number of pages in the merged PDF.
+        """
+        with tracer.span("save_merged_pdf"):
+            with self.pdf.open_outline() as outline:
+                for title, page in self.bookmarks:
+                    outline.root.append(pikepdf.OutlineItem(title, page))
+            self.pdf.save(
+                self.pdf_fname,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+            )
+            pages = len(self.pdf.pages)
+            for src in self.sources:
+                src.close()
+            self.sources = []
+        return pages
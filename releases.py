@@ -0,0 +1,163 @@
+import os
+import tomllib
+from os.path import dirname, join, normpath
+
+
+import polars as pl
+
+
+from tracing import tracer
+from utils import get_fname
+from mergedata import (
+    read_excel,
+    clean_exhibitors_data,
+    prepare_data_lazy,
+    extract_distributor_data,
+    extract_payloads,
+)
+
+
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+FNAME_TPL = "{count:02}_{movie}_{exhibitor}_{release_date}"
+# Settings of a release manifest and their defaults, each of which a release may override
+# except the template and stylesheet, which are shared by the worker pool
+DEFAULTS = {
+    "template": "agreement_template.docx",
+    "css": "agreement.css",
+    "distributor": "distributors.xlsx",
+    "exhibitor": "exhibitors.xlsx",
+    "distributor_row": 0,
+    "output_dir": ".",
+}
+
+
+def load_releases(manifest_fname: str) -> tuple[dict, list[dict]]:
+    """Read a release manifest in TOML format. Top level keys give the defaults of the
+    releases, and each [[release]] table gives the theatres workbook of one release, and
+    optionally the sheet to read, the distributor row and the output directory:
+
+        template = "agreement_template.html.jinja"
+        distributor = "distributors.xlsx"
+
+        [[release]]
+        theatre = "chhaava_theatres.xlsx"
+        output_dir = "chhaava"
+
+        [[release]]
+        theatre = "week_15.xlsx"
+        sheet = "Sikandar"
+        distributor_row = 1
+
+    Relative file names are relative to the directory of the manifest.
+
+    Args:
+        manifest_fname (str): Manifest file name.
+
+    Returns:
+        tuple[dict, list[dict]]: The manifest settings, and the settings of each release
+            with the defaults filled in.
+
+    Raises:
+        ValueError: If the manifest has no releases, a release has no theatre workbook, or
+            a release overrides the template or stylesheet.
+    """
+    with open(manifest_fname, "rb") as f:
+        manifest = tomllib.load(f)
+    base_dir = dirname(manifest_fname)
+    settings = {key: manifest.get(key, value) for key, value in DEFAULTS.items()}
+    releases = []
+    for i, entry in enumerate(manifest.get("release", []), start=1):
+        if "theatre" not in entry:
+            raise ValueError(f"{manifest_fname}: release {i} has no theatre workbook")
+        if "template" in entry or "css" in entry:
+            raise ValueError(
+                f"{manifest_fname}: release {i} sets the template or stylesheet, which are shared by all releases"
+            )
+        release = {**settings, "sheet": None, **entry}
+        releases.append(release)
+    if not releases:
+        raise ValueError(f"{manifest_fname}: no [[release]] tables")
+    for item in [settings, *releases]:
+        for key in ("template", "css", "distributor", "exhibitor", "theatre"):
+            if key in item:
+                item[key] = join(base_dir, item[key])
+        item["output_dir"] = join(base_dir, item["output_dir"])
+    return settings, releases
+
+
+def prepare_releases(
+    releases: list[dict], cache: bool = True
+) -> list[tuple[dict, list[tuple]]]:
+    """Read and prepare the data of several releases. Each workbook and sheet is read once,
+    however many releases use it, the exhibitors are cleaned once, and the queries of all
+    the releases are collected together so that Polars runs their common parts once.
+
+    Args:
+        releases (list[dict]): Release settings, as returned by load_releases.
+        cache (bool): If True, read unchanged files from the on-disk cache. Default is
+            True.
+
+    Returns:
+        list[tuple[dict, list[tuple]]]: For each release, the distributor data, and the
+            output file name without suffix, exhibitor data and annexure data of each
+            document.
+
+    Raises:
+        ValueError: If a distributor row is not in the distributor workbook.
+    """
+    sheets = {}
+
+    def read(fname: str, sheet_name: str | None = None) -> pl.DataFrame:
+        if (fname, sheet_name) not in sheets:
+            sheets[fname, sheet_name] = read_excel(fname, sheet_name, cache=cache)
+        return sheets[fname, sheet_name]
+
+    cleaned = {}
+    distributors_list = []
+    queries = []
+    for release in releases:
+        distributors = read(release["distributor"])
+        row = release["distributor_row"]
+        if not 0 <= row < distributors.height:
+            raise ValueError(
+                f"{release['distributor']}: no distributor row {row}, the workbook has {distributors.height}"
+            )
+        if release["exhibitor"] not in cleaned:
+            cleaned[release["exhibitor"]] = clean_exhibitors_data(
+                read(release["exhibitor"])
+            )
+        distributors, df = prepare_data_lazy(
+            distributors,
+            cleaned[release["exhibitor"]],
+            read(release["theatre"], release["sheet"]),
+            GROUP_COLS,
+            distributor_row=row,
+        )
+        distributors_list.append(distributors)
+        queries.append(df)
+    with tracer.span("prepare_data"):
+        frames = pl.collect_all(queries)
+
+    prepared = []
+    for release, distributors, df in zip(releases, distributors_list, frames):
+        docs = []
+        for count, (exhibitor_data, annexure) in enumerate(
+            extract_payloads(df, GROUP_COLS), start=1
+        ):
+            output_fname = get_fname(
+                FNAME_TPL,
+                count=count,
+                movie=exhibitor_data["movie"].lower(),
+                exhibitor=exhibitor_data["exhibitor"],
+                release_date=exhibitor_data["release_date"],
+            )
+            docs.append(
+                (
+                    normpath(join(release["output_dir"], output_fname)),
+                    exhibitor_data,
+                    annexure,
+                )
+            )
+        os.makedirs(release["output_dir"], exist_ok=True)
+        prepared.append((extract_distributor_data(distributors), docs))
+    return prepared
@@ -0,0 +1,423 @@
+import gc
+import os
+import sys
+import queue
+import tempfile
+import threading
+from concurrent.futures import (
+    ALL_COMPLETED,
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    wait,
+)
+from typing import Callable, Iterable, Iterator
+
+
+import polars as pl
+
+
+from tracing import tracer
+from utils import get_fname, tpl_suffix
+from mergedata import (
+    read_excel,
+    clean_distributors_data,
+    clean_exhibitors_data,
+    clean_theatres_data,
+    exhibitor_index,
+    join_data_lazy,
+    extract_distributor_data,
+    extract_payloads,
+)
+
+
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+FNAME_TPL = "{count:02}_{movie}_{exhibitor}_{release_date}"
+# Documents prepared ahead of the render stage
+STREAM_QUEUE_SIZE = 32
+# Number of .docx files converted by one soffice invocation
+DOCX_CHUNK_SIZE = 50
+
+_DONE = object()
+
+
+def current_rss() -> int:
+    """Resident set size of this process, read from /proc on Linux and approximated by the
+    peak resident set size elsewhere.
+
+    Returns:
+        int: Resident set size in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process, 0 where it is not available, as on Windows.
+
+    Returns:
+        int: Peak resident set size in bytes.
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def iter_theatre_batches(
+    fname: str, batch_rows: int, cache: bool = True
+) -> Iterator[pl.DataFrame]:
+    """Read the theatres data in batches of rows. A .csv file is read batch by batch. The
+    parser of .xlsx files reads a whole worksheet at once, so that reading it in batches
+    with skip_rows and n_rows parses the worksheet again for each batch without lowering
+    the peak memory; a workbook is therefore read once and split into batches.
+
+    Args:
+        fname (str): Theatres data in .xlsx or .csv format.
+        batch_rows (int): Number of rows per batch.
+        cache (bool): If True, read an unchanged workbook from the on-disk cache. Default
+            is True.
+
+    Returns:
+        Iterator[pl.DataFrame]: Batches of theatre rows, in order.
+    """
+    if fname.lower().endswith(".csv"):
+        reader = pl.read_csv_batched(fname, batch_size=batch_rows, try_parse_dates=True)
+        while batches := reader.next_batches(1):
+            yield from batches
+    else:
+        df = read_excel(fname, cache=cache)
+        for start in range(0, df.height, batch_rows):
+            yield df.slice(start, batch_rows)
+
+
+def stream_payloads(
+    exhibitors: pl.DataFrame,
+    batches: Iterable[pl.DataFrame],
+    group_cols: list[str] = GROUP_COLS,
+) -> Iterator[tuple[dict, list[dict]]]:
+    """Prepare the exhibitor data and annexure data of each group from batches of theatre
+    rows, yielding each group as soon as it is complete. The rows of a group must be
+    consecutive, as in theatres data sorted by exhibitor, movie and dates, so that a group
+    is complete once a row of another group follows it. The rows of the last group of a
+    batch are carried over to the next batch. The result is the same as that of
+    extract_payloads on the whole prepared data.
+
+    Args:
+        exhibitors (pl.DataFrame): Exhibitor data.
+        batches (Iterable[pl.DataFrame]): Batches of theatre rows, in order.
+        group_cols (list[str]): The columns to group by. Default is GROUP_COLS.
+
+    Returns:
+        Iterator[tuple[dict, list[dict]]]: Exhibitor data and annexure data of each group.
+
+    Raises:
+        ValueError: If the rows of a group are not consecutive.
+    """
+    exhibitors = clean_exhibitors_data(exhibitors.lazy()).collect()
+    index = exhibitor_index(exhibitors.lazy())
+    # Hashes rather than keys of the groups yielded, to keep the set small
+    emitted = set()
+
+    def complete(df: pl.DataFrame):
+        for exhibitor_data, annexure in extract_payloads(df, group_cols):
+            key = tuple(exhibitor_data[col] for col in group_cols)
+            if hash(key) in emitted:
+                raise ValueError(
+                    f"Theatres of {', '.join(map(str, key))} are not consecutive; sort the theatres data by exhibitor, movie and dates"
+                )
+            emitted.add(hash(key))
+            yield exhibitor_data, annexure
+
+    carry = None
+    for batch in batches:
+        with tracer.span("prepare_batch"):
+            df = join_data_lazy(
+                exhibitors.lazy(), clean_theatres_data(batch.lazy()), index
+            ).collect()
+            if carry is not None:
+                df = pl.concat([carry, df], how="vertical_relaxed")
+            if df.height == 0:
+                continue
+            last = df.select(group_cols).row(-1)
+            in_last = pl.all_horizontal(
+                [pl.col(col).eq_missing(value) for col, value in zip(group_cols, last)]
+            )
+            carry = df.filter(in_last)
+            df = df.filter(~in_last)
+        yield from complete(df)
+    if carry is not None:
+        yield from complete(carry)
+
+
+def run_stages(
+    items: Iterable,
+    consume: Callable,
+    queue_size: int = STREAM_QUEUE_SIZE,
+    max_rss: int = 0,
+) -> int:
+    """Produce items in a thread and consume them in the calling thread, through a queue of
+    at most queue_size items, so that the producer is never more than queue_size items
+    ahead. When the resident set size exceeds max_rss, the producer waits for the queue to
+    drain before producing more, and fails if that does not bring it under max_rss.
+
+    Args:
+        items (Iterable): Items, produced lazily in the producer thread.
+        consume (Callable): Called with each item in the calling thread.
+        queue_size (int): Maximum number of items in the queue. Default is
+            STREAM_QUEUE_SIZE.
+        max_rss (int): Resident set size ceiling in bytes, 0 for none. Default is 0.
+
+    Returns:
+        int: Number of items consumed.
+
+    Raises:
+        MemoryError: If the resident set size stays over max_rss with the queue empty.
+    """
+    q = queue.Queue(maxsize=queue_size)
+    # Set when the consumer stops, so that the producer does not wait for it forever
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if max_rss and current_rss() > max_rss:
+                    while not q.empty() and not stop.is_set():
+                        stop.wait(0.05)
+                    gc.collect()
+                    if current_rss() > max_rss:
+                        raise MemoryError(
+                            f"Resident set size {current_rss() / 2**20:.0f} MB is over the ceiling of {max_rss / 2**20:.0f} MB; use smaller batches"
+                        )
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    count = 0
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            consume(item)
+            count += 1
+    finally:
+        stop.set()
+        producer.join()
+    return count
+
+
+class RenderStage:
+    """Render stage of the streaming pipeline: generates the PDF file of each document it
+    is called with, keeping a bounded number of documents in flight.
+
+    Markdown and HTML documents are rendered in the calling process, or by worker
+    processes with at most two documents per worker queued, each worker writing its PDF
+    files. DOCX documents are merged into a temporary directory and converted in chunks
+    of DOCX_CHUNK_SIZE files.
+
+    Args:
+        template_fname (str): Template file name.
+        css_fname (str): CSS file name.
+        workers (int): Number of worker processes, or of soffice invocations for .docx
+            templates. Defaults to 1.
+        callback (Callable | None): Called with the PDF file name of each document
+            generated. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        template_fname: str,
+        css_fname: str,
+        workers: int = 1,
+        callback: Callable | None = None,
+    ):
+        self.template_fname = template_fname
+        self.tpl_type = tpl_suffix(template_fname)
+        self.workers = workers
+        self.callback = callback or (lambda pdf_fname: None)
+        self.executor = None
+        self.pending = set()
+        if self.tpl_type == "docx":
+            from docxmerge import detect_soffice_path
+
+            self.soffice_path, _, _ = detect_soffice_path()
+            self.docx_dir = tempfile.TemporaryDirectory()
+            self.chunk = []
+        elif workers > 1:
+            from htmlmerge import init_render_worker
+
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_render_worker,
+                initargs=(template_fname, self.tpl_type, css_fname, tracer.enabled),
+            )
+        else:
+            from htmlmerge import PdfRenderer
+
+            self.renderer = PdfRenderer(template_fname, self.tpl_type, css_fname)
+
+    def __call__(self, doc: tuple):
+        output_fname, distributor_data, exhibitor_data, annexure = doc
+        pdf_fname = f"{output_fname}.pdf"
+        if self.tpl_type == "docx":
+            from docxmerge import docx_mergefields
+
+            docx_fname = os.path.join(self.docx_dir.name, f"{output_fname}.docx")
+            docx_mergefields(
+                self.template_fname,
+                docx_fname,
+                distributor_data,
+                exhibitor_data,
+                annexure,
+            )
+            self.chunk.append(docx_fname)
+            if len(self.chunk) >= DOCX_CHUNK_SIZE * self.workers:
+                self.convert()
+        elif self.executor:
+            from htmlmerge import render_worker
+
+            if len(self.pending) >= 2 * self.workers:
+                self.collect(FIRST_COMPLETED)
+            self.pending.add(
+                self.executor.submit(
+                    render_worker,
+                    (pdf_fname, distributor_data, exhibitor_data, annexure),
+                )
+            )
+        else:
+            with tracer.document(pdf_fname):
+                self.renderer.write_pdf(
+                    pdf_fname, distributor_data, exhibitor_data, annexure
+                )
+            self.callback(pdf_fname)
+
+    def collect(self, return_when: str = ALL_COMPLETED):
+        """Wait for documents rendered by the worker processes.
+
+        Args:
+            return_when (str): FIRST_COMPLETED or ALL_COMPLETED.
+
+        Returns:
+            None
+        """
+        done, self.pending = wait(self.pending, return_when=return_when)
+        for future in done:
+            pdf_fname, events, _ = future.result()
+            tracer.extend(events)
+            self.callback(pdf_fname)
+
+    def convert(self):
+        """Convert the merged .docx files of the current chunk to PDF and remove them.
+
+        Returns:
+            None
+        """
+        from docxmerge import soffice_docx2pdf_batch
+
+        pdf_fnames = soffice_docx2pdf_batch(
+            self.chunk, self.soffice_path, ".", DOCX_CHUNK_SIZE, self.workers
+        )
+        for docx_fname, pdf_fname in zip(self.chunk, pdf_fnames):
+            os.remove(docx_fname)
+            self.callback(pdf_fname)
+        self.chunk = []
+
+    def close(self):
+        """Finish the documents in flight and release the worker processes.
+
+        Returns:
+            None
+        """
+        if self.tpl_type == "docx":
+            if self.chunk:
+                self.convert()
+            self.docx_dir.cleanup()
+        elif self.executor:
+            self.collect()
+            self.executor.shutdown()
+
+
+def generate_streaming(
+    distributor_fname: str,
+    exhibitor_fname: str,
+    theatre_fname: str,
+    template_fname: str,
+    css_fname: str,
+    batch_rows: int,
+    workers: int = 1,
+    max_rss: int = 0,
+    cache: bool = True,
+    callback: Callable | None = None,
+) -> int:
+    """Generate the agreement documents of theatres data read in batches of rows. Groups
+    are prepared as they are completed and rendered while later batches are prepared, so
+    that neither the whole prepared data nor all the payloads are held in memory.
+
+    Args:
+        distributor_fname (str): Distributors workbook.
+        exhibitor_fname (str): Exhibitors workbook.
+        theatre_fname (str): Theatres data in .xlsx or .csv format, with the rows of each
+            exhibitor, movie and dates consecutive.
+        template_fname (str): Template file name.
+        css_fname (str): CSS file name.
+        batch_rows (int): Number of theatre rows per batch.
+        workers (int): Number of worker processes, or of soffice invocations for .docx
+            templates. Defaults to 1.
+        max_rss (int): Resident set size ceiling of this process in bytes, 0 for none.
+            Defaults to 0.
+        cache (bool): If True, read unchanged workbooks from the on-disk cache. Defaults to
+            True.
+        callback (Callable | None): Called with the PDF file name of each document
+            generated. Defaults to None.
+
+    Returns:
+        int: Number of documents generated.
+    """
+    distributor_data = extract_distributor_data(
+        clean_distributors_data(read_excel(distributor_fname, cache=cache))
+    )
+    payloads = stream_payloads(
+        read_excel(exhibitor_fname, cache=cache),
+        iter_theatre_batches(theatre_fname, batch_rows, cache),
+    )
+    docs = (
+        (
+            get_fname(
+                FNAME_TPL,
+                count=count,
+                movie=exhibitor_data["movie"].lower(),
+                exhibitor=exhibitor_data["exhibitor"],
+                release_date=exhibitor_data["release_date"],
+            ),
+            distributor_data,
+            exhibitor_data,
+            annexure,
+        )
+        for count, (exhibitor_data, annexure) in enumerate(payloads, start=1)
+    )
+    stage = RenderStage(template_fname, css_fname, workers, callback)
+    try:
+        return run_stages(docs, stage, max_rss=max_rss)
+    finally:
+        stage.close()
@@ -0,0 +1,189 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+
+
+from rich.console import Console
+from rich.table import Table
+
+
+con = Console()
+
+# Name of the document being generated, attached to the spans recorded for it
+current_document: ContextVar[str] = ContextVar("current_document", default="")
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Percentile of a list of values by the nearest-rank method.
+
+    Args:
+        values (list[float]): The values, need not be sorted.
+        p (float): Percentile between 0 and 100.
+
+    Returns:
+        float: The percentile, 0.0 for an empty list.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[k]
+
+
+class Tracer:
+    """Recorder of named, timed spans. Recording is off until enabled, in which case a span
+    costs one context variable lookup."""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+
+    @contextmanager
+    def span(self, name: str):
+        """Time the enclosed block as a span named name, attributed to the current document.
+
+        Args:
+            name (str): Span name.
+        """
+        if not self.enabled:
+            yield
+            return
+        t1 = perf_counter()
+        try:
+            yield
+        finally:
+            t2 = perf_counter()
+            self.events.append(
+                {
+                    "name": name,
+                    "doc": current_document.get(),
+                    "start": t1,
+                    "dur": t2 - t1,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                }
+            )
+
+    @contextmanager
+    def document(self, doc: str):
+        """Attribute the spans recorded in the enclosed block to the document doc.
+
+        Args:
+            doc (str): Document name, usually the output file name.
+        """
+        token = current_document.set(doc)
+        try:
+            yield
+        finally:
+            current_document.reset(token)
+
+    def drain(self) -> list[dict]:
+        """Remove and return the recorded spans, to be sent from a worker process to the
+        parent process.
+
+        Returns:
+            list[dict]: The recorded spans.
+        """
+        events, self.events = self.events, []
+        return events
+
+    def extend(self, events: list[dict]):
+        """Add spans recorded by a worker process.
+
+        Args:
+            events (list[dict]): Spans returned by drain in the worker.
+
+        Returns:
+            None
+        """
+        self.events.extend(events)
+
+    def summary(self, slowest: int = 5):
+        """Print the count, total, p50, p95 and maximum time of each span name, and the
+        documents that took the longest.
+
+        Args:
+            slowest (int): Number of slowest documents to print. Defaults to 5.
+
+        Returns:
+            None
+        """
+        by_name = {}
+        by_doc = {}
+        for event in self.events:
+            by_name.setdefault(event["name"], []).append(event["dur"])
+            if event["doc"]:
+                by_doc[event["doc"]] = by_doc.get(event["doc"], 0.0) + event["dur"]
+
+        table = Table("Span", "Count", "Total (s)", "p50 (ms)", "p95 (ms)", "Max (ms)")
+        for name, durs in by_name.items():
+            table.add_row(
+                name,
+                str(len(durs)),
+                f"{sum(durs):.3f}",
+                f"{1000 * percentile(durs, 50):.1f}",
+                f"{1000 * percentile(durs, 95):.1f}",
+                f"{1000 * max(durs):.1f}",
+            )
+        con.print(table)
+
+        if by_doc:
+            table = Table("Slowest documents", "Time (ms)")
+            for doc, dur in sorted(by_doc.items(), key=lambda d: -d[1])[:slowest]:
+                table.add_row(doc, f"{1000 * dur:.1f}")
+            con.print(table)
+
+    def write_chrome_trace(self, fname: str):
+        """Write the recorded spans in Chrome trace event format, to be opened with
+        chrome://tracing or https://ui.perfetto.dev.
+
+        Args:
+            fname (str): Trace file name.
+
+        Returns:
+            None
+        """
+        t0 = min((event["start"] for event in self.events), default=0.0)
+        trace_events = [
+            {
+                "name": event["name"],
+                "cat": "agreement",
+                "ph": "X",
+                "ts": round(1e6 * (event["start"] - t0)),
+                "dur": round(1e6 * event["dur"]),
+                "pid": event["pid"],
+                "tid": event["tid"],
+                "args": {"doc": event["doc"]},
+            }
+            for event in self.events
+        ]
+        with open(fname, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": trace_events}, f)
+
+
+tracer = Tracer()
+
+
+def traced(name: str):
+    """Decorator that records each call of the decorated function as a span.
+
+    Args:
+        name (str): Span name.
+
+    Returns:
+        Callable: The decorator.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -43,6 +43,22 @@ def get_fname(fname_tpl: str, **kwargs) -> str:
     return fname
 
 
+def print_header(header: str, underline: str = "-"):
+    """Print header with underline.
+
+    Args:
+        header (str): Header text.
+        underline (str): Underline character. Defaults to "-".
+
+    Returns:
+        None
+    """
+    print()
+    print(header)
+    print(f"{underline * len(header)}")
+    print()
+
+
 if __name__ == "__main__":
     fname_tpl = "{count:02}_{movie}_{exhibitor}_{release_date}"
     print(
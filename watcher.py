@@ -0,0 +1,327 @@
+import os
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os.path import abspath, dirname, isfile
+
+
+from rich.console import Console
+
+
+from tracing import tracer
+from utils import get_fname, tpl_suffix
+
+
+GROUP_COLS = ["exhibitor", "exhibitor_place", "movie", "release_date", "agreement_date"]
+FNAME_TPL = "{count:02}_{movie}_{exhibitor}_{release_date}"
+
+con = Console()
+
+
+class FileWatcher:
+    """Watcher of a set of files. Uses watchfiles, which relies on inotify and its
+    equivalents, when it is installed, and otherwise polls the modification time and size
+    of the files. Editors that save by replacing a file are handled in both cases, since
+    the directories of the files are watched.
+
+    Args:
+        fnames (list[str]): File names to watch.
+        interval (float): Polling interval in seconds. Defaults to 0.5.
+        debounce (float): Changes are reported once the files have not changed for this
+            many seconds. Defaults to 0.3.
+    """
+
+    def __init__(self, fnames: list[str], interval: float = 0.5, debounce: float = 0.3):
+        self.fnames = {abspath(fname) for fname in fnames}
+        self.interval = interval
+        self.debounce = debounce
+        self.changes = None
+        try:
+            import watchfiles
+
+            self.changes = watchfiles.watch(
+                *{dirname(fname) for fname in self.fnames},
+                watch_filter=lambda change, path: abspath(path) in self.fnames,
+                debounce=int(debounce * 1000),
+                step=int(min(interval, debounce) * 1000),
+            )
+        except ImportError:
+            self.state = self.snapshot()
+
+    def snapshot(self) -> dict[str, tuple]:
+        """Modification time and size of each watched file, None if it does not exist.
+
+        Returns:
+            dict[str, tuple]: The state of each file.
+        """
+        state = {}
+        for fname in self.fnames:
+            try:
+                stat = os.stat(fname)
+                state[fname] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                state[fname] = None
+        return state
+
+    def wait(self) -> set[str]:
+        """Block until some of the files change, and then until they stop changing.
+
+        Returns:
+            set[str]: Absolute paths of the files that changed.
+        """
+        if self.changes is not None:
+            return {abspath(path) for _, path in next(self.changes)}
+        while True:
+            time.sleep(self.interval)
+            state = self.snapshot()
+            if state != self.state:
+                break
+        # Wait for an editor or a spreadsheet program to finish writing
+        while True:
+            time.sleep(self.debounce)
+            settled = self.snapshot()
+            if settled == state:
+                break
+            state = settled
+        changed = {fname for fname in self.fnames if state[fname] != self.state[fname]}
+        self.state = state
+        return changed
+
+
+class WatchSession:
+    """Regenerate agreement documents as their inputs change. The workbooks are kept in
+    memory as parsed DataFrames and a workbook is read again only when it changes. A change
+    of the template or stylesheet keeps the prepared data and only renders again. In either
+    case only the documents whose payload hash changed are generated, in parallel, and
+    the outputs of documents that no longer exist are removed.
+
+    Args:
+        distributor_fname (str): Distributors workbook.
+        exhibitor_fname (str): Exhibitors workbook.
+        theatre_fname (str): Theatres workbook.
+        template_fname (str): Template file name.
+        css_fname (str): CSS file name, ignored for .docx templates.
+        manifest (Manifest): Manifest of the documents generated so far.
+        workers (int): Number of worker processes, or of soffice invocations for .docx
+            templates. Defaults to 1.
+        cache (bool): If True, read unchanged workbooks from the on-disk cache. Defaults
+            to True.
+    """
+
+    def __init__(
+        self,
+        distributor_fname: str,
+        exhibitor_fname: str,
+        theatre_fname: str,
+        template_fname: str,
+        css_fname: str,
+        manifest,
+        workers: int = 1,
+        cache: bool = True,
+    ):
+        self.workbooks = [distributor_fname, exhibitor_fname, theatre_fname]
+        self.template_fname = template_fname
+        self.css_fname = css_fname
+        self.tpl_type = tpl_suffix(template_fname)
+        self.manifest = manifest
+        self.workers = workers
+        self.cache = cache
+        self.frames = {}
+        self.executor = None
+        self.renderer = None
+
+    def watched(self) -> list[str]:
+        """Files that are watched: the workbooks, the template and the stylesheet.
+
+        Returns:
+            list[str]: File names.
+        """
+        fnames = [*self.workbooks, self.template_fname]
+        if self.tpl_type in ["md", "html"]:
+            fnames.append(self.css_fname)
+        return fnames
+
+    def read(self, fname: str):
+        """Parsed DataFrame of a workbook, read again only after it changes.
+
+        Args:
+            fname (str): Workbook file name.
+
+        Returns:
+            pl.DataFrame: The DataFrame.
+        """
+        from mergedata import read_excel
+
+        if fname not in self.frames:
+            con.log(f"Reading {fname}")
+            self.frames[fname] = read_excel(fname, cache=self.cache)
+        return self.frames[fname]
+
+    def prepare(self) -> list[tuple]:
+        """Prepare the data and compute the payload hash of each document.
+
+        Returns:
+            list[tuple]: Output file name without suffix, payload hash, distributor data,
+                exhibitor data and annexure data of each document.
+        """
+        from manifest import payload_hash, template_hash
+        from mergedata import (
+            prepare_data_lazy,
+            extract_distributor_data,
+            extract_payloads,
+        )
+
+        distributors, df = prepare_data_lazy(
+            *(self.read(fname) for fname in self.workbooks), GROUP_COLS
+        )
+        with tracer.span("prepare_data"):
+            df = df.collect()
+        payloads = extract_payloads(df, GROUP_COLS)
+        distributor_data = extract_distributor_data(distributors)
+        tpl_digest = template_hash(self.template_fname, self.css_fname)
+        docs = []
+        for count, (exhibitor_data, annexure) in enumerate(payloads, start=1):
+            output_fname = get_fname(
+                FNAME_TPL,
+                count=count,
+                movie=exhibitor_data["movie"].lower(),
+                exhibitor=exhibitor_data["exhibitor"],
+                release_date=exhibitor_data["release_date"],
+            )
+            digest = payload_hash(
+                distributor_data, exhibitor_data, annexure, tpl_digest
+            )
+            docs.append(
+                (output_fname, digest, distributor_data, exhibitor_data, annexure)
+            )
+        return docs
+
+    def restart_renderer(self):
+        """Create the renderer, or the worker processes that each hold one, again, so that
+        they load the current stylesheet. A changed template is reloaded by Jinja2 without
+        a restart.
+
+        Returns:
+            None
+        """
+        from htmlmerge import PdfRenderer, init_render_worker
+
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=init_render_worker,
+                initargs=(self.template_fname, self.tpl_type, self.css_fname),
+            )
+        else:
+            self.renderer = PdfRenderer(
+                self.template_fname, self.tpl_type, self.css_fname
+            )
+
+    def render(self, docs: list[tuple]):
+        """Generate the PDF files of documents.
+
+        Args:
+            docs (list[tuple]): Documents, as returned by prepare.
+
+        Returns:
+            None
+        """
+        if self.tpl_type == "docx":
+            from docxmerge import (
+                docx_mergefields,
+                detect_soffice_path,
+                soffice_docx2pdf_batch,
+            )
+
+            soffice_path, _, _ = detect_soffice_path()
+            with tempfile.TemporaryDirectory() as docx_dir:
+                docx_fnames = []
+                for output_fname, _, *data in docs:
+                    docx_fname = os.path.join(docx_dir, f"{output_fname}.docx")
+                    docx_mergefields(self.template_fname, docx_fname, *data)
+                    docx_fnames.append(docx_fname)
+                soffice_docx2pdf_batch(docx_fnames, soffice_path, ".", 50, self.workers)
+        elif self.executor:
+            from htmlmerge import render_worker
+
+            futures = [
+                self.executor.submit(render_worker, (f"{output_fname}.pdf", *data))
+                for output_fname, _, *data in docs
+            ]
+            for future in as_completed(futures):
+                _, events, _ = future.result()
+                tracer.extend(events)
+        else:
+            for output_fname, _, *data in docs:
+                self.renderer.write_pdf(f"{output_fname}.pdf", *data)
+
+    def update(self, changed: set[str]):
+        """Generate the documents affected by changed files.
+
+        Args:
+            changed (set[str]): Absolute paths of the changed files.
+
+        Returns:
+            None
+        """
+        for fname in self.workbooks:
+            if abspath(fname) in changed:
+                self.frames.pop(fname, None)
+        started = self.renderer is not None or self.executor is not None
+        if self.tpl_type in ["md", "html"] and (
+            not started or abspath(self.css_fname) in changed
+        ):
+            self.restart_renderer()
+        t1 = time.perf_counter()
+        docs = self.prepare()
+        self.manifest.current = {}
+        outdated = []
+        for output_fname, digest, *data in docs:
+            self.manifest.record(f"{output_fname}.pdf", digest)
+            if not self.manifest.is_current(f"{output_fname}.pdf", digest):
+                outdated.append((output_fname, digest, *data))
+        for stale_fname in self.manifest.remove_stale():
+            con.log(f"Removed stale {stale_fname}")
+        self.render(outdated)
+        self.manifest.save()
+        self.manifest.previous = dict(self.manifest.current)
+        con.log(
+            f"Generated {len(outdated)} of {len(docs)} documents in {time.perf_counter() - t1:.2f}s"
+        )
+
+    def run(self, interval: float = 0.5):
+        """Generate the documents affected by each change of the watched files until
+        interrupted.
+
+        Args:
+            interval (float): Polling interval in seconds, if watchfiles is not installed.
+                Defaults to 0.5.
+
+        Returns:
+            None
+        """
+        watcher = FileWatcher(self.watched(), interval)
+        con.print(
+            f"Watching {', '.join(self.watched())} for changes, press Ctrl+C to stop"
+        )
+        try:
+            while True:
+                changed = watcher.wait()
+                con.log(f"Changed: {', '.join(sorted(changed))}")
+                missing = [fname for fname in self.watched() if not isfile(fname)]
+                if missing:
+                    con.log(f"Waiting for {', '.join(missing)}")
+                    continue
+                try:
+                    self.update(changed)
+                except Exception as e:
+                    # Keep watching after an error in a half edited file
+                    con.log(f"[red]Generation failed: {e}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.executor:
+                self.executor.shutdown()